@@ -5,8 +5,8 @@ a = Analysis(
     ['main.py'],
     pathex=[],
     binaries=[],
-    datas=[('app', 'app'), ('usm.ico', '.'), ('config.json', '.')],
-    hiddenimports=['pandas', 'openpyxl', 'PyQt5', 'sqlalchemy'],
+    datas=[('app', 'app'), ('usm.ico', '.'), ('config.json', '.'), ('extensions', 'extensions')],
+    hiddenimports=['pandas', 'openpyxl', 'PyQt5', 'sqlalchemy', 'pyarrow', 'duckdb'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -10,7 +10,14 @@ DEFAULT_CONFIG = {
     "database_path": "logistics_processor.db",
     "stg_folder": "",
     "existing_data_path": "",
-    "route_id_path": ""
+    "history_months": None,
+    "batch_workers": 1,
+    "stage_cache": True,
+    "route_mapping": "pandas",
+    "query_engine": "sqlite",
+    "route_id_path": "",
+    "profile_memory": False,
+    "export_trace": False
 }
 
 def get_config_path():
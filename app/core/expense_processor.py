@@ -1,11 +1,15 @@
 import os
 import pandas as pd
+import numpy as np
 from openpyxl import load_workbook
 import logging
 from typing import List, Dict, Tuple, Optional
 
 from app.database.operations import get_active_routes, get_matrix_mappings
 from app.utils.file_utils import ensure_directory_exists
+from app.utils.key_encoding import (
+    KeyDictionary, normalize_invoice_numbers, normalize_wagon_numbers, pack_wn_keys
+)
 
 logger = logging.getLogger(__name__)
 
@@ -24,18 +28,21 @@ class ExpenseProcessor:
         
         # Ensure directory exists
         ensure_directory_exists(self.output_directory)
+        
+        # Invoice codes for the (wagon, invoice) join, built from the Route ID and
+        # expense files themselves so matching does not depend on the database
+        self.invoices = KeyDictionary("invoices")
+        self.unkeyed_expense_rows = 0
     
-    def format_value(self, value) -> str:
-        """Format values consistently to ensure proper matching."""
-        try:
-            if pd.notna(value):
-                if isinstance(value, float) and value.is_integer():
-                    return str(int(value)).zfill(8)
-                elif str(value).isdigit():
-                    return str(int(value)).zfill(8)
-            return str(value).strip()
-        except Exception:
-            return str(value).strip()
+    def wn_keys(self, wagon_numbers, invoice_numbers) -> np.ndarray:
+        """
+        Return the packed (wagon, invoice) key of each row, encoding invoices with
+        the processor's in-memory dictionary. Rows missing either part get -1.
+        """
+        return pack_wn_keys(
+            normalize_wagon_numbers(wagon_numbers),
+            self.invoices.encode(normalize_invoice_numbers(invoice_numbers))
+        )
     
     def find_and_clean_headers(self, df, expected_columns) -> Tuple[pd.DataFrame, int]:
         """Find headers by inspecting the top rows and remove rows before the header."""
@@ -74,13 +81,16 @@ class ExpenseProcessor:
                 'Номер документа': 'Накладная №'
             }, inplace=True)
             
-            # Format values for consistent matching
-            main_data['Вагон №'] = main_data['Вагон №'].apply(self.format_value)
-            main_data['Накладная №'] = main_data['Накладная №'].apply(self.format_value)
+            # Key the rows like the reference data; invoices it never saw match nothing
+            main_data['wn_key'] = self.wn_keys(main_data['Вагон №'], main_data['Накладная №'])
+            unkeyed = int((main_data['wn_key'] < 0).sum())
+            if unkeyed:
+                logger.warning(f"{unkeyed} of {len(main_data)} rows in {file_path} have no wagon or invoice number")
+                self.unkeyed_expense_rows += unkeyed
             
             # Merge with reference data
             merged_data = main_data.merge(
-                reference_data, how='left', on=['Вагон №', 'Накладная №']
+                reference_data[['wn_key', 'ЗНП']], how='left', on='wn_key'
             )
             
             # Ensure ЗНП column is numeric and fill nulls with 0
@@ -165,15 +175,20 @@ class ExpenseProcessor:
         """Process all expense files in a folder."""
         # Load reference data
         reference_data = pd.read_csv(route_id_data_path, encoding='utf-8')
-        reference_data['Вагон №'] = reference_data['Вагон №'].apply(self.format_value)
-        reference_data['Накладная №'] = reference_data['Накладная №'].apply(self.format_value)
+        reference_data['wn_key'] = self.wn_keys(reference_data['Вагон №'], reference_data['Накладная №'])
+        unkeyed_reference_rows = int((reference_data['wn_key'] < 0).sum())
+        if unkeyed_reference_rows:
+            logger.warning(f"{unkeyed_reference_rows} of {len(reference_data)} Route ID rows "
+                           f"have no wagon or invoice number and are skipped")
+        reference_data = reference_data[reference_data['wn_key'] >= 0]
+        self.unkeyed_expense_rows = 0
         
         # Remove completely identical duplicates from reference data
         initial_len = len(reference_data)
         # First remove exact duplicates
         reference_data = reference_data.drop_duplicates()
         # Then handle duplicates by wagon and invoice, keeping the first occurrence
-        reference_data = reference_data.drop_duplicates(subset=['Вагон №', 'Накладная №'], keep='first')
+        reference_data = reference_data.drop_duplicates(subset=['wn_key'], keep='first')
         if len(reference_data) < initial_len:
             logger.info(f"Removed {initial_len - len(reference_data)} duplicate rows from reference data")
         
@@ -207,5 +222,7 @@ class ExpenseProcessor:
         return {
             "processed_files": processed_files,
             "skipped_files": skipped_files,
-            "error_files": error_files
+            "error_files": error_files,
+            "unkeyed_reference_rows": unkeyed_reference_rows,
+            "unkeyed_expense_rows": self.unkeyed_expense_rows
         }
\ No newline at end of file
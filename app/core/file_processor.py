@@ -1,15 +1,93 @@
 import pandas as pd
+import numpy as np
 import os
 from datetime import datetime
 import logging
-from typing import List, Dict, Tuple, Optional
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, List, Dict, Tuple, Optional, Iterable, Iterator, Sequence
 
-from app.database.operations import get_znp_data, get_exceptions, get_overrides
-from app.utils.file_utils import get_files_by_pattern, ensure_directory_exists
+from app.database.operations import (
+    get_znp_data, lookup_znp_codes, get_exceptions, get_overrides, add_run_metrics,
+    upsert_stg_data, get_stg_history, get_stg_partitions, get_wn_keys,
+    iter_stg_history_by_wagon, update_stg_batch_ids, get_stg_history_for_wagons, get_loaded_counts_by_wagon,
+    get_route_dirty_wagons, clear_route_dirty_wagons, sync_wagon_invoices, shift_wagon_invoice_batches,
+    get_reference_version, map_route_ids_in_database, get_route_id_data, is_history_snapshot_imported,
+    record_history_snapshot
+)
+from app.core.stage_cache import StageCache, stage_key
+from app.core.history_store import (
+    SNAPSHOT_COLUMNS, resolve_history_snapshot, read_history_snapshot, write_history_snapshot,
+    export_history_workbook, is_history_snapshot, default_snapshot_path, resolve_month_range
+)
+from app.utils.file_utils import get_files_by_pattern, ensure_directory_exists, get_file_hash
 from app.utils.data_utils import standardize_column_types
+from app.utils.metrics import RunMetrics
+from app.utils.stg_schema import (
+    prepare_stg_frame, concat_stg_frames, MONTH_DTYPE, BATCH_ID_DTYPE, STG_REQUIRED_COLUMNS
+)
+from app.utils.key_encoding import KeyEncoding
 
 logger = logging.getLogger(__name__)
 
+class BatchState:
+    """
+    State of the batch ID walk carried from one wagon-sorted chunk to the next:
+    the wagon and batch of the last row, and the number of ГРУЖ rows seen so far.
+    """
+
+    def __init__(self):
+        self.last_wagon = None
+        self.last_batch = 0
+        self.loaded_count = 0
+
+def walk_batch_ids(wagons: np.ndarray, is_loaded: np.ndarray, is_empty: np.ndarray,
+                   state: BatchState) -> np.ndarray:
+    """
+    Return the batch ID of each row of a (wagon, report date) sorted chunk and
+    advance the state past it. Every ГРУЖ row opens the next batch number, a ПОР
+    row inherits the batch of the previous row of the same wagon (possibly the
+    last row of the previous chunk), and any other row gets batch 0.
+    """
+    if not len(wagons):
+        return np.zeros(0, dtype=np.int64)
+    
+    # A ПОР row continues the previous row's batch only within the same wagon
+    same_wagon = np.zeros(len(wagons), dtype=bool)
+    same_wagon[1:] = wagons[1:] == wagons[:-1]
+    same_wagon[0] = state.last_wagon is not None and wagons[0] == state.last_wagon
+    continues = is_empty & same_wagon
+    
+    # Every other row starts a segment whose batch is its ГРУЖ number (or 0);
+    # rows before the first start continue the previous chunk's last batch
+    loaded_numbers = state.loaded_count + np.cumsum(is_loaded)
+    starts = ~continues
+    segment_values = np.concatenate(([state.last_batch], np.where(is_loaded, loaded_numbers, 0)[starts]))
+    batch_ids = segment_values[np.cumsum(starts)]
+    
+    state.last_wagon = wagons[-1]
+    state.last_batch = int(batch_ids[-1])
+    state.loaded_count = int(loaded_numbers[-1])
+    return batch_ids
+
+# Wagons recomputed per step of an incremental route ID update
+ROUTE_UPDATE_WAGONS = 5000
+
+# Below this many rows the serial walk is faster than starting worker processes
+PARALLEL_BATCH_MIN_ROWS = 500_000
+
+def walk_wagon_shard(wagons: np.ndarray, dates: np.ndarray, is_nat: np.ndarray, is_loaded: np.ndarray,
+                     is_empty: np.ndarray, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    Sort one shard of whole wagons by (wagon, report date) and walk its batches.
+    Runs in a worker process. Returns the shard's row positions in sorted order,
+    its local batch IDs (numbered from 1) and its number of ГРУЖ rows.
+    """
+    # Stable, with missing wagons and dates last, like sort_values(kind="mergesort")
+    order = np.lexsort((dates, is_nat, wagons, np.isnan(wagons)))
+    state = BatchState()
+    batch_ids = walk_batch_ids(wagons[order], is_loaded[order], is_empty[order], state)
+    return positions[order], batch_ids, state.loaded_count
+
 class FileProcessor:
     """
     Replaces the Power BI logic for processing STG files and generating route IDs.
@@ -21,10 +99,20 @@ class FileProcessor:
         self.output_dir = config.get('output_directory', './output')
         ensure_directory_exists(self.output_dir)
         
+        # Stage instrumentation; process_workflow replaces this with an active collector
+        self.metrics = RunMetrics(enabled=False)
+        
+        # Persisted stage outputs, so reruns skip stages whose inputs are unchanged
+        self.stage_cache = None
+        if config.get('stage_cache', True):
+            self.stage_cache = StageCache(os.path.join(self.output_dir, 'stage_cache'))
+        
     def process_daily_files(self, folder_path: str) -> pd.DataFrame:
         """
         Process all STG daily files from a folder.
         Replaces the first part of your Power BI M-code.
+        Each file is converted with the STG dtype plan as it is read, and the
+        combined rows get their packed (wagon, invoice) key once.
         """
         # Get all STG files
         stg_files = get_files_by_pattern(folder_path, "STGDaily_*.xlsx")
@@ -33,134 +121,220 @@ class FileProcessor:
             logger.warning(f"No STG daily files found in {folder_path}")
             return pd.DataFrame()
         
-        # Load and combine data from all files
-        combined_data = pd.DataFrame()
+        # Load data from all files and combine once at the end
+        frames = []
         
         for file_path in stg_files:
             try:
                 logger.info(f"Processing file: {file_path}")
-                df = pd.read_excel(file_path)
+                with self.metrics.stage("read_daily_file", file_name=file_path) as stage:
+                    df = pd.read_excel(file_path)
+                    stage.rows_out = len(df)
                 
-                # Ensure column headers are standardized
-                df.columns = [col.strip() for col in df.columns]
-                
-                # Apply column type standardization
-                column_types = {
-                    "Вагон №": 'int64',
-                    "Накладная №": 'str',
-                    "Ст. отправления": 'str',
-                    "Ст. назначения": 'str',
-                    "Прибытие на ст. отправл.": 'datetime64',
-                    "Отчетная дата": 'datetime64',
-                    "Прибытие на ст. назн.": 'datetime64',
-                    "Груж\\пор": 'str',
-                    "Тип вагона": 'str',
-                    "Расстояние": 'int64',
-                    "Собственник": 'str',
-                    "Грузоотправитель": 'str',
-                    "Грузополучатель": 'str',
-                    "Простой в ожидании ремонта": 'float'
-                }
-                
-                df = standardize_column_types(df, column_types)
-                
-                # Append to combined data
-                combined_data = pd.concat([combined_data, df], ignore_index=True)
+                frames.append(prepare_stg_frame(df))
                 
             except Exception as e:
                 logger.error(f"Error processing file {file_path}: {str(e)}")
         
-        return combined_data
+        daily_data = concat_stg_frames(frames)
+        if not daily_data.empty:
+            daily_data["wn_key"] = get_wn_keys(daily_data["wagon_number"], daily_data["invoice_number"])
+        return daily_data
     
-    def merge_with_existing_data(self, daily_data: pd.DataFrame, existing_data_path: str) -> pd.DataFrame:
+    def merge_with_existing_data(self, daily_data: pd.DataFrame, existing_data_path: str,
+                                 months: Optional[Sequence] = None) -> pd.DataFrame:
         """
         Merge new daily data with existing historical data.
+        The history lives in the stg_data table keyed by (wagon, invoice); daily rows
+        are upserted so a row only replaces one with the same or an older report date.
+        
+        existing_data_path is a columnar history snapshot (a workbook is imported into
+        one on first use); it is imported into the history once, see seed_history.
+        months (the history_months setting, see resolve_month_range) limits the
+        returned history to the (year, month) partitions in that range. The
+        snapshot file is not rewritten here; see save_history_snapshot.
         """
         try:
-            # Load existing data
-            existing_data = pd.read_excel(existing_data_path)
-            
-            # Apply column type standardization to existing data
-            column_types = {
-                "Вагон №": 'int64',
-                "Накладная №": 'str',
-                "Ст. отправления": 'str',
-                "Ст. назначения": 'str',
-                "Прибытие на ст. отправл.": 'datetime64',
-                "Отчетная дата": 'datetime64',
-                "Прибытие на ст. назн.": 'datetime64',
-                "Груж\\пор": 'str',
-                "Тип вагона": 'str'
-            }
-            
-            existing_data = standardize_column_types(existing_data, column_types)
-            
-            # Combine existing and daily data
-            combined_data = pd.concat([existing_data, daily_data], ignore_index=True)
+            self.seed_history(existing_data_path)
             
-            # Remove null values in key columns
-            combined_data = combined_data.dropna(subset=["Вагон №", "Накладная №", "Груж\\пор", "Отчетная дата"])
+            # Apply the daily rows, keeping the latest entry per wagon and invoice
+            upsert_stg_data(daily_data.dropna(subset=STG_REQUIRED_COLUMNS))
             
-            # Deduplicate data, keeping latest entries
-            combined_data = combined_data.sort_values("Отчетная дата", ascending=True)
-            combined_data = combined_data.drop_duplicates(subset=["Вагон №", "Накладная №"], keep='last')
-            
-            # Add W&N column for easier reference
-            combined_data["W&N"] = combined_data["Вагон №"].astype(str) + combined_data["Накладная №"].astype(str)
-            
-            return combined_data
+            # Read only the partitions of the requested months
+            partitions = None
+            if months:
+                partitions = get_stg_partitions()
+                first, last = resolve_month_range(months, partitions)
+                logger.info(f"Reading STG history from {first[0]}-{first[1]:02d} to {last[0]}-{last[1]:02d}")
+                partitions = [p for p in partitions if first <= p <= last]
+            return prepare_stg_frame(get_stg_history(partitions))
             
         except Exception as e:
             logger.error(f"Error merging with existing data: {str(e)}")
             return daily_data
     
-    def assign_batch_ids(self, data: pd.DataFrame) -> pd.DataFrame:
+    def seed_history(self, existing_data_path: str) -> int:
+        """
+        Import the whole history snapshot into the STG history unless this snapshot
+        file (by content hash) is already contained in it. The rows are upserted like
+        daily rows, so history that is already stored, e.g. from daily files ingested
+        before the snapshot, is only replaced by snapshot rows that are as recent.
+        Returns the number of rows applied.
+        """
+        snapshot_path = resolve_history_snapshot(existing_data_path)
+        if not snapshot_path:
+            return 0
+        
+        content_hash = get_file_hash(snapshot_path)
+        if is_history_snapshot_imported(content_hash):
+            return 0
+        
+        logger.info(f"Seeding STG history from {snapshot_path}")
+        rows = upsert_stg_data(read_history_snapshot(snapshot_path, columns=SNAPSHOT_COLUMNS))
+        # Recorded after the rows are committed; an interrupted import is simply repeated
+        record_history_snapshot(snapshot_path, content_hash, rows)
+        return rows
+    
+    def save_history_snapshot(self, existing_data_path: str) -> str:
+        """
+        Write the whole STG history to the history snapshot, on demand.
+        The current snapshot is imported first, so the history written is a superset
+        of it; the new file is then recorded as contained in the history.
+        Returns the snapshot path.
+        """
+        snapshot_path = resolve_history_snapshot(existing_data_path)
+        if snapshot_path:
+            self.seed_history(snapshot_path)
+        elif is_history_snapshot(existing_data_path):
+            snapshot_path = existing_data_path
+        else:
+            snapshot_path = default_snapshot_path(existing_data_path)
+        
+        history = prepare_stg_frame(get_stg_history())
+        write_history_snapshot(history, snapshot_path)
+        record_history_snapshot(snapshot_path, get_file_hash(snapshot_path), len(history))
+        return snapshot_path
+    
+    def assign_batch_ids(self, data: pd.DataFrame, workers: Optional[int] = None) -> pd.DataFrame:
         """
         Assign batch IDs based on wagon numbers and груж/пор values.
         Replaces the batch ID logic from your second M-code block.
+        
+        Rows are walked in (wagon, report date) order: every ГРУЖ row opens the next
+        batch number, a ПОР row inherits the batch of the previous row of the same
+        wagon, and any other row gets batch 0. The walk is vectorized, so the
+        column dtypes of the input are kept.
+        
+        With more than one worker (default: the 'batch_workers' setting) large
+        inputs are sharded by wagon across processes, see assign_batch_ids_parallel.
         """
+        workers = workers or self.config.get('batch_workers', 1)
+        if workers > 1 and len(data) >= PARALLEL_BATCH_MIN_ROWS:
+            return self.assign_batch_ids_parallel(data, workers)
+        
         # Sort data by wagon number and report date
-        sorted_data = data.sort_values(by=["wagon_number", "report_date"])
-        
-        # Initialize variables for batch assignment
-        last_batch_id = 0
-        last_gruz_batch_id = 0
-        last_wagon = None
-        result_data = []
-        
-        # Process each row
-        for _, row in sorted_data.iterrows():
-            current_wagon = row["wagon_number"]
-            gruzh_por_value = row["load_status"]
-            
-            # Assign batch ID based on logic
-            if gruzh_por_value == "ГРУЖ":
-                new_batch_id = last_gruz_batch_id + 1
-                last_gruz_batch_id = new_batch_id
-            elif gruzh_por_value == "ПОР" and last_wagon == current_wagon:
-                new_batch_id = last_batch_id
-            else:
-                new_batch_id = 0
-            
-            # Add batch ID to row
-            row_with_batch = row.copy()
-            row_with_batch["batch_id"] = new_batch_id
-            result_data.append(row_with_batch)
-            
-            # Update tracking variables
-            last_batch_id = new_batch_id
-            last_wagon = current_wagon
+        sorted_data = data.sort_values(by=["wagon_number", "report_date"], kind="mergesort")
+        
+        return self._assign_chunk_batch_ids(sorted_data, BatchState())
+    
+    def _assign_chunk_batch_ids(self, sorted_chunk: pd.DataFrame, state: BatchState) -> pd.DataFrame:
+        """Return a copy of a wagon-sorted chunk with batch IDs, advancing the state."""
+        batch_ids = walk_batch_ids(
+            sorted_chunk["wagon_number"].to_numpy(),
+            (sorted_chunk["load_status"] == "ГРУЖ").to_numpy(),
+            (sorted_chunk["load_status"] == "ПОР").to_numpy(),
+            state
+        )
         
-        # Convert back to DataFrame
-        result_df = pd.DataFrame(result_data)
+        result_df = sorted_chunk.copy()
+        result_df["batch_id"] = pd.array(batch_ids, dtype=BATCH_ID_DTYPE)
         
         return result_df
     
+    def assign_batch_ids_parallel(self, data: pd.DataFrame, workers: int) -> pd.DataFrame:
+        """
+        Assign batch IDs with wagons sharded across worker processes.
+        Shards are contiguous wagon ranges of about equal size, so each wagon's
+        rows stay in one shard. Workers sort and number their shard from 1; the
+        shards are then renumbered in wagon order by adding the ГРУЖ count of all
+        earlier shards, which makes the result identical to the serial walk.
+        """
+        wagons = data["wagon_number"].to_numpy(dtype=float, na_value=np.nan)
+        report_dates = pd.to_datetime(data["report_date"])
+        is_nat = report_dates.isna().to_numpy()
+        dates = report_dates.to_numpy().astype(np.int64)
+        is_loaded = (data["load_status"] == "ГРУЖ").to_numpy(dtype=bool, na_value=False)
+        is_empty = (data["load_status"] == "ПОР").to_numpy(dtype=bool, na_value=False)
+        
+        # Cut the wagon range at quantiles; missing wagons sort last, into the last shard
+        valid_wagons = wagons[~np.isnan(wagons)]
+        cuts = np.unique(np.quantile(valid_wagons, np.linspace(0, 1, workers + 1)[1:-1])) if len(valid_wagons) else []
+        shards = np.searchsorted(cuts, wagons, side="right")
+        
+        shard_positions = [np.flatnonzero(shards == shard) for shard in range(len(cuts) + 1)]
+        shard_positions = [positions for positions in shard_positions if len(positions)]
+        with ProcessPoolExecutor(max_workers=min(workers, len(shard_positions))) as executor:
+            results = list(executor.map(
+                walk_wagon_shard,
+                *zip(*[
+                    (wagons[p], dates[p], is_nat[p], is_loaded[p], is_empty[p], p)
+                    for p in shard_positions
+                ])
+            ))
+        
+        # Offset each shard's batches by the ГРУЖ rows of the shards before it
+        offsets = np.concatenate(([0], np.cumsum([loaded_count for _, _, loaded_count in results])[:-1]))
+        order = np.concatenate([positions for positions, _, _ in results])
+        batch_ids = np.concatenate([
+            np.where(local_ids > 0, local_ids + offset, 0)
+            for (_, local_ids, _), offset in zip(results, offsets)
+        ])
+        
+        result_df = data.iloc[order].copy()
+        result_df["batch_id"] = pd.array(batch_ids, dtype=BATCH_ID_DTYPE)
+        
+        logger.info(f"Assigned batch IDs to {len(result_df)} rows in {len(results)} wagon shards")
+        return result_df
+    
+    def assign_batch_ids_chunked(self, sorted_chunks: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """
+        Assign batch IDs to data arriving as consecutive chunks of one (wagon,
+        report date) sorted sequence, e.g. from iter_stg_history_by_wagon.
+        Only one chunk is held at a time; the last wagon, last batch and ГРУЖ
+        counter are carried across chunk boundaries, so the IDs are identical to
+        assign_batch_ids on the concatenated data.
+        """
+        state = BatchState()
+        for chunk in sorted_chunks:
+            yield self._assign_chunk_batch_ids(chunk, state)
+    
+    def assign_history_batch_ids(self, chunk_rows: int = 100_000) -> int:
+        """
+        Assign batch IDs to the stored STG history out of core: the history is
+        streamed in wagon order chunk_rows rows at a time and the IDs are written
+        back to stg_data. Returns the number of batches.
+        The walk always covers the whole history: the stored IDs are one global
+        numbering that the incremental route update continues from.
+        """
+        chunks = (prepare_stg_frame(chunk) for chunk in iter_stg_history_by_wagon(chunk_rows))
+        
+        rows = 0
+        batch_count = 0
+        for batched_chunk in self.assign_batch_ids_chunked(chunks):
+            rows += update_stg_batch_ids(batched_chunk["id"], batched_chunk["batch_id"])
+            batch_count = max(batch_count, int(batched_chunk["batch_id"].max()))
+        
+        logger.info(f"Assigned {batch_count} batches to {rows} STG history rows in chunks of {chunk_rows}")
+        return batch_count
+    
     def map_znp_to_batches(self, batched_data: pd.DataFrame) -> pd.DataFrame:
         """
         Map ЗНП data to batched records.
         Replaces the ЗНП mapping logic from your third and fourth M-code blocks.
         """
+        # Diagnostics that scan the frames are only computed when debug logging is on
+        log_debug = logger.isEnabledFor(logging.DEBUG)
+        
         # Add month column safely
         try:
             if "month" not in batched_data.columns:
@@ -170,7 +344,7 @@ class FileProcessor:
                 
                 batched_data["report_date"] = pd.to_datetime(batched_data["report_date"], errors='coerce')
                 # Extract month, handling NaT values
-                batched_data["month"] = batched_data["report_date"].dt.month.fillna(0).astype(int)
+                batched_data["month"] = batched_data["report_date"].dt.month.fillna(0).astype(MONTH_DTYPE)
                 
                 # Log the unique months found
                 unique_months = batched_data["month"].unique()
@@ -181,8 +355,8 @@ class FileProcessor:
                     logger.error("All months are 0, indicating possible date conversion issues")
                     raise ValueError("Failed to extract valid months from dates")
             else:
-                # If month column exists, ensure it's an integer
-                batched_data["month"] = pd.to_numeric(batched_data["month"], errors='coerce').fillna(0).astype(int)
+                # If month column exists, ensure it's a small integer
+                batched_data["month"] = pd.to_numeric(batched_data["month"], errors='coerce').fillna(0).astype(MONTH_DTYPE)
         except Exception as e:
             logger.error(f"Error processing month data: {str(e)}")
             logger.error(f"Available columns: {batched_data.columns.tolist()}")
@@ -210,21 +384,35 @@ class FileProcessor:
             'ЗНП': 'znp'
         })
         
-        # Ensure month column in znp_data is also integer
-        znp_data["month"] = pd.to_numeric(znp_data["month"], errors='coerce').fillna(0).astype(int)
+        # Ensure month column in znp_data uses the same dtype as the STG data
+        znp_data["month"] = pd.to_numeric(znp_data["month"], errors='coerce').fillna(0).astype(MONTH_DTYPE)
         
         # Log the unique months in both dataframes for debugging
-        logger.info(f"Months in loaded_batches: {loaded_batches['month'].unique()}")
-        logger.info(f"Months in znp_data: {znp_data['month'].unique()}")
+        if log_debug:
+            logger.debug(f"Months in loaded_batches: {loaded_batches['month'].unique()}")
+            logger.debug(f"Months in znp_data: {znp_data['month'].unique()}")
+        
+        # Join keys are packed into int64 codes from shared dictionaries, so the joins
+        # below compare integers instead of station names and invoice strings
+        encoding = KeyEncoding()
         
         # Merge based on month, stations, and wagon type
-        merge_columns = ["month", "departure_station", "destination_station", "wagon_type"]
-        merged_data = pd.merge(
-            loaded_batches,
-            znp_data,
-            on=merge_columns,
-            how="left"
-        )
+        loaded_keys = pd.DataFrame({
+            "batch_id": loaded_batches["batch_id"].reset_index(drop=True),
+            "route_key": encoding.route_keys(
+                loaded_batches["month"], loaded_batches["departure_station"],
+                loaded_batches["destination_station"], loaded_batches["wagon_type"]
+            ),
+            "invoice_key": encoding.invoice_keys(loaded_batches["invoice_number"])
+        })
+        znp_keys = pd.DataFrame({
+            "route_key": encoding.route_keys(
+                znp_data["month"], znp_data["departure_station"],
+                znp_data["destination_station"], znp_data["wagon_type"]
+            ),
+            "znp": znp_data["znp"].to_numpy()
+        })
+        merged_data = pd.merge(loaded_keys, znp_keys, on="route_key", how="left")
         
         # Get exceptions data
         exceptions_data = get_exceptions()
@@ -235,113 +423,73 @@ class FileProcessor:
             'ExceptionRouteID': 'exception_route_id'
         })
         
-        # Ensure invoice numbers are strings for merging
-        if "invoice_number" in merged_data.columns:
-            merged_data["invoice_number"] = merged_data["invoice_number"].astype(str)
-        if "invoice_number" in exceptions_data.columns:
-            exceptions_data["invoice_number"] = exceptions_data["invoice_number"].astype(str)
-        
         # Merge exceptions
-        exceptions_merged = pd.merge(
-            merged_data,
-            exceptions_data,
-            on="invoice_number",
-            how="left"
-        )
-        
-        # Create Final RouteID (Exceptions > ЗНП)
-        batch_to_znp = exceptions_merged.groupby("batch_id").agg({
-            "exception_route_id": lambda x: next((i for i in x if pd.notna(i)), None),
-            "znp": lambda x: next((i for i in x if pd.notna(i)), None)
-        }).reset_index()
+        exception_keys = pd.DataFrame({
+            "invoice_key": encoding.invoice_keys(exceptions_data.get("invoice_number", pd.Series(dtype=object))),
+            "exception_route_id": exceptions_data.get("exception_route_id", pd.Series(dtype=object)).to_numpy()
+        })
+        exceptions_merged = pd.merge(merged_data, exception_keys, on="invoice_key", how="left")
         
-        # Create Final RouteID column
-        batch_to_znp["final_route_id"] = batch_to_znp.apply(
-            lambda row: row["exception_route_id"] if pd.notna(row["exception_route_id"]) else row["znp"],
-            axis=1
+        # Create Final RouteID (Exceptions > ЗНП) from the first non-null value in each batch
+        batch_to_znp = exceptions_merged.groupby("batch_id")[["exception_route_id", "znp"]].first()
+        final_route_ids = batch_to_znp["exception_route_id"].where(
+            batch_to_znp["exception_route_id"].notna(), batch_to_znp["znp"]
         )
         
-        # Merge final RouteID back to original data
-        final_data = pd.merge(
-            batched_data,
-            batch_to_znp[["batch_id", "final_route_id"]],
-            on="batch_id",
-            how="left"
-        )
+        # Map final RouteID back to the original data
+        final_data = batched_data.reset_index(drop=True)
+        final_data["final_route_id"] = final_data["batch_id"].map(final_route_ids)
         
         # Get overrides data
         overrides_data = get_overrides()
         
         # Log the column names for debugging
-        logger.info(f"Override columns: {overrides_data.columns.tolist()}")
-        logger.info(f"Final data columns: {final_data.columns.tolist()}")
-        
-        # Ensure wagon_number is numeric in both DataFrames
-        if 'wagon_number' in final_data.columns:
-            final_data['wagon_number'] = pd.to_numeric(final_data['wagon_number'], errors='coerce').fillna(0).astype('int64')
-        if 'wagon_number' in overrides_data.columns:
-            overrides_data['wagon_number'] = pd.to_numeric(overrides_data['wagon_number'], errors='coerce').fillna(0).astype('int64')
-        
-        # Ensure invoice_number is string in both DataFrames
-        if 'invoice_number' in final_data.columns:
-            final_data['invoice_number'] = final_data['invoice_number'].astype(str)
-        if 'invoice_number' in overrides_data.columns:
-            overrides_data['invoice_number'] = overrides_data['invoice_number'].astype(str)
-        
-        # Log data types for debugging
-        logger.info(f"Final data types: {final_data.dtypes}")
-        logger.info(f"Overrides data types: {overrides_data.dtypes}")
-        
-        # Merge with overrides
-        merged_with_overrides = pd.merge(
-            final_data,
-            overrides_data,
-            on=['wagon_number', 'invoice_number'],
-            how='left',
-            suffixes=('', '_override')
-        )
+        if log_debug:
+            logger.debug(f"Override columns: {overrides_data.columns.tolist()}")
+            logger.debug(f"Final data columns: {final_data.columns.tolist()}")
+        
+        # Frames from ingestion carry the (wagon, invoice) key; compute it for any other input
+        if 'wn_key' not in final_data.columns:
+            final_data['wn_key'] = get_wn_keys(final_data['wagon_number'], final_data['invoice_number'])
+        
+        # Merge with overrides on the packed (wagon, invoice) key, then expand the rows it matched
+        override_keys = pd.DataFrame({
+            "wn_key": overrides_data.get('wn_key', pd.Series(dtype='int64')).to_numpy(),
+            "znp_code": overrides_data.get('znp_code', pd.Series(dtype=object)).to_numpy()
+        })
+        override_keys = override_keys[override_keys["wn_key"] >= 0]
+        row_keys = pd.DataFrame({
+            "row": np.arange(len(final_data)),
+            "wn_key": final_data['wn_key'].to_numpy()
+        })
+        matched = pd.merge(row_keys, override_keys, on="wn_key", how="left")
+        merged_with_overrides = final_data.take(matched["row"].to_numpy()).reset_index(drop=True)
+        merged_with_overrides['znp_code'] = matched['znp_code'].to_numpy()
         
         # Replace RouteID with Overrides using znp_code
-        merged_with_overrides['updated_final_route_id'] = merged_with_overrides.apply(
-            lambda row: row['znp_code'] if pd.notna(row.get('znp_code')) else row['final_route_id'],
-            axis=1
+        merged_with_overrides['updated_final_route_id'] = merged_with_overrides['znp_code'].where(
+            merged_with_overrides['znp_code'].notna(), merged_with_overrides['final_route_id']
         )
         
         # Log the number of overrides applied
         overrides_applied = merged_with_overrides['znp_code'].notna().sum()
         logger.info(f"Applied {overrides_applied} overrides to route IDs")
         
-        # Propagate RouteID within batches
-        result_data = []
-        for batch_id, batch_df in merged_with_overrides.groupby("batch_id"):
-            if batch_id == 0:  # Skip unassigned batches
-                result_data.append(batch_df)
-                continue
-                
-            # Find the first non-null RouteID in the batch
-            valid_route_ids = batch_df["updated_final_route_id"].dropna()
-            if not valid_route_ids.empty:
-                final_route_id = valid_route_ids.iloc[0]
-                batch_df["propagated_final_route_id"] = final_route_id
-            else:
-                batch_df["propagated_final_route_id"] = None
-                
-            result_data.append(batch_df)
-        
-        # Combine all processed batches
-        result_df = pd.concat(result_data, ignore_index=True)
+        # Propagate RouteID within batches, in batch order; unassigned batches (0) get none
+        result_df = merged_with_overrides[merged_with_overrides["batch_id"].notna()]
+        result_df = result_df.sort_values("batch_id", kind="stable").reset_index(drop=True)
+        propagated = result_df.groupby("batch_id")["updated_final_route_id"].transform("first")
+        result_df["propagated_final_route_id"] = propagated.where(result_df["batch_id"] != 0)
         
         # Log the number of records with propagated route IDs
-        propagated_count = result_df['propagated_final_route_id'].notna().sum()
-        logger.info(f"Total records with propagated route IDs: {propagated_count}")
-        
-        # Create W&N code column
-        result_df["wn_code"] = result_df["wagon_number"].astype(str) + result_df["invoice_number"].astype(str)
+        if log_debug:
+            propagated_count = result_df['propagated_final_route_id'].notna().sum()
+            logger.debug(f"Total records with propagated route IDs: {propagated_count}")
         
         # Clean up and rename
         selected_columns = [
             "month", "propagated_final_route_id", "batch_id", "wagon_number", "invoice_number", 
-            "wn_code", "load_status", "departure_station", "destination_station", 
+            "wn_key", "load_status", "departure_station", "destination_station", 
             "departure_arrival", "report_date", "destination_arrival"
         ]
         final_table = result_df[selected_columns].copy()
@@ -353,7 +501,7 @@ class FileProcessor:
             'batch_id': 'Batch ID',
             'wagon_number': 'Вагон №',
             'invoice_number': 'Накладная №',
-            'wn_code': 'W&N',
+            'wn_key': 'W&N',
             'load_status': 'Груж\\пор',
             'departure_station': 'Ст. отправления',
             'destination_station': 'Ст. назначения',
@@ -368,50 +516,147 @@ class FileProcessor:
         # Check for duplicate Route IDs more thoroughly
         logger.info("Checking for duplicate Route IDs...")
         
-        # First check duplicates by ZNP only
-        znp_duplicates = final_table[final_table.duplicated(subset=["ЗНП"], keep=False)]
-        if not znp_duplicates.empty:
-            logger.warning(f"Found {len(znp_duplicates)} rows where same ZNP is used multiple times")
-            logger.warning("Sample of duplicated ZNPs:")
-            for znp in znp_duplicates["ЗНП"].unique()[:5]:  # Show first 5 examples
-                count = len(znp_duplicates[znp_duplicates["ЗНП"] == znp])
-                logger.warning(f"ZNP {znp} appears {count} times")
-        
-        # Then check complete Route ID duplicates (ZNP + Wagon + Invoice)
-        route_id_duplicates = final_table[final_table.duplicated(subset=["ЗНП", "Вагон №", "Накладная №"], keep=False)]
+        # First check duplicates by ZNP only; a ZNP covers many wagons, so this is diagnostic only
+        if log_debug:
+            znp_counts = final_table["ЗНП"].value_counts(sort=False)
+            znp_counts = znp_counts[znp_counts > 1]
+            if not znp_counts.empty:
+                logger.debug(f"Found {int(znp_counts.sum())} rows where same ZNP is used multiple times")
+                logger.debug("Sample of duplicated ZNPs:")
+                for znp, count in znp_counts.head(5).items():  # Show first 5 examples
+                    logger.debug(f"ZNP {znp} appears {count} times")
+        
+        # Then check complete Route ID duplicates (ZNP + the (wagon, invoice) key)
+        route_id_duplicates = final_table[final_table.duplicated(subset=["ЗНП", "W&N"], keep=False)]
         if not route_id_duplicates.empty:
             logger.warning(f"Found {len(route_id_duplicates)} rows with duplicate complete Route IDs")
             logger.warning("These are cases where same ZNP is used for same wagon and invoice")
             
             # Group duplicates to show examples
-            duplicate_groups = route_id_duplicates.groupby(["ЗНП", "Вагон №", "Накладная №"])
-            logger.warning("Sample of duplicate groups:")
-            for name, group in list(duplicate_groups)[:3]:  # Show first 3 examples
-                znp, wagon, invoice = name
-                logger.warning(f"ZNP: {znp}, Wagon: {wagon}, Invoice: {invoice} appears {len(group)} times")
-                logger.warning(f"Dates: {group['Отчетная дата'].tolist()}")
+            if log_debug:
+                logger.debug("Sample of duplicate groups:")
+                for (znp, _), group in list(route_id_duplicates.groupby(["ЗНП", "W&N"]))[:3]:  # Show first 3 examples
+                    wagon, invoice = group.iloc[0]["Вагон №"], group.iloc[0]["Накладная №"]
+                    logger.debug(f"ZNP: {znp}, Wagon: {wagon}, Invoice: {invoice} appears {len(group)} times")
+                    logger.debug(f"Dates: {group['Отчетная дата'].tolist()}")
             
             # Remove duplicates, keeping the latest entry
             logger.warning("Removing duplicates, keeping the latest entry based on report date")
             final_table = final_table.sort_values("Отчетная дата", ascending=False)
-            final_table = final_table.drop_duplicates(subset=["ЗНП", "Вагон №", "Накладная №"], keep='first')
+            final_table = final_table.drop_duplicates(subset=["ЗНП", "W&N"], keep='first')
             
             # Verify no duplicates remain
-            remaining_duplicates = final_table[final_table.duplicated(subset=["ЗНП", "Вагон №", "Накладная №"], keep=False)]
+            remaining_duplicates = final_table[final_table.duplicated(subset=["ЗНП", "W&N"], keep=False)]
             if remaining_duplicates.empty:
                 logger.info("Successfully removed all duplicates")
             else:
                 logger.error(f"Still found {len(remaining_duplicates)} duplicate rows after cleanup!")
         
         # Add custom route description
-        final_table["Custom"] = final_table["Ст. отправления"] + " - " + final_table["Ст. назначения"]
+        final_table["Custom"] = final_table["Ст. отправления"].astype(str) + " - " + final_table["Ст. назначения"].astype(str)
         
         # Log final statistics
         logger.info(f"Final table contains {len(final_table)} unique Route IDs")
-        logger.info(f"Number of unique ZNPs: {final_table['ЗНП'].nunique()}")
+        if log_debug:
+            logger.debug(f"Number of unique ZNPs: {final_table['ЗНП'].nunique()}")
         
         return final_table
     
+    def update_route_ids(self) -> Dict[str, int]:
+        """
+        Recompute route IDs only for the wagons marked in route_dirty_wagons and
+        upsert the changed rows into wagon_invoices.
+        
+        Wagons are marked when their STG rows or overrides change, or when a ZNP
+        route or exception used by one of their ГРУЖ rows changes; batches never
+        span wagons, so recomputing a marked wagon's batches is exact. Batch IDs
+        follow the whole-history walk: a wagon's batches start after the ГРУЖ rows
+        of all lower wagons, and stored batches of wagons above a wagon whose ГРУЖ
+        count changed are shifted instead of recomputed.
+        wagon_invoices is seeded by a full process_workflow run.
+        """
+        dirty = get_route_dirty_wagons()
+        summary = {'wagons': len(dirty), 'inserted': 0, 'updated': 0, 'deleted': 0, 'shifted': 0}
+        if dirty.empty:
+            logger.info("No wagons marked for route ID recomputation")
+            return summary
+        
+        # Global batch numbering: ГРУЖ rows of all lower wagons come first
+        loaded_counts = get_loaded_counts_by_wagon()
+        loaded_before = loaded_counts.cumsum() - loaded_counts
+        
+        for start in range(0, len(dirty), ROUTE_UPDATE_WAGONS):
+            group = dirty.iloc[start:start + ROUTE_UPDATE_WAGONS]
+            wagons = group["wagon_number"].astype("int64").tolist()
+            
+            history = get_stg_history_for_wagons(wagons)
+            if not history.empty:
+                batched = self.assign_batch_ids(prepare_stg_frame(history), workers=1)
+                
+                # Move each wagon's local numbering to its place in the global walk
+                batch_wagons = pd.Series(batched["wagon_number"].to_numpy(dtype="int64"))
+                is_loaded = pd.Series((batched["load_status"] == "ГРУЖ").to_numpy(dtype="int64"))
+                local_counts = is_loaded.groupby(batch_wagons, sort=True).sum()
+                local_before = local_counts.cumsum() - local_counts
+                offsets = loaded_before.reindex(local_before.index).fillna(0).astype("int64") - local_before
+                shift = batch_wagons.map(offsets).to_numpy()
+                batched["batch_id"] = batched["batch_id"].where(
+                    batched["batch_id"] == 0, batched["batch_id"] + shift
+                )
+                
+                route_ids = self.map_znp_to_batches(batched)
+            else:
+                route_ids = None
+            
+            if route_ids is None or route_ids.empty:
+                changes = sync_wagon_invoices(self._empty_route_ids(), wagons)
+            else:
+                changes = sync_wagon_invoices(route_ids, wagons)
+            for key in ('inserted', 'updated', 'deleted'):
+                summary[key] += changes[key]
+            
+            # Wagons above a recomputed wagon move by the change in its ГРУЖ count
+            deltas = loaded_counts.reindex(wagons).fillna(0).astype("int64").to_numpy() - group["loaded_count"].to_numpy()
+            cumulative = np.cumsum(deltas)
+            bounds = wagons[1:] + [None]
+            summary['shifted'] += shift_wagon_invoice_batches([
+                (low, high, int(total)) for low, high, total in zip(wagons, bounds, cumulative)
+            ])
+            
+            clear_route_dirty_wagons(wagons)
+        
+        logger.info(f"Incremental route ID update: {summary}")
+        return summary
+    
+    def _empty_route_ids(self) -> pd.DataFrame:
+        """Return an empty Route ID table, for wagons left without rows."""
+        return pd.DataFrame(columns=[
+            "Вагон №", "Накладная №", "ЗНП", "Batch ID", "Ст. отправления", "Ст. назначения",
+            "Прибытие на ст. отправл.", "Отчетная дата", "Прибытие на ст. назн.", "Груж\\пор", "W&N"
+        ])
+    
+    def store_route_ids(self, final_data: pd.DataFrame) -> Dict[str, int]:
+        """
+        Store a full Route ID table in wagon_invoices, writing only changed rows,
+        and clear all route recomputation marks it makes current.
+        """
+        summary = sync_wagon_invoices(final_data)
+        clear_route_dirty_wagons()
+        return summary
+    
+    def map_route_ids_in_database(self, chunk_rows: int = 100_000) -> Dict[str, int]:
+        """
+        Compute the Route ID table of the whole stored history inside SQLite:
+        batch IDs are assigned out of core, then the ЗНП, exception and override
+        joins and the propagation within batches run as set-based SQL that writes
+        straight into wagon_invoices. Gives the same table as
+        map_znp_to_batches + store_route_ids without holding the history in memory.
+        """
+        self.assign_history_batch_ids(chunk_rows=chunk_rows)
+        summary = map_route_ids_in_database()
+        clear_route_dirty_wagons()
+        return summary
+    
     def export_route_id_data(self, final_data: pd.DataFrame, output_path: Optional[str] = None) -> str:
         """
         Export the final route ID data to a CSV file.
@@ -427,50 +672,166 @@ class FileProcessor:
         logger.info(f"Route ID data exported to {output_path}")
         return output_path
 
+    def run_stage(self, name: str, inputs: Dict[str, Any], compute: Callable[[], pd.DataFrame],
+                  rows_in: Optional[int] = None,
+                  inputs_after: Optional[Callable[[], Dict[str, Any]]] = None,
+                  cache_if: Optional[Callable[[pd.DataFrame], bool]] = None) -> Tuple[pd.DataFrame, str]:
+        """
+        Run one pipeline stage, or reuse its persisted output.
+        The output is cached under a hash of the stage's declared inputs. A stage
+        that changes one of its own inputs (e.g. the history it writes to) passes
+        inputs_after, and its output is stored under the inputs as they are once
+        it has run, which is what a rerun will see. cache_if can veto storing an
+        output, e.g. a fallback result after an error.
+        Returns the output and its key, which downstream stages declare as an input.
+        """
+        key = stage_key(name, inputs)
+        with self.metrics.stage(name, rows_in=rows_in) as stage:
+            output = self.stage_cache.load(name, key) if self.stage_cache else None
+            if output is not None:
+                logger.info(f"Stage {name}: inputs unchanged, reusing cached output ({len(output)} rows)")
+            else:
+                output = compute()
+                if inputs_after is not None:
+                    key = stage_key(name, inputs_after())
+                if self.stage_cache and (cache_if is None or cache_if(output)):
+                    self.stage_cache.save(name, key, output)
+            stage.rows_out = len(output)
+        return output, key
+    
     def process_workflow(self, stg_folder: str, existing_data_path: str) -> str:
         """
         Run the complete workflow to replace the Power BI process.
+        Each stage is measured; the measurements are stored in the run_metrics table
+        and, when 'export_trace' is set in the config, written as a Chrome trace.
+        
+        The stages declare their inputs: the daily files' content hashes, the
+        history version, the upstream stage's key and the reference table versions.
+        With 'stage_cache' enabled, a rerun skips every stage whose inputs are
+        unchanged, e.g. after a failed ЗНП mapping only the mapping runs again
+        once the reference data is fixed.
         """
         logger.info("Starting workflow processing")
+        self.start_run_metrics()
+        months = self.config.get('history_months')
         
-        # Step 1: Process daily files
-        daily_data = self.process_daily_files(stg_folder)
-        if daily_data.empty:
-            logger.warning("No data found in daily files")
-            return None
+        try:
+            # Step 1: Process daily files
+            daily_files = {path: get_file_hash(path) for path in get_files_by_pattern(stg_folder, "STGDaily_*.xlsx")}
+            daily_data, daily_key = self.run_stage(
+                "process_daily_files", {"files": daily_files},
+                lambda: self.process_daily_files(stg_folder)
+            )
+            if daily_data.empty:
+                logger.warning("No data found in daily files")
+                return None
+                
+            # Step 2: Merge with existing data; the merge itself moves the history version
+            snapshot_path = resolve_history_snapshot(existing_data_path)
+            snapshot_hash = get_file_hash(snapshot_path) if snapshot_path else None
+            def merge_inputs() -> Dict[str, Any]:
+                return {
+                    "daily": daily_key, "existing_data_path": existing_data_path, "months": months,
+                    "snapshot": snapshot_hash, "history_version": get_reference_version('stg_data')
+                }
+            combined_data, merge_key = self.run_stage(
+                "merge_with_existing_data", merge_inputs(),
+                lambda: self.merge_with_existing_data(daily_data, existing_data_path, months=months),
+                rows_in=len(daily_data), inputs_after=merge_inputs,
+                # A failed merge falls back to the daily rows alone, which must not be reused
+                cache_if=lambda output: output is not daily_data
+            )
             
-        # Step 2: Merge with existing data
-        combined_data = self.merge_with_existing_data(daily_data, existing_data_path)
-        
-        # Step 3: Assign batch IDs
-        batched_data = self.assign_batch_ids(combined_data)
-        
-        # Step 4: Map ЗНП to batches
-        final_data = self.map_znp_to_batches(batched_data)
+            # Steps 3-6 in SQL: the merged history is mapped where it is stored
+            if self.config.get('route_mapping') == 'sql':
+                if not months:
+                    return self._process_routes_in_database()
+                logger.warning("SQL route mapping covers the whole history; using pandas for the month range")
+            
+            # Step 3: Assign batch IDs
+            batched_data, batch_key = self.run_stage(
+                "assign_batch_ids", {"history": merge_key},
+                lambda: self.assign_batch_ids(combined_data),
+                rows_in=len(combined_data)
+            )
+            
+            # Step 4: Map ЗНП to batches
+            final_data, _ = self.run_stage(
+                "map_znp_to_batches",
+                {
+                    "batches": batch_key,
+                    "references": {table: get_reference_version(table) for table in ('znp', 'exceptions', 'overrides')}
+                },
+                lambda: self.map_znp_to_batches(batched_data),
+                rows_in=len(batched_data)
+            )
+            
+            # Step 5: Export RouteID data
+            with self.metrics.stage("export_route_id_data", rows_in=len(final_data)) as stage:
+                output_path = self.export_route_id_data(final_data)
+                stage.rows_out = len(final_data)
+            
+            # Step 6: Store the route IDs for incremental updates; a month range covers only part of the history
+            if not months:
+                with self.metrics.stage("store_route_ids", rows_in=len(final_data)) as stage:
+                    self.store_route_ids(final_data)
+                    stage.rows_out = len(final_data)
+            
+            logger.info("Workflow processing completed successfully")
+            return output_path
+        finally:
+            self.save_run_metrics()
+    
+    def _process_routes_in_database(self) -> str:
+        """Assign batches, map route IDs and export them without loading the history."""
+        with self.metrics.stage("map_route_ids_in_database") as stage:
+            summary = self.map_route_ids_in_database()
+            stage.rows_out = summary['total']
         
-        # Step 5: Export RouteID data
-        output_path = self.export_route_id_data(final_data)
+        with self.metrics.stage("export_route_id_data") as stage:
+            final_data = get_route_id_data()
+            output_path = self.export_route_id_data(final_data)
+            stage.rows_in = stage.rows_out = len(final_data)
         
         logger.info("Workflow processing completed successfully")
         return output_path
+    
+    def start_run_metrics(self) -> RunMetrics:
+        """Start collecting stage measurements for a new run."""
+        self.metrics = RunMetrics(trace_memory=self.config.get('profile_memory', False))
+        return self.metrics
+    
+    def save_run_metrics(self) -> None:
+        """Persist the current run's stage measurements and optionally export a trace."""
+        if not self.metrics.records:
+            return
+        
+        try:
+            add_run_metrics(self.metrics.run_id, self.metrics.summary())
+        except Exception as e:
+            logger.warning(f"Could not save run metrics: {str(e)}")
+        
+        if self.config.get('export_trace', False):
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            trace_path = os.path.join(self.output_dir, f"Trace_{timestamp}.json")
+            self.metrics.export_chrome_trace(trace_path)
+
+    def export_history(self, existing_data_path: str, output_path: Optional[str] = None) -> str:
+        """Save the STG history to the history snapshot and export the snapshot to an STG workbook."""
+        if not existing_data_path:
+            raise ValueError("No existing data path configured for the history snapshot")
+        snapshot_path = self.save_history_snapshot(existing_data_path)
+        
+        if output_path is None:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            output_path = os.path.join(self.output_dir, f"STGHistory_{timestamp}.xlsx")
+        
+        return export_history_workbook(snapshot_path, output_path)
 
     def generate_route_suggestions(self, stg_folder: str) -> List[Dict]:
         """Generate route suggestions from STG files."""
         all_data = []
         
-        # Get existing ZNP data
-        znp_data = get_znp_data()
-        znp_lookup = {}
-        if not znp_data.empty:
-            for _, row in znp_data.iterrows():
-                key = (
-                    int(row["Месяц"]),
-                    str(row["Ст. отправления"]),
-                    str(row["Ст. назначения"]),
-                    str(row["Тип вагона"]) if pd.notna(row["Тип вагона"]) else ""
-                )
-                znp_lookup[key] = str(row["ЗНП"])
-        
         # Process all STG files
         stg_files = get_files_by_pattern(stg_folder, "STGDaily_*.xlsx")
         for file_path in stg_files:
@@ -519,18 +880,9 @@ class FileProcessor:
         # Sort by station names
         grouped = grouped.sort_values(["Ст. отправления", "Ст. назначения"])
         
-        # Add ZNP values from lookup
-        result = []
-        for _, row in grouped.iterrows():
-            key = (
-                int(row["Месяц"]),
-                str(row["Ст. отправления"]),
-                str(row["Ст. назначения"]),
-                str(row["Тип вагона"]) if pd.notna(row["Тип вагона"]) else ""
-            )
-            route_dict = row.to_dict()
-            route_dict["ЗНП"] = znp_lookup.get(key, "")  # Add existing ZNP value if found
-            result.append(route_dict)
+        # Add existing ZNP values with one merge on the normalized route key
+        grouped["ЗНП"] = lookup_znp_codes(grouped)
+        result = grouped.to_dict('records')
         
         return result
 
@@ -0,0 +1,131 @@
+import os
+import logging
+import pandas as pd
+from datetime import datetime
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from app.database.analytics import get_query_engine
+from app.utils.stg_schema import STG_COLUMN_MAPPING, prepare_stg_frame
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_EXTENSION = '.parquet'
+
+# Columns kept in the snapshot: the STG fields plus the derived report month
+SNAPSHOT_COLUMNS = list(STG_COLUMN_MAPPING.values()) + ['month']
+
+# Report month range ((first year, first month), (last year, last month)), both inclusive
+MonthRange = Tuple[Tuple[int, int], Tuple[int, int]]
+
+def resolve_month_range(months: Optional[Sequence], partitions: Iterable[Tuple[int, int]]) -> Optional[MonthRange]:
+    """
+    Return the history_months setting as (year, month) bounds.
+    The setting is [[first year, first month], [last year, last month]] or, as in
+    older configurations, [first month, last month]; plain months are taken from
+    the latest year among the (year, month) partitions that has one of them
+    (the current year if none has).
+    """
+    if not months:
+        return None
+    
+    first, last = months
+    if isinstance(first, (list, tuple)):
+        return (int(first[0]), int(first[1])), (int(last[0]), int(last[1]))
+    
+    first, last = int(first), int(last)
+    if first > last:
+        raise ValueError(f"history_months [{first}, {last}] crosses a year end; use [year, month] bounds")
+    years = [year for year, month in partitions if first <= month <= last]
+    year = max(years) if years else datetime.now().year
+    return (year, first), (year, last)
+
+def month_range_dates(month_range: MonthRange) -> Tuple[datetime, datetime]:
+    """Return the report dates [start, end) covered by a month range."""
+    (first_year, first_month), (last_year, last_month) = month_range
+    end_year, end_month = (last_year + 1, 1) if last_month == 12 else (last_year, last_month + 1)
+    return datetime(first_year, first_month, 1), datetime(end_year, end_month, 1)
+
+def is_history_snapshot(path: str) -> bool:
+    """Return True if the path points to a columnar history snapshot."""
+    return bool(path) and path.lower().endswith(SNAPSHOT_EXTENSION)
+
+def default_snapshot_path(workbook_path: str) -> str:
+    """Return the snapshot path used for a history workbook (same name, .parquet)."""
+    return os.path.splitext(workbook_path)[0] + SNAPSHOT_EXTENSION
+
+def write_history_snapshot(df: pd.DataFrame, snapshot_path: str) -> str:
+    """
+    Write a prepared STG frame to the snapshot file.
+    Categorical and nullable columns keep their dtypes in the file.
+    """
+    columns = [col for col in SNAPSHOT_COLUMNS if col in df.columns]
+    tmp_path = snapshot_path + '.tmp'
+    df[columns].to_parquet(tmp_path, index=False)
+    # Replace the old snapshot only once the new one is complete
+    os.replace(tmp_path, snapshot_path)
+
+    logger.info(f"Wrote {len(df)} rows to history snapshot {snapshot_path}")
+    return snapshot_path
+
+def read_history_snapshot(snapshot_path: str, columns: Optional[List[str]] = None,
+                          months: Optional[MonthRange] = None) -> pd.DataFrame:
+    """
+    Read the history snapshot.
+    Only the requested columns are read, and a month range skips row groups
+    whose report dates fall outside it. With the DuckDB query engine the
+    snapshot is scanned by DuckDB; text columns then come back as plain strings.
+    """
+    report_dates = month_range_dates(months) if months else None
+    
+    engine = get_query_engine()
+    if engine is not None:
+        return engine.read_parquet(snapshot_path, columns=columns, report_dates=report_dates)
+
+    filters = None
+    if report_dates:
+        start, end = report_dates
+        filters = [('report_date', '>=', pd.Timestamp(start)), ('report_date', '<', pd.Timestamp(end))]
+
+    return pd.read_parquet(snapshot_path, columns=columns, filters=filters)
+
+def import_history_workbook(workbook_path: str, snapshot_path: Optional[str] = None) -> str:
+    """
+    Convert an STG history workbook into a snapshot.
+    Rows are deduplicated on (wagon, invoice), keeping the latest report date.
+    """
+    snapshot_path = snapshot_path or default_snapshot_path(workbook_path)
+    logger.info(f"Importing history workbook {workbook_path}")
+
+    history = prepare_stg_frame(pd.read_excel(workbook_path))
+    history = history.dropna(subset=["wagon_number", "invoice_number", "report_date"])
+    history = history.sort_values("report_date", kind="mergesort")
+    history = history.drop_duplicates(subset=["wagon_number", "invoice_number"], keep='last')
+
+    return write_history_snapshot(history, snapshot_path)
+
+def export_history_workbook(snapshot_path: str, output_path: str) -> str:
+    """Write the snapshot back out as an STG workbook with the original column names."""
+    history = read_history_snapshot(snapshot_path, columns=list(STG_COLUMN_MAPPING.values()))
+    history = history.rename(columns={v: k for k, v in STG_COLUMN_MAPPING.items()})
+    history.to_excel(output_path, index=False)
+
+    logger.info(f"History snapshot exported to {output_path}")
+    return output_path
+
+def resolve_history_snapshot(existing_data_path: str) -> Optional[str]:
+    """
+    Return the snapshot for the configured existing data path.
+    A workbook path is imported into a snapshot next to it the first time it is used.
+    """
+    if not existing_data_path:
+        return None
+
+    if is_history_snapshot(existing_data_path):
+        return existing_data_path if os.path.exists(existing_data_path) else None
+
+    snapshot_path = default_snapshot_path(existing_data_path)
+    if os.path.exists(snapshot_path):
+        return snapshot_path
+    if os.path.exists(existing_data_path):
+        return import_history_workbook(existing_data_path, snapshot_path)
+    return None
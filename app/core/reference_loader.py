@@ -0,0 +1,125 @@
+import os
+import time
+import logging
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Any, Callable, Iterator, Optional, Tuple
+
+from app.database.operations import (
+    add_znp_data, add_exceptions, add_overrides, add_active_routes, add_matrix_mappings,
+    is_reference_unchanged, get_reference_version
+)
+from app.utils.file_utils import get_file_hash
+
+logger = logging.getLogger(__name__)
+
+# Reference file types in the order they are written to the database
+REFERENCE_FILE_TYPES = ["znp", "exceptions", "overrides", "active", "matrix"]
+
+# Table written by each reference file type, as recorded in reference_versions
+REFERENCE_TABLES = {
+    "znp": "znp",
+    "exceptions": "exceptions",
+    "overrides": "overrides",
+    "active": "active_routes",
+    "matrix": "matrix_mappings"
+}
+
+# Database writer for each reference file type
+REFERENCE_WRITERS: Dict[str, Callable[..., Any]] = {
+    "znp": add_znp_data,
+    "exceptions": add_exceptions,
+    "overrides": add_overrides,
+    "active": add_active_routes,
+    "matrix": add_matrix_mappings
+}
+
+def parse_reference_file(file_type: str, file_path: str) -> Dict[str, Any]:
+    """
+    Read one reference file into the form its database writer expects.
+    Runs in a worker process, so it only reads the file and touches no shared state.
+    """
+    start = time.perf_counter()
+
+    if file_type in ("znp", "exceptions", "overrides"):
+        data = pd.read_excel(file_path)
+        rows = len(data)
+    elif file_type == "active":
+        df = pd.read_csv(file_path)
+        data = df.iloc[:, 0].astype(str).tolist()
+        rows = len(data)
+    elif file_type == "matrix":
+        data = pd.read_csv(file_path)
+        rows = len(data)
+    else:
+        raise ValueError(f"Unknown reference file type: {file_type}")
+
+    return {
+        "file_type": file_type,
+        "file_path": file_path,
+        "data": data,
+        "rows": rows,
+        "parse_seconds": time.perf_counter() - start
+    }
+
+def parse_reference_files(files: Dict[str, str], max_workers: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Parse the given reference files concurrently in worker processes.
+    Yields one result per file as it finishes; a file that fails to parse
+    yields a result with an 'error' entry instead of data.
+    """
+    files = {file_type: path for file_type, path in files.items() if path}
+    if not files:
+        return
+
+    workers = max_workers or min(len(files), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(parse_reference_file, file_type, path): file_type
+            for file_type, path in files.items()
+        }
+        for future in as_completed(futures):
+            file_type = futures[future]
+            try:
+                yield future.result()
+            except Exception as e:
+                logger.error(f"Error parsing {file_type}: {str(e)}")
+                yield {"file_type": file_type, "file_path": files[file_type], "error": str(e)}
+
+def find_changed_files(files: Dict[str, str]) -> Tuple[Dict[str, str], Dict[str, int]]:
+    """
+    Hash the given reference files and compare them with the last import.
+    Returns the content hash of each file that needs importing, and the current
+    table version of each file that is unchanged and can be skipped.
+    """
+    changed = {}
+    unchanged = {}
+    for file_type, file_path in files.items():
+        if not file_path:
+            continue
+        content_hash = get_file_hash(file_path)
+        table_name = REFERENCE_TABLES[file_type]
+        if is_reference_unchanged(table_name, content_hash):
+            unchanged[file_type] = get_reference_version(table_name)
+        else:
+            changed[file_type] = content_hash
+    return changed, unchanged
+
+def write_reference_data(file_type: str, data: Any, source_path: Optional[str] = None,
+                         content_hash: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Write parsed reference data to its table in one transaction and time it.
+    'changes' holds the writer's insert/update/delete summary.
+    """
+    start = time.perf_counter()
+    changes = REFERENCE_WRITERS[file_type](data, source_path=source_path, content_hash=content_hash)
+    return {
+        "count": changes["total"],
+        "changes": changes,
+        "version": get_reference_version(REFERENCE_TABLES[file_type]),
+        "write_seconds": time.perf_counter() - start
+    }
+
+def rows_per_second(rows: int, seconds: float) -> float:
+    """Return a throughput figure, guarding against zero durations."""
+    return rows / seconds if seconds > 0 else float(rows)
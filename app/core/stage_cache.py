@@ -0,0 +1,63 @@
+import os
+import json
+import glob
+import hashlib
+import logging
+import pandas as pd
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CACHE_EXTENSION = '.parquet'
+
+def stage_key(stage: str, inputs: Dict[str, Any]) -> str:
+    """
+    Return the cache key of a stage run: a hash of the stage name and its declared
+    inputs (file hashes, upstream stage keys, table versions, settings).
+    """
+    payload = json.dumps({'stage': stage, 'inputs': inputs}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class StageCache:
+    """
+    Persisted outputs of pipeline stages, one Parquet file per stage and key.
+    Only the latest output of each stage is kept, which is all a rerun needs.
+    Categorical and nullable columns keep their dtypes in the files.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, stage: str, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{stage}_{key[:16]}{CACHE_EXTENSION}")
+
+    def load(self, stage: str, key: str) -> Optional[pd.DataFrame]:
+        """Return the cached output of a stage for a key, or None if there is none."""
+        path = self._path(stage, key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            return pd.read_parquet(path)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cache entry {path}: {str(e)}")
+            return None
+
+    def save(self, stage: str, key: str, df: pd.DataFrame) -> str:
+        """Store a stage output under its key, replacing the stage's previous output."""
+        path = self._path(stage, key)
+        tmp_path = path + '.tmp'
+        df.to_parquet(tmp_path, index=False)
+        # Only a complete file becomes visible under the key
+        os.replace(tmp_path, path)
+
+        for old_path in glob.glob(os.path.join(self.cache_dir, f"{stage}_{'?' * 16}{CACHE_EXTENSION}")):
+            if old_path != path:
+                os.remove(old_path)
+        return path
+
+    def clear(self) -> None:
+        """Remove all cached stage outputs."""
+        for path in glob.glob(os.path.join(self.cache_dir, f"*{CACHE_EXTENSION}")):
+            os.remove(path)
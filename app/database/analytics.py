@@ -0,0 +1,141 @@
+import os
+import sys
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+import pandas as pd
+
+try:
+    import duckdb
+except ImportError:  # the DuckDB query engine is optional
+    duckdb = None
+
+logger = logging.getLogger(__name__)
+
+QUERY_ENGINES = ('sqlite', 'duckdb')
+
+# Name the SQLite database is attached under
+STORE = 'store'
+
+# DuckDB extensions shipped with the application (build.bat installs the sqlite
+# extension here); in the frozen executable they are unpacked next to the app code
+EXTENSION_DIRECTORY = os.path.join(
+    getattr(sys, '_MEIPASS', os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))),
+    'extensions'
+)
+
+class DuckDBEngine:
+    """
+    Embedded columnar engine for history-scale scans, joins and aggregations.
+    The SQLite database file is attached read-only and Parquet snapshots are
+    read in place, so nothing is copied and no server is needed. Queries see
+    what is committed to SQLite when they start; all writes stay on SQLAlchemy.
+    """
+
+    def __init__(self, db_path: str):
+        if duckdb is None:
+            raise RuntimeError("DuckDB is not installed")
+
+        self.db_path = os.path.realpath(db_path)
+        self._lock = threading.Lock()
+        self._conn = duckdb.connect()
+        try:
+            self._load_sqlite_extension()
+            self._conn.execute(f"ATTACH '{_quote(self.db_path)}' AS {STORE} (TYPE sqlite, READ_ONLY)")
+        except Exception:
+            self._conn.close()
+            raise
+
+    def _load_sqlite_extension(self) -> None:
+        """
+        Load the SQLite scanner from the bundled extensions when present, otherwise
+        from DuckDB's extension directory, installing it there on first use
+        (which needs network access).
+        """
+        if os.path.isdir(EXTENSION_DIRECTORY):
+            self._conn.execute(f"SET extension_directory = '{_quote(EXTENSION_DIRECTORY)}'")
+        try:
+            self._conn.execute("LOAD sqlite")
+        except duckdb.Error:
+            self._conn.execute("INSTALL sqlite")
+            self._conn.execute("LOAD sqlite")
+
+    def reads(self, db_path: str) -> bool:
+        """Return True if this engine reads the given SQLite database file."""
+        return bool(db_path) and os.path.realpath(db_path) == self.db_path
+
+    def query(self, sql: str, params: Optional[Sequence[Any]] = None) -> pd.DataFrame:
+        """Run a query and return the result as a DataFrame."""
+        with self._lock:
+            return self._conn.execute(sql, params or []).df()
+
+    def table(self, name: str) -> str:
+        """Return the reference to a table of the attached SQLite database."""
+        return f"{STORE}.{name}"
+
+    def read_parquet(self, path: str, columns: Optional[List[str]] = None,
+                     report_dates: Optional[Tuple[datetime, datetime]] = None) -> pd.DataFrame:
+        """
+        Read a Parquet snapshot, only the given columns and, with
+        report_dates=(start, end), only the rows reported in [start, end).
+        """
+        select = ", ".join(f'"{column}"' for column in columns) if columns else "*"
+        sql = f"SELECT {select} FROM read_parquet(?)"
+        params: List[Any] = [path]
+        if report_dates:
+            sql += " WHERE report_date >= ? AND report_date < ?"
+            params.extend(report_dates)
+        return self.query(sql, params)
+
+    def close(self) -> None:
+        """Close the DuckDB connection and detach the database."""
+        with self._lock:
+            self._conn.close()
+
+def _quote(value: str) -> str:
+    return value.replace("'", "''")
+
+def partition_join(partitions: Iterable[Tuple[int, int]], alias: str = "s") -> str:
+    """
+    Return a JOIN clause restricting the rows of alias to the given (year, month)
+    partitions; at least one partition must be given.
+    """
+    values = ", ".join(f"({int(year)}, {int(month)})" for year, month in partitions)
+    return f"JOIN (VALUES {values}) p(year, month) ON p.year = {alias}.year AND p.month = {alias}.month"
+
+# Engine shared by every reader in the process; None runs everything on SQLite
+_engine: Optional[DuckDBEngine] = None
+
+def init_query_engine(name: str, db_path: str) -> Optional[DuckDBEngine]:
+    """
+    Select the engine for scans and aggregations: 'sqlite' (the default) or 'duckdb'.
+    When DuckDB is not installed or cannot attach the database, the queries
+    stay on SQLite and a warning is logged. Returns the DuckDB engine, if any.
+    """
+    global _engine
+
+    if name not in QUERY_ENGINES:
+        raise ValueError(f"Unknown query engine '{name}', expected one of {QUERY_ENGINES}")
+
+    close_query_engine()
+    if name == 'duckdb':
+        try:
+            _engine = DuckDBEngine(db_path)
+            logger.info(f"Using DuckDB for history queries on {db_path}")
+        except Exception as e:
+            logger.warning(f"DuckDB query engine unavailable, using SQLite: {str(e)}")
+    return _engine
+
+def get_query_engine() -> Optional[DuckDBEngine]:
+    """Return the DuckDB engine, or None when queries run on SQLite."""
+    return _engine
+
+def close_query_engine() -> None:
+    """Close the DuckDB engine, if one is open."""
+    global _engine
+
+    if _engine is not None:
+        _engine.close()
+        _engine = None
@@ -0,0 +1,96 @@
+import time
+import queue
+import logging
+import threading
+from datetime import datetime
+from typing import Optional
+
+from app.database.models import ProcessingLog
+
+logger = logging.getLogger(__name__)
+
+# Queue item standing for "flush_interval has passed"
+_FLUSH_DUE = object()
+
+class AuditLogWriter:
+    """
+    Buffered writer for processing_logs entries.
+    Entries are queued by the caller and inserted by a background thread in one
+    transaction per batch: once batch_size entries are waiting, flush_interval
+    seconds after the oldest waiting entry, on flush() and at stop(). The batches
+    use their own connection, so a failed log insert never rolls back other work.
+    """
+
+    def __init__(self, engine, batch_size: int = 200, flush_interval: float = 2.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._engine = engine
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="audit-log-writer", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def write(self, operation: str, status: str, file_name: Optional[str] = None,
+              message: Optional[str] = None) -> None:
+        """Queue a log entry; it is stamped with the current time."""
+        self._queue.put({
+            'timestamp': datetime.now(),
+            'operation': operation,
+            'status': status,
+            'file_name': file_name,
+            'message': message
+        })
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Write the queued entries now and wait up to timeout seconds until they are
+        stored. Returns False when they were not stored in time or the thread has stopped.
+        """
+        if not self._thread.is_alive():
+            logger.warning("Audit log writer is not running; queued log entries were not written")
+            return False
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Write the queued entries, then stop the thread."""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        pending = []
+        deadline = None
+        while True:
+            wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=wait)
+            except queue.Empty:
+                item = _FLUSH_DUE
+
+            if isinstance(item, dict):
+                pending.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(pending) < self.batch_size:
+                    continue
+
+            # Size or time threshold reached, flush requested or shutting down
+            self._insert(pending)
+            pending = []
+            deadline = None
+
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
+
+    def _insert(self, entries) -> None:
+        if not entries:
+            return
+        try:
+            with self._engine.begin() as conn:
+                conn.execute(ProcessingLog.__table__.insert(), entries)
+        except Exception as e:
+            logger.error(f"Error writing {len(entries)} processing log entries: {str(e)}")
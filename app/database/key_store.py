@@ -0,0 +1,57 @@
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import bindparam, text
+
+from app.utils.key_encoding import (
+    MISSING_CODE, normalize_invoice_numbers, normalize_wagon_numbers, pack_wn_keys
+)
+
+# Bound parameters per IN (...) lookup, well under SQLite's variable limit
+LOOKUP_CHUNK_SIZE = 5000
+
+_SELECT_INVOICE_IDS = text(
+    "SELECT invoice_number, id FROM invoice_keys WHERE invoice_number IN :values"
+).bindparams(bindparam("values", expanding=True))
+
+_INSERT_INVOICE = text("INSERT OR IGNORE INTO invoice_keys (invoice_number) VALUES (:invoice_number)")
+
+def _fetch_invoice_ids(connection, invoices: List[str]) -> Dict[str, int]:
+    """Return the dictionary ID of each given invoice that is already registered."""
+    ids = {}
+    for start in range(0, len(invoices), LOOKUP_CHUNK_SIZE):
+        chunk = invoices[start:start + LOOKUP_CHUNK_SIZE]
+        ids.update(connection.execute(_SELECT_INVOICE_IDS, {"values": chunk}).all())
+    return ids
+
+def invoice_ids(connection, invoice_numbers, add: bool = True) -> np.ndarray:
+    """
+    Return the invoice dictionary ID of each invoice number as int64.
+    Numbers are normalized first, so 12345678, 12345678.0 and '12345678' share an ID.
+    With add=True unseen invoices are registered in the caller's transaction;
+    otherwise they, like missing values, get MISSING_CODE.
+    """
+    codes, uniques = pd.factorize(normalize_invoice_numbers(invoice_numbers), use_na_sentinel=True)
+    uniques = [str(value) for value in uniques]
+
+    ids = _fetch_invoice_ids(connection, uniques)
+    unseen = [value for value in uniques if value not in ids]
+    if add and unseen:
+        connection.execute(_INSERT_INVOICE, [{"invoice_number": value} for value in unseen])
+        ids.update(_fetch_invoice_ids(connection, unseen))
+
+    if not uniques:
+        return np.full(len(codes), MISSING_CODE, dtype=np.int64)
+    unique_ids = np.array([ids.get(value, MISSING_CODE) for value in uniques], dtype=np.int64)
+    return np.where(codes >= 0, unique_ids[codes], MISSING_CODE)
+
+def wn_keys(connection, wagon_numbers, invoice_numbers, add: bool = True) -> np.ndarray:
+    """
+    Return the packed int64 (wagon, invoice) key of each row.
+    Rows without a whole wagon number or an invoice get MISSING_CODE.
+    """
+    return pack_wn_keys(
+        normalize_wagon_numbers(wagon_numbers),
+        invoice_ids(connection, invoice_numbers, add=add)
+    )
@@ -1,8 +1,10 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, create_engine
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Index, create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 import datetime
 
+from app.database.key_store import wn_keys
+
 Base = declarative_base()
 
 class ZNP(Base):
@@ -11,6 +13,9 @@ class ZNP(Base):
     Replaces your ЗНП.xlsx file.
     """
     __tablename__ = 'znp'
+    __table_args__ = (
+        Index('ix_znp_route', 'month', 'departure_station', 'destination_station', 'wagon_type'),
+    )
     
     id = Column(Integer, primary_key=True)
     month = Column(Integer, nullable=False)
@@ -48,6 +53,7 @@ class Override(Base):
     wagon_number = Column(String, nullable=False)
     invoice_number = Column(String, nullable=False)
     znp_code = Column(String, nullable=False)
+    wn_key = Column(Integer, nullable=True, index=True)  # Packed (wagon, invoice) key
     
     def __repr__(self):
         return f"<Override(id={self.id}, wagon={self.wagon_number}, invoice='{self.invoice_number}')>"
@@ -83,9 +89,12 @@ class MatrixMapping(Base):
 class WagonInvoice(Base):
     """
     Model for processed wagon-invoice combinations.
-    Stores the final output of the processing.
+    Stores the final output of the processing, one row per (wagon, invoice) key.
     """
     __tablename__ = 'wagon_invoices'
+    __table_args__ = (
+        Index('ix_wagon_invoices_wn_key', 'wn_key', unique=True),
+    )
     
     id = Column(Integer, primary_key=True)
     wagon_number = Column(Integer, nullable=False, index=True)
@@ -99,6 +108,7 @@ class WagonInvoice(Base):
     arrival_date = Column(DateTime, nullable=True)
     status = Column(String, nullable=False)  # "ГРУЖ" or "ПОР"
     wagon_type = Column(String, nullable=False)
+    wn_key = Column(Integer, nullable=True)  # Packed (wagon, invoice) key
     
     def __repr__(self):
         return f"<WagonInvoice(id={self.id}, wagon={self.wagon_number}, invoice='{self.invoice_number}')>"
@@ -108,6 +118,11 @@ class ProcessingLog(Base):
     Model for tracking processing activities.
     """
     __tablename__ = 'processing_logs'
+    __table_args__ = (
+        # The logs view pages newest first, optionally for one operation or status
+        Index('ix_processing_logs_operation', 'operation', 'id'),
+        Index('ix_processing_logs_status', 'status', 'id'),
+    )
     
     id = Column(Integer, primary_key=True)
     timestamp = Column(DateTime, default=datetime.datetime.now)
@@ -119,9 +134,78 @@ class ProcessingLog(Base):
     def __repr__(self):
         return f"<ProcessingLog(id={self.id}, operation='{self.operation}', status='{self.status}')>"
 
+class RunMetric(Base):
+    """
+    Model for per-stage timing and memory measurements of pipeline runs.
+    """
+    __tablename__ = 'run_metrics'
+    
+    id = Column(Integer, primary_key=True)
+    run_id = Column(String, nullable=False, index=True)
+    stage = Column(String, nullable=False)
+    file_name = Column(String, nullable=True)
+    depth = Column(Integer, nullable=False, default=0)
+    started_at = Column(DateTime, nullable=True)
+    wall_seconds = Column(Float, nullable=True)
+    cpu_seconds = Column(Float, nullable=True)
+    rows_in = Column(Integer, nullable=True)
+    rows_out = Column(Integer, nullable=True)
+    peak_memory_bytes = Column(Integer, nullable=True)
+    rss_bytes = Column(Integer, nullable=True)
+    
+    def __repr__(self):
+        return f"<RunMetric(run={self.run_id}, stage='{self.stage}', wall={self.wall_seconds})>"
+
+class ReferenceVersion(Base):
+    """
+    Model for the current version of each reference table.
+    The version goes up on every change to the table; the source file hash lets
+    an unchanged file be skipped on re-import.
+    """
+    __tablename__ = 'reference_versions'
+    
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String, nullable=False, unique=True)
+    version = Column(Integer, nullable=False, default=0)
+    source_path = Column(String, nullable=True)
+    content_hash = Column(String, nullable=True)
+    row_count = Column(Integer, nullable=True)
+    imported_at = Column(DateTime, default=datetime.datetime.now)
+    
+    def __repr__(self):
+        return f"<ReferenceVersion(table='{self.table_name}', version={self.version})>"
+
+class InvoiceKey(Base):
+    """
+    Model for the invoice dictionary.
+    Gives every normalized invoice number a stable integer ID; the ID forms the
+    low half of the packed (wagon, invoice) key, see app.database.key_store.
+    """
+    __tablename__ = 'invoice_keys'
+    
+    id = Column(Integer, primary_key=True)
+    invoice_number = Column(String, nullable=False, unique=True)
+    
+    def __repr__(self):
+        return f"<InvoiceKey(id={self.id}, invoice='{self.invoice_number}')>"
+
 class STGData(Base):
-    """Model for storing STG file data."""
+    """
+    Model for storing STG file data.
+    Holds the STG history; each (wagon, invoice) key is stored once. Rows are
+    partitioned by report (year, month): readers select partitions through the
+    partition index and loads replace only the partitions they contain.
+    """
     __tablename__ = 'stg_data'
+    __table_args__ = (
+        Index('ix_stg_data_wn_key', 'wn_key', unique=True),
+        # Month first, so filters on the month alone can use it too
+        Index('ix_stg_data_partition', 'month', 'year'),
+        # Serves the (wagon, report date) order of the out-of-core batch walk
+        Index('ix_stg_data_wagon_date', 'wagon_number', 'report_date'),
+        # Counts a wagon's ГРУЖ rows, which fix where its batch numbers start
+        Index('ix_stg_data_loaded_wagon', 'wagon_number', sqlite_where=text("load_status = 'ГРУЖ'")),
+    )
     
     id = Column(Integer, primary_key=True)
     wagon_number = Column(Integer, nullable=True)
@@ -138,18 +222,354 @@ class STGData(Base):
     shipper = Column(String, nullable=True)
     consignee = Column(String, nullable=True)
     repair_wait_time = Column(Float, nullable=True)
-    wn_code = Column(String, nullable=True)  # W&N
+    wn_key = Column(Integer, nullable=True)  # W&N: packed (wagon, invoice) key
     batch_id = Column(Integer, nullable=True)
     month = Column(Integer, nullable=True)
+    year = Column(Integer, nullable=True)
     route_id = Column(String, nullable=True)
     
     def __repr__(self):
         return f"<STGData(wagon={self.wagon_number}, route={self.route_id})>"
 
+class STGFile(Base):
+    """
+    Model for the STG files already applied to the STG history.
+    A file whose content hash is recorded here is not upserted again.
+    """
+    __tablename__ = 'stg_files'
+    
+    id = Column(Integer, primary_key=True)
+    file_path = Column(String, nullable=False)
+    content_hash = Column(String, nullable=False, unique=True)
+    row_count = Column(Integer, nullable=True)
+    ingested_at = Column(DateTime, default=datetime.datetime.now)
+    
+    def __repr__(self):
+        return f"<STGFile(path='{self.file_path}', rows={self.row_count})>"
+
+class RouteCount(Base):
+    """
+    Model for the number of loaded wagons per route and report (year, month) in
+    the STG history. Kept up to date by triggers on stg_data (see
+    ensure_route_counts), so the ZNP Routes tab can read route counts without
+    regrouping the raw rows.
+    Missing key values are stored as 0 / '' so they group like any other value.
+    """
+    __tablename__ = 'route_counts'
+    __table_args__ = (
+        Index('ix_route_counts_route', 'year', 'month', 'departure_station', 'destination_station',
+              'wagon_type', unique=True),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    departure_station = Column(String, nullable=False)
+    destination_station = Column(String, nullable=False)
+    wagon_type = Column(String, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f"<RouteCount({self.year}-{self.month}, {self.departure_station}-{self.destination_station}, count={self.count})>"
+
+class RouteDirtyWagon(Base):
+    """
+    Model for wagons whose route IDs must be recomputed.
+    Wagons are marked when their STG rows, their overrides or the ZNP routes and
+    exceptions their loaded rows use change (see ensure_route_dirty_tracking).
+    loaded_count is the wagon's number of ГРУЖ rows when it was first marked,
+    i.e. when its stored route IDs were last current.
+    """
+    __tablename__ = 'route_dirty_wagons'
+    
+    wagon_number = Column(Integer, primary_key=True)
+    loaded_count = Column(Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f"<RouteDirtyWagon(wagon={self.wagon_number}, loaded={self.loaded_count})>"
+
 # Database initialization function
 def init_db(db_path):
     """Initialize the database and create tables."""
-    engine = create_engine(f'sqlite:///{db_path}')
+    # Threads share the engine with a session each; a connection waits up to
+    # 30s for another's write lock instead of failing with "database is locked"
+    engine = create_engine(f'sqlite:///{db_path}', connect_args={"timeout": 30})
+    # WAL lets readers keep using the last committed data while a write is in progress
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA journal_mode=WAL")
     Base.metadata.create_all(engine)
+    ensure_wn_keys(engine)
+    ensure_stg_history_index(engine)
+    ensure_stg_partitions(engine)
+    ensure_stg_wagon_index(engine)
+    ensure_znp_route_index(engine)
+    ensure_processing_log_indexes(engine)
+    ensure_route_counts(engine)
+    ensure_route_dirty_tracking(engine)
     SessionMaker = sessionmaker(bind=engine)
-    return engine, SessionMaker
\ No newline at end of file
+    return engine, SessionMaker
+
+# Tables that carry the packed (wagon, invoice) key
+WN_KEY_TABLES = ['stg_data', 'overrides', 'wagon_invoices']
+
+def ensure_wn_keys(engine):
+    """
+    Add the packed (wagon, invoice) key to tables created by an older version
+    and fill it in for rows stored without one.
+    """
+    with engine.begin() as conn:
+        for table_name in WN_KEY_TABLES:
+            columns = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table_name})"))}
+            if 'wn_key' not in columns:
+                conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN wn_key INTEGER"))
+            
+            rows = conn.execute(text(
+                f"SELECT id, wagon_number, invoice_number FROM {table_name} "
+                "WHERE wn_key IS NULL AND wagon_number IS NOT NULL AND invoice_number IS NOT NULL"
+            )).all()
+            if rows:
+                ids, wagons, invoices = zip(*rows)
+                keys = wn_keys(conn, list(wagons), list(invoices))
+                conn.execute(
+                    text(f"UPDATE {table_name} SET wn_key = :wn_key WHERE id = :id"),
+                    [{"wn_key": int(key), "id": row_id} for row_id, key in zip(ids, keys) if key >= 0]
+                )
+            
+            if table_name != 'stg_data':
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table_name}_wn_key ON {table_name} (wn_key)"))
+
+def ensure_stg_history_index(engine):
+    """
+    Add the unique (wagon, invoice) key index to an stg_data table created by an older version.
+    Rows sharing a key are removed first, keeping the one with the latest report date;
+    the key replaces the older index on the raw (wagon, invoice) columns.
+    """
+    with engine.begin() as conn:
+        exists = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ix_stg_data_wn_key'"
+        )).first()
+        if exists:
+            return
+        
+        conn.execute(text(
+            "DELETE FROM stg_data WHERE wn_key IS NOT NULL AND id NOT IN ("
+            " SELECT id FROM ("
+            "  SELECT id, ROW_NUMBER() OVER ("
+            "   PARTITION BY wn_key"
+            "   ORDER BY report_date DESC, id DESC) AS rn"
+            "  FROM stg_data WHERE wn_key IS NOT NULL) WHERE rn = 1)"
+        ))
+        conn.execute(text("CREATE UNIQUE INDEX ix_stg_data_wn_key ON stg_data (wn_key)"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_stg_data_wagon_invoice"))
+
+def ensure_stg_partitions(engine):
+    """
+    Add the report year and the (month, year) partition index to an stg_data
+    table created by an older version, deriving the year from the report date.
+    """
+    with engine.begin() as conn:
+        columns = {row[1] for row in conn.execute(text("PRAGMA table_info(stg_data)"))}
+        if 'year' not in columns:
+            conn.execute(text("ALTER TABLE stg_data ADD COLUMN year INTEGER"))
+            conn.execute(text(
+                "UPDATE stg_data SET year = CAST(strftime('%Y', report_date) AS INTEGER) "
+                "WHERE report_date IS NOT NULL"
+            ))
+        
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_stg_data_partition ON stg_data (month, year)"))
+
+def ensure_stg_wagon_index(engine):
+    """Add the (wagon, report date) index to an stg_data table created by an older version."""
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stg_data_wagon_date ON stg_data (wagon_number, report_date)"
+        ))
+
+def ensure_znp_route_index(engine):
+    """Add the route key index to a znp table created by an older version."""
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_znp_route "
+            "ON znp (month, departure_station, destination_station, wagon_type)"
+        ))
+
+def ensure_processing_log_indexes(engine):
+    """Add the logs view indexes to a processing_logs table created by an older version."""
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_processing_logs_operation ON processing_logs (operation, id)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_processing_logs_status ON processing_logs (status, id)"
+        ))
+
+# Route key of an stg_data row (NEW or OLD) as stored in route_counts
+_ROUTE_KEY_SQL = (
+    "COALESCE({row}.year, 0), COALESCE({row}.month, 0), COALESCE({row}.departure_station, ''), "
+    "COALESCE({row}.destination_station, ''), COALESCE({row}.wagon_type, '')"
+)
+_ROUTE_KEY_MATCH_SQL = (
+    "year = COALESCE({row}.year, 0)"
+    " AND month = COALESCE({row}.month, 0)"
+    " AND departure_station = COALESCE({row}.departure_station, '')"
+    " AND destination_station = COALESCE({row}.destination_station, '')"
+    " AND wagon_type = COALESCE({row}.wagon_type, '')"
+)
+
+# Only loaded wagons are counted, as in route generation
+_ROUTE_COUNT_TRIGGERS = {
+    'trg_route_counts_insert': (
+        "CREATE TRIGGER trg_route_counts_insert AFTER INSERT ON stg_data "
+        "WHEN NEW.load_status = 'ГРУЖ' BEGIN "
+        " INSERT INTO route_counts (year, month, departure_station, destination_station, wagon_type, count)"
+        " VALUES (" + _ROUTE_KEY_SQL.format(row='NEW') + ", 1)"
+        " ON CONFLICT (year, month, departure_station, destination_station, wagon_type)"
+        " DO UPDATE SET count = count + 1; "
+        "END"
+    ),
+    'trg_route_counts_delete': (
+        "CREATE TRIGGER trg_route_counts_delete AFTER DELETE ON stg_data "
+        "WHEN OLD.load_status = 'ГРУЖ' BEGIN "
+        " UPDATE route_counts SET count = count - 1 WHERE " + _ROUTE_KEY_MATCH_SQL.format(row='OLD') + ";"
+        " DELETE FROM route_counts WHERE count <= 0 AND " + _ROUTE_KEY_MATCH_SQL.format(row='OLD') + "; "
+        "END"
+    ),
+    'trg_route_counts_update': (
+        "CREATE TRIGGER trg_route_counts_update "
+        "AFTER UPDATE OF year, month, departure_station, destination_station, wagon_type, load_status ON stg_data "
+        "BEGIN "
+        " UPDATE route_counts SET count = count - 1"
+        " WHERE OLD.load_status = 'ГРУЖ' AND " + _ROUTE_KEY_MATCH_SQL.format(row='OLD') + ";"
+        " INSERT INTO route_counts (year, month, departure_station, destination_station, wagon_type, count)"
+        " SELECT " + _ROUTE_KEY_SQL.format(row='NEW') + ", 1 WHERE NEW.load_status = 'ГРУЖ'"
+        " ON CONFLICT (year, month, departure_station, destination_station, wagon_type)"
+        " DO UPDATE SET count = count + 1;"
+        " DELETE FROM route_counts WHERE count <= 0 AND " + _ROUTE_KEY_MATCH_SQL.format(row='OLD') + "; "
+        "END"
+    )
+}
+
+def ensure_route_counts(engine):
+    """
+    Create the triggers that keep route_counts in step with stg_data.
+    When they are missing or differ (new database or one created by an older
+    version), route_counts is first rebuilt from the rows already in stg_data;
+    a table from before the counts were keyed by year is recreated.
+    """
+    with engine.begin() as conn:
+        existing = dict(conn.execute(text(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'trg_route_counts_%'"
+        )).all())
+        if existing == _ROUTE_COUNT_TRIGGERS:
+            return
+        
+        for name in existing:
+            conn.execute(text(f"DROP TRIGGER {name}"))
+        
+        columns = {row[1] for row in conn.execute(text("PRAGMA table_info(route_counts)"))}
+        if 'year' not in columns:
+            RouteCount.__table__.drop(conn)
+            RouteCount.__table__.create(conn)
+        
+        conn.execute(text("DELETE FROM route_counts"))
+        conn.execute(text(
+            "INSERT INTO route_counts (year, month, departure_station, destination_station, wagon_type, count) "
+            "SELECT " + _ROUTE_KEY_SQL.format(row='stg_data') + ", COUNT(*) "
+            "FROM stg_data WHERE load_status = 'ГРУЖ' "
+            "GROUP BY " + _ROUTE_KEY_SQL.format(row='stg_data')
+        ))
+        for ddl in _ROUTE_COUNT_TRIGGERS.values():
+            conn.execute(text(ddl))
+
+# Marks a wagon dirty, recording its ГРУЖ row count before the change being made.
+# A wagon already marked is skipped with NOT EXISTS rather than OR IGNORE: inside a
+# trigger, the conflict policy of the firing statement (an upsert's is ABORT) wins.
+_MARK_DIRTY_SQL = (
+    " INSERT INTO route_dirty_wagons (wagon_number, loaded_count)"
+    " SELECT {wagon}, (SELECT COUNT(*) FROM stg_data"
+    "  WHERE wagon_number = {wagon} AND load_status = 'ГРУЖ'){adjust}"
+    " WHERE {wagon} IS NOT NULL"
+    "  AND NOT EXISTS (SELECT 1 FROM route_dirty_wagons WHERE wagon_number = {wagon});"
+)
+
+# stg_data columns that feed batch assignment and route mapping
+_ROUTE_INPUT_COLUMNS = [
+    'wagon_number', 'invoice_number', 'report_date', 'load_status', 'month',
+    'departure_station', 'destination_station', 'wagon_type', 'wn_key'
+]
+
+# The wagon of an override, taken from the high bits of its (wagon, invoice) key
+_OVERRIDE_WAGON_SQL = "(CASE WHEN {row}.wn_key >= 0 THEN {row}.wn_key >> 32 END)"
+
+_ROUTE_DIRTY_TRIGGERS = {
+    # AFTER INSERT does not fire when an upsert turns into an update
+    'trg_route_dirty_stg_insert': (
+        "CREATE TRIGGER trg_route_dirty_stg_insert AFTER INSERT ON stg_data BEGIN"
+        + _MARK_DIRTY_SQL.format(wagon='NEW.wagon_number', adjust=" - (NEW.load_status = 'ГРУЖ')")
+        + " END"
+    ),
+    'trg_route_dirty_stg_delete': (
+        "CREATE TRIGGER trg_route_dirty_stg_delete BEFORE DELETE ON stg_data BEGIN"
+        + _MARK_DIRTY_SQL.format(wagon='OLD.wagon_number', adjust='')
+        + " END"
+    ),
+    'trg_route_dirty_stg_update': (
+        "CREATE TRIGGER trg_route_dirty_stg_update BEFORE UPDATE OF "
+        + ", ".join(_ROUTE_INPUT_COLUMNS) + " ON stg_data WHEN "
+        + " OR ".join(f"OLD.{col} IS NOT NEW.{col}" for col in _ROUTE_INPUT_COLUMNS) + " BEGIN"
+        + _MARK_DIRTY_SQL.format(wagon='OLD.wagon_number', adjust='')
+        + _MARK_DIRTY_SQL.format(wagon='NEW.wagon_number', adjust='')
+        + " END"
+    ),
+    'trg_route_dirty_override_insert': (
+        "CREATE TRIGGER trg_route_dirty_override_insert AFTER INSERT ON overrides BEGIN"
+        + _MARK_DIRTY_SQL.format(wagon=_OVERRIDE_WAGON_SQL.format(row='NEW'), adjust='')
+        + " END"
+    ),
+    'trg_route_dirty_override_delete': (
+        "CREATE TRIGGER trg_route_dirty_override_delete AFTER DELETE ON overrides BEGIN"
+        + _MARK_DIRTY_SQL.format(wagon=_OVERRIDE_WAGON_SQL.format(row='OLD'), adjust='')
+        + " END"
+    ),
+    'trg_route_dirty_override_update': (
+        "CREATE TRIGGER trg_route_dirty_override_update AFTER UPDATE OF wn_key, znp_code ON overrides "
+        "WHEN OLD.wn_key IS NOT NEW.wn_key OR OLD.znp_code IS NOT NEW.znp_code BEGIN"
+        + _MARK_DIRTY_SQL.format(wagon=_OVERRIDE_WAGON_SQL.format(row='OLD'), adjust='')
+        + _MARK_DIRTY_SQL.format(wagon=_OVERRIDE_WAGON_SQL.format(row='NEW'), adjust='')
+        + " END"
+    )
+}
+
+def ensure_route_dirty_tracking(engine):
+    """
+    Create the triggers that mark wagons in route_dirty_wagons when their STG
+    rows or overrides change, and bring indexes of a database created by an
+    older version in line: the partial index counting a wagon's ГРУЖ rows and a
+    unique (wagon, invoice) key on wagon_invoices, keeping the newest duplicate.
+    ZNP and exception changes are marked by their writers, which know the keys.
+    """
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stg_data_loaded_wagon ON stg_data (wagon_number) "
+            "WHERE load_status = 'ГРУЖ'"
+        ))
+        
+        index_sql = conn.execute(text(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND name = 'ix_wagon_invoices_wn_key'"
+        )).scalar()
+        if not index_sql or 'UNIQUE' not in index_sql.upper():
+            conn.execute(text(
+                "DELETE FROM wagon_invoices WHERE wn_key IS NOT NULL AND id NOT IN ("
+                " SELECT MAX(id) FROM wagon_invoices WHERE wn_key IS NOT NULL GROUP BY wn_key)"
+            ))
+            conn.execute(text("DROP INDEX IF EXISTS ix_wagon_invoices_wn_key"))
+            conn.execute(text("CREATE UNIQUE INDEX ix_wagon_invoices_wn_key ON wagon_invoices (wn_key)"))
+        
+        # Triggers created by an older version are replaced
+        existing = dict(conn.execute(text(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'trg_route_dirty_%'"
+        )).all())
+        for name, ddl in _ROUTE_DIRTY_TRIGGERS.items():
+            if existing.get(name) != ddl:
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+                conn.execute(text(ddl))
@@ -1,13 +1,27 @@
 import pandas as pd
+import numpy as np
 import logging
+import atexit
+import functools
 from sqlalchemy.orm import Session
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Callable, Iterable, Iterator, Tuple
 from datetime import datetime
-from sqlalchemy import func, create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import func, text, MetaData, tuple_
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import os
 
-from app.database.models import ZNP, Exception, Override, ActiveRoute, MatrixMapping, WagonInvoice, ProcessingLog, STGData
+# The exceptions model is aliased so that `except Exception` keeps meaning the builtin
+from app.database.models import (
+    ZNP, Exception as RouteException, Override, ActiveRoute, MatrixMapping, WagonInvoice, ProcessingLog,
+    STGData, RunMetric, ReferenceVersion, STGFile, RouteCount, RouteDirtyWagon
+)
+from app.database.reference_cache import reference_cache
+from app.database.analytics import DuckDBEngine, get_query_engine, partition_join
+from app.database.writer import DatabaseWriter
+from app.database.audit_log import AuditLogWriter
+from app.database.key_store import wn_keys
+from app.utils.data_utils import ROUTE_KEY_COLUMNS, normalize_route_keys
 
 logger = logging.getLogger(__name__)
 
@@ -17,57 +31,410 @@ def get_database_path():
     os.makedirs(db_dir, exist_ok=True)
     return os.path.join(db_dir, "logistics_processor.db")
 
-# Create engine and session factory
-DATABASE_URL = f'sqlite:///{get_database_path()}'
-engine = create_engine(DATABASE_URL)
-SessionFactory = sessionmaker(bind=engine)
+# Sessions are per thread and share one engine: the session given to init_session
+# belongs to the thread that called it, any other thread gets its own on first use
+_sessions: Optional[scoped_session] = None
 
-# Global session variable
-_session = None
+# Thread that commits every write when started (see start_writer)
+_writer: Optional[DatabaseWriter] = None
 
 def init_session(session: Session):
-    """Initialize the global session."""
-    global _session
-    _session = session
+    """
+    Initialize the database sessions from the calling thread's session.
+    Other threads get sessions bound to the same engine.
+    """
+    global _sessions
+    _sessions = scoped_session(sessionmaker(bind=session.get_bind()))
+    _sessions.registry.set(session)
+    # Cached reference data may belong to a different database
+    reference_cache.invalidate()
 
 def get_session() -> Session:
-    """Get the current database session."""
-    global _session
-    if _session is None:
+    """Get the calling thread's database session."""
+    if _sessions is None:
         raise RuntimeError("Database session not initialized")
-    return _session
+    return _sessions()
+
+def remove_session() -> None:
+    """Close the calling thread's session; worker threads call this when they finish."""
+    if _sessions is not None:
+        _sessions.remove()
+
+def start_writer() -> DatabaseWriter:
+    """
+    Start the writer thread. From then on every write operation in this module
+    is committed on the writer's session, one at a time, and the calling thread
+    waits for it; reads stay on the calling thread's session.
+    """
+    global _writer
+    if _writer is None:
+        _writer = DatabaseWriter(on_exit=remove_session)
+        _writer.start()
+    return _writer
+
+def stop_writer() -> None:
+    """Finish the queued writes and stop the writer thread; writes then run on the caller's thread."""
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        writer.stop()
+
+# Buffered writer for processing_logs entries when started (see start_audit_log)
+_audit_log: Optional[AuditLogWriter] = None
+
+def start_audit_log(batch_size: int = 200, flush_interval: float = 2.0) -> AuditLogWriter:
+    """
+    Start buffering log_operation entries: they are queued and inserted in
+    batches on a background thread, on the session engine's own connections.
+    The remaining entries are written by stop_audit_log, at the latest at exit.
+    """
+    global _audit_log
+    if _audit_log is None:
+        _audit_log = AuditLogWriter(get_session().get_bind(), batch_size=batch_size, flush_interval=flush_interval)
+        _audit_log.start()
+        atexit.register(stop_audit_log)
+    return _audit_log
+
+def flush_audit_log(timeout: float = 5.0) -> bool:
+    """
+    Write the buffered log entries now, e.g. before showing the logs, waiting at
+    most timeout seconds. Returns False if they were not all written in time.
+    """
+    if _audit_log is None:
+        return True
+    return _audit_log.flush(timeout)
+
+def stop_audit_log() -> None:
+    """Write the buffered log entries and stop buffering."""
+    global _audit_log
+    audit_log, _audit_log = _audit_log, None
+    if audit_log is not None:
+        audit_log.stop()
+
+def _write_operation(func: Callable) -> Callable:
+    """Run a write operation on the writer thread when one is started."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        writer = _writer
+        if writer is None or writer.is_writer_thread():
+            return func(*args, **kwargs)
+        try:
+            return writer.call(func, *args, **kwargs)
+        finally:
+            # Objects this thread's session loaded may predate the write
+            get_session().expire_all()
+    return wrapper
+
+def _history_engine() -> Optional[DuckDBEngine]:
+    """
+    Return the DuckDB engine when one is selected and reads the session's database
+    file; history scans then run there instead of SQLite.
+    """
+    engine = get_query_engine()
+    if engine is None or not engine.reads(get_session().get_bind().url.database):
+        return None
+    return engine
+
+# (Wagon, invoice) key operations
+@_write_operation
+def get_wn_keys(wagon_numbers, invoice_numbers, add: bool = True) -> np.ndarray:
+    """
+    Return the packed (wagon, invoice) key of each row as int64.
+    With add=True unseen invoices are registered in the invoice dictionary and
+    committed, so call this before starting a write transaction. With add=False
+    rows whose invoice is not registered get -1 and match nothing.
+    """
+    session = get_session()
+    
+    try:
+        keys = wn_keys(session.connection(), wagon_numbers, invoice_numbers, add=add)
+        if add:
+            session.commit()
+        return keys
+    except Exception:
+        session.rollback()
+        raise
+
+# Reference version operations
+def get_reference_versions() -> pd.DataFrame:
+    """Get the current version, source hash and row count of each reference table."""
+    session = get_session()
+    versions = session.query(ReferenceVersion).order_by(ReferenceVersion.table_name).all()
+    
+    data = [{
+        'table_name': v.table_name,
+        'version': v.version,
+        'source_path': v.source_path,
+        'content_hash': v.content_hash,
+        'row_count': v.row_count,
+        'imported_at': v.imported_at
+    } for v in versions]
+    
+    return pd.DataFrame(data)
+
+def get_reference_version(table_name: str) -> int:
+    """Get the current version of a reference table (0 if it was never written)."""
+    session = get_session()
+    version = session.query(ReferenceVersion.version).filter(ReferenceVersion.table_name == table_name).scalar()
+    return version or 0
+
+def is_reference_unchanged(table_name: str, content_hash: str) -> bool:
+    """Return True if the table was last imported from a file with this content hash."""
+    session = get_session()
+    stored_hash = session.query(ReferenceVersion.content_hash).filter(
+        ReferenceVersion.table_name == table_name
+    ).scalar()
+    return stored_hash is not None and stored_hash == content_hash
+
+def _bump_reference_version(session: Session, table_name: str, row_count: int,
+                            source_path: Optional[str] = None, content_hash: Optional[str] = None,
+                            bump: bool = True) -> int:
+    """
+    Increase a reference table's version within the caller's transaction.
+    Changes that do not come from a file clear the stored hash, so the next
+    import of the source file is applied again. With bump=False only the
+    source details are recorded, for imports that left the table unchanged.
+    """
+    record = session.query(ReferenceVersion).filter(ReferenceVersion.table_name == table_name).first()
+    if record is None:
+        record = ReferenceVersion(table_name=table_name, version=0)
+        session.add(record)
+    
+    if bump:
+        record.version = (record.version or 0) + 1
+        reference_cache.invalidate(table_name)
+    record.source_path = source_path
+    record.content_hash = content_hash
+    record.row_count = row_count
+    record.imported_at = datetime.now()
+    return record.version
+
+def apply_reference_diff(session: Session, model, incoming: pd.DataFrame,
+                         key_columns: List[str], value_columns: List[str], scope=None,
+                         on_changed_keys: Optional[Callable[[Session, pd.DataFrame], None]] = None,
+                         insert_defaults: Optional[Dict[str, Any]] = None) -> Dict[str, int]:
+    """
+    Bring a reference table in line with an incoming frame using its natural key.
+    Rows missing from the table are inserted, rows whose values differ are updated
+    and rows no longer in the frame are deleted; unchanged rows are not touched.
+    A scope filter limits the comparison (and so the deletes) to part of the table.
+    on_changed_keys receives the keys of all inserted, updated and deleted rows.
+    insert_defaults gives columns that are set on inserted rows only and never
+    compared, so they do not turn unchanged rows into updates.
+    Runs inside the caller's transaction and returns the number of rows in each group.
+    """
+    columns = key_columns + value_columns
+    
+    # The last occurrence of a key in the file wins
+    incoming = incoming[columns].drop_duplicates(subset=key_columns, keep='last')
+    
+    table = model.__table__
+    query = session.query(table.c.id, *[table.c[col] for col in columns])
+    if scope is not None:
+        query = query.filter(scope)
+    current = pd.read_sql(query.statement, session.connection())
+    current = current.astype({col: incoming[col].dtype for col in key_columns})
+    
+    merged = current.merge(incoming, on=key_columns, how='outer', suffixes=('_old', ''), indicator=True)
+    
+    to_insert = merged[merged['_merge'] == 'right_only']
+    to_delete = merged[merged['_merge'] == 'left_only']
+    both = merged[merged['_merge'] == 'both']
+    
+    differs = pd.Series(False, index=both.index)
+    for col in value_columns:
+        old = both[f"{col}_old"].astype(object)
+        new = both[col].astype(object)
+        differs |= ~((old == new) | (old.isna() & new.isna()))
+    to_update = both[differs]
+    
+    if not to_delete.empty:
+        ids = to_delete['id'].astype(int).tolist()
+        for start in range(0, len(ids), 500):
+            session.query(model).filter(model.id.in_(ids[start:start + 500])).delete(synchronize_session=False)
+    
+    if not to_update.empty:
+        updates = to_update[['id'] + value_columns].astype(object)
+        updates['id'] = updates['id'].astype(int)
+        session.bulk_update_mappings(model, updates.to_dict('records'))
+    
+    if not to_insert.empty:
+        inserts = to_insert[columns].astype(object)
+        for col, value in (insert_defaults or {}).items():
+            inserts[col] = value
+        session.bulk_insert_mappings(model, inserts.to_dict('records'))
+    
+    if on_changed_keys is not None:
+        changed_keys = pd.concat([to_insert[key_columns], to_update[key_columns], to_delete[key_columns]])
+        if not changed_keys.empty:
+            on_changed_keys(session, changed_keys)
+    
+    return {
+        'inserted': len(to_insert),
+        'updated': len(to_update),
+        'deleted': len(to_delete),
+        'unchanged': len(both) - len(to_update),
+        'total': len(incoming)
+    }
+
+def _swap_reference_table(session: Session, model, rows: List[Dict[str, Any]],
+                          source_path: Optional[str] = None, content_hash: Optional[str] = None) -> Dict[str, int]:
+    """
+    Fully reload a reference table through a staging table.
+    The rows are written to <table>_staging first, with the live table untouched;
+    a short transaction then drops the live table and renames the staging table
+    into its place. Readers see either the old or the new contents, never an
+    empty table. Returns the same summary as apply_reference_diff: every old
+    row counts as deleted and every new one as inserted.
+    """
+    table = model.__table__
+    replaced = session.query(func.count()).select_from(table).scalar()
+    staging = table.to_metadata(MetaData(), name=f"{table.name}_staging")
+    staging.indexes.clear()
+    
+    # Build the staging table
+    conn = session.connection()
+    staging.drop(conn, checkfirst=True)
+    staging.create(conn)
+    if rows:
+        conn.execute(staging.insert(), rows)
+    session.commit()
+    
+    # Swap it in. The version row is flushed first so the driver has opened the
+    # transaction before the DDL runs; otherwise DROP/ALTER would autocommit.
+    _bump_reference_version(session, table.name, len(rows), source_path, content_hash)
+    session.flush()
+    conn = session.connection()
+    conn.execute(text(f'DROP TABLE "{table.name}"'))
+    conn.execute(text(f'ALTER TABLE "{staging.name}" RENAME TO "{table.name}"'))
+    for index in table.indexes:
+        index.create(conn)
+    session.commit()
+    
+    return {'inserted': len(rows), 'updated': 0, 'deleted': replaced, 'unchanged': 0, 'total': len(rows)}
+
+def _has_changes(summary: Dict[str, int]) -> bool:
+    """Return True if a diff summary wrote any rows."""
+    return bool(summary['inserted'] or summary['updated'] or summary['deleted'])
 
 # ZNP operations
+ZNP_COLUMNS = ['Месяц', 'Ст. отправления', 'Ст. назначения', 'Тип вагона', 'ЗНП']
+
+# Natural key of the znp table
+ZNP_KEY_COLUMNS = ['month', 'departure_station', 'destination_station', 'wagon_type']
+
+# Keys per IN (...) lookup when resolving the wagons a reference change touches
+DEPENDENCY_CHUNK_SIZE = 500
+
+_MARK_WAGON_DIRTY = text(
+    "INSERT OR IGNORE INTO route_dirty_wagons (wagon_number, loaded_count) "
+    "SELECT :wagon, COUNT(*) FROM stg_data WHERE wagon_number = :wagon AND load_status = 'ГРУЖ'"
+)
+
+def mark_route_wagons(session: Session, wagons: Iterable[int]) -> int:
+    """
+    Mark wagons for route ID recomputation in the caller's transaction.
+    Wagons already marked keep their recorded ГРУЖ count. Returns the number of wagons given.
+    """
+    params = [{"wagon": int(wagon)} for wagon in set(wagons)]
+    if params:
+        session.execute(_MARK_WAGON_DIRTY, params)
+    return len(params)
+
+def _mark_route_key_wagons(session: Session, keys: pd.DataFrame) -> None:
+    """Mark the wagons whose ГРУЖ rows use any of the given ZNP route keys."""
+    table = STGData.__table__
+    route = tuple_(table.c.month, table.c.departure_station, table.c.destination_station, table.c.wagon_type)
+    
+    keys = list(keys[ZNP_KEY_COLUMNS].drop_duplicates().itertuples(index=False, name=None))
+    wagons = set()
+    for start in range(0, len(keys), DEPENDENCY_CHUNK_SIZE):
+        chunk = [(int(month), *rest) for month, *rest in keys[start:start + DEPENDENCY_CHUNK_SIZE]]
+        rows = session.query(table.c.wagon_number).filter(
+            table.c.load_status == 'ГРУЖ', table.c.wagon_number.isnot(None), route.in_(chunk)
+        ).distinct()
+        wagons.update(row[0] for row in rows)
+    
+    mark_route_wagons(session, wagons)
+    logger.info(f"Marked {len(wagons)} wagons for {len(keys)} changed ZNP routes")
+
+def _mark_invoice_wagons(session: Session, keys: pd.DataFrame) -> None:
+    """Mark the wagons whose ГРУЖ rows carry any of the given exception invoices."""
+    table = STGData.__table__
+    
+    invoices = keys['invoice_number'].drop_duplicates().tolist()
+    wagons = set()
+    for start in range(0, len(invoices), DEPENDENCY_CHUNK_SIZE):
+        rows = session.query(table.c.wagon_number).filter(
+            table.c.load_status == 'ГРУЖ', table.c.wagon_number.isnot(None),
+            table.c.invoice_number.in_(invoices[start:start + DEPENDENCY_CHUNK_SIZE])
+        ).distinct()
+        wagons.update(row[0] for row in rows)
+    
+    mark_route_wagons(session, wagons)
+    logger.info(f"Marked {len(wagons)} wagons for {len(invoices)} changed exceptions")
+
 def get_znp_data() -> pd.DataFrame:
-    """Get all ZNP data as a DataFrame."""
+    """
+    Get all ZNP data as a DataFrame.
+    Served from the reference cache; the table is only queried after it changes.
+    """
     try:
-        session = get_session()
-        znp_records = session.query(ZNP).all()
-        
-        if not znp_records:
-            logger.warning("No ZNP records found in database")
-            return pd.DataFrame(columns=['Месяц', 'Ст. отправления', 'Ст. назначения', 'Тип вагона', 'ЗНП'])
-        
-        data = [{
-            'Месяц': record.month,
-            'Ст. отправления': record.departure_station,
-            'Ст. назначения': record.destination_station,
-            'Тип вагона': record.wagon_type,
-            'ЗНП': record.znp_code
-        } for record in znp_records]
-        
-        return pd.DataFrame(data)
+        return reference_cache.get_frame('znp', _load_znp_data, lambda: get_reference_version('znp'))
     except Exception as e:
         logger.error(f"Error retrieving ZNP data: {str(e)}")
-        return pd.DataFrame(columns=['Месяц', 'Ст. отправления', 'Ст. назначения', 'Тип вагона', 'ЗНП'])
+        return pd.DataFrame(columns=ZNP_COLUMNS)
+
+def _load_znp_data() -> pd.DataFrame:
+    """Query the ZNP table into a typed DataFrame."""
+    session = get_session()
+    table = ZNP.__table__
+    query = session.query(
+        table.c.month, table.c.departure_station, table.c.destination_station,
+        table.c.wagon_type, table.c.znp_code
+    )
+    df = pd.read_sql(query.statement, session.connection())
+    
+    if df.empty:
+        logger.warning("No ZNP records found in database")
+        return pd.DataFrame(columns=ZNP_COLUMNS)
+    
+    df.columns = ZNP_COLUMNS
+    df['Месяц'] = df['Месяц'].astype(int)
+    return df
 
-def add_znp_data(df: pd.DataFrame) -> int:
+def get_znp_route_keys() -> pd.DataFrame:
     """
-    Add ZNP data from a DataFrame.
-    Returns the number of records added.
+    Get the ZNP data keyed by normalized route keys, one row per route.
+    Built once per ZNP version; the frame is shared and must not be modified.
+    """
+    def build(df: pd.DataFrame) -> pd.DataFrame:
+        keyed = normalize_route_keys(df)
+        keyed["ЗНП"] = df["ЗНП"].astype(str)
+        # As with a dict lookup, the last row for a route wins
+        return keyed.drop_duplicates(subset=ROUTE_KEY_COLUMNS, keep='last').reset_index(drop=True)
+    
+    return reference_cache.get_derived('znp', 'route_keys', get_znp_data, build, lambda: get_reference_version('znp'))
+
+def lookup_znp_codes(routes: pd.DataFrame) -> pd.Series:
+    """
+    Look up the ЗНП code of each route with a single merge on the normalized route key.
+    Returns a Series aligned with routes, with "" where no ЗНП is set.
+    """
+    keys = normalize_route_keys(routes)
+    matched = keys.merge(get_znp_route_keys(), on=ROUTE_KEY_COLUMNS, how='left')
+    return pd.Series(matched["ЗНП"].fillna("").to_numpy(), index=routes.index, name="ЗНП")
+
+@_write_operation
+def add_znp_data(df: pd.DataFrame, source_path: Optional[str] = None,
+                 content_hash: Optional[str] = None) -> Dict[str, int]:
+    """
+    Sync ZNP data with a DataFrame.
+    Rows are matched on (month, departure station, destination station, wagon type);
+    only inserts, updates and deletes are written.
+    Returns the change summary from apply_reference_diff.
     """
     session = get_session()
-    count = 0
     
     try:
         # Convert month column to integer
@@ -79,32 +446,27 @@ def add_znp_data(df: pd.DataFrame) -> int:
         if missing_columns:
             raise ValueError(f"Missing required columns: {missing_columns}")
         
-        # Get current year
-        current_year = datetime.now().year
-        
-        # Clear existing ZNP data
-        session.query(ZNP).delete()
-        session.commit()
-        
-        # Add each record
-        for _, row in df.iterrows():
-            try:
-                znp = ZNP(
-                    month=int(row['Месяц']),  # Ensure integer
-                    year=current_year,  # Set current year as default
-                    departure_station=str(row['Ст. отправления']),  # Ensure string
-                    destination_station=str(row['Ст. назначения']),  # Ensure string
-                    wagon_type=str(row['Тип вагона']),  # Ensure string
-                    znp_code=str(row['ЗНП'])  # Ensure string
-                )
-                session.add(znp)
-                count += 1
-            except BaseException as e:
-                logger.error(f"Error adding ZNP record: {str(e)}, Row: {row.to_dict()}")
-                continue
+        incoming = pd.DataFrame({
+            'month': df['Месяц'],
+            'departure_station': df['Ст. отправления'].map(str),
+            'destination_station': df['Ст. назначения'].map(str),
+            'wagon_type': df['Тип вагона'].map(str),
+            'znp_code': df['ЗНП'].map(str)
+        })
         
+        summary = apply_reference_diff(
+            session, ZNP, incoming,
+            key_columns=['month', 'departure_station', 'destination_station', 'wagon_type'],
+            value_columns=['znp_code'],
+            on_changed_keys=_mark_route_key_wagons,
+            # Set current year as default; it is not part of the route's value
+            insert_defaults={'year': datetime.now().year}
+        )
+        _bump_reference_version(session, 'znp', summary['total'], source_path, content_hash,
+                                bump=_has_changes(summary))
         session.commit()
-        return count
+        logger.info(f"Synced ZNP data: {summary}")
+        return summary
     except BaseException as e:
         session.rollback()
         logger.error(f"Error adding ZNP data: {str(e)}")
@@ -112,11 +474,115 @@ def add_znp_data(df: pd.DataFrame) -> int:
             raise
         raise RuntimeError(f"Failed to add ZNP data: {str(e)}")
 
+def _apply_znp_route_edits(session: Session, changes: List[Dict[str, Any]]) -> int:
+    """
+    Apply edited ZNP routes within the caller's transaction.
+    Each change holds the route key with its original wagon type ('old_wagon_type')
+    plus the new 'Тип вагона' and 'ЗНП' values. An empty ЗНП removes the record.
+    Returns the number of records touched.
+    """
+    touched = 0
+    current_year = datetime.now().year
+    changed_keys = []
+
+    for change in changes:
+        month = int(change['Месяц'])
+        departure = str(change['Ст. отправления'])
+        destination = str(change['Ст. назначения'])
+        old_wagon_type = str(change['old_wagon_type'])
+        new_wagon_type = str(change['Тип вагона']).strip()
+        znp_code = str(change['ЗНП']).strip()
+        changed_keys += [
+            (month, departure, destination, old_wagon_type),
+            (month, departure, destination, new_wagon_type)
+        ]
+
+        route_query = session.query(ZNP).filter(
+            ZNP.month == month,
+            ZNP.departure_station == departure,
+            ZNP.destination_station == destination
+        )
+
+        # Drop any record already sitting on the new key so the route stays unique
+        if new_wagon_type != old_wagon_type:
+            touched += route_query.filter(ZNP.wagon_type == new_wagon_type).delete(synchronize_session=False)
+
+        existing = route_query.filter(ZNP.wagon_type == old_wagon_type)
+        if not znp_code:
+            touched += existing.delete(synchronize_session=False)
+            continue
+
+        record = existing.first()
+        if record is None:
+            record = ZNP(
+                month=month,
+                year=current_year,
+                departure_station=departure,
+                destination_station=destination,
+                wagon_type=new_wagon_type,
+                znp_code=znp_code
+            )
+            session.add(record)
+        else:
+            record.wagon_type = new_wagon_type
+            record.znp_code = znp_code
+        touched += 1
+
+    _mark_route_key_wagons(session, pd.DataFrame(changed_keys, columns=ZNP_KEY_COLUMNS))
+
+    # Edited routes no longer match the imported file
+    _bump_reference_version(session, 'znp', session.query(func.count(ZNP.id)).scalar())
+    return touched
+
+@_write_operation
+def upsert_znp_routes(changes: List[Dict[str, Any]]) -> int:
+    """
+    Apply edited ZNP routes as targeted upserts instead of a full reload.
+    Returns the number of records touched.
+    """
+    session = get_session()
+
+    try:
+        touched = _apply_znp_route_edits(session, changes)
+        session.commit()
+        logger.info(f"Upserted {len(changes)} edited ZNP routes ({touched} records touched)")
+        return touched
+    except BaseException as e:
+        session.rollback()
+        logger.error(f"Error upserting ZNP routes: {str(e)}")
+        raise
+
+@_write_operation
+def save_znp_route_edits(znp_changes: List[Dict[str, Any]],
+                         wagon_type_changes: List[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    Save edited ZNP routes and the STG wagon types they rename in one transaction,
+    so a failed save leaves neither table half-updated.
+    Returns the ZNP records touched and the STG records retyped.
+    """
+    session = get_session()
+
+    try:
+        touched = _apply_znp_route_edits(session, znp_changes)
+        retyped = _apply_stg_wagon_types(session, wagon_type_changes)
+        session.commit()
+        logger.info(f"Saved {len(znp_changes)} edited ZNP routes "
+                    f"({touched} records touched, {retyped} STG records retyped)")
+        return {'znp': touched, 'stg': retyped}
+    except BaseException as e:
+        session.rollback()
+        logger.error(f"Error saving ZNP route edits: {str(e)}")
+        raise
+
 # Exception operations
 def get_exceptions() -> pd.DataFrame:
-    """Get all exceptions data as a DataFrame."""
+    """Get all exceptions data as a DataFrame, served from the reference cache."""
+    return reference_cache.get_frame('exceptions', _load_exceptions, lambda: get_reference_version('exceptions'))
+
+def _load_exceptions() -> pd.DataFrame:
+    """Query the exceptions table into a DataFrame."""
     session = get_session()
-    exception_records = session.query(Exception).all()
+    exception_records = session.query(RouteException).all()
     
     data = [{
         'Накладная №': record.invoice_number,
@@ -125,33 +591,32 @@ def get_exceptions() -> pd.DataFrame:
     
     return pd.DataFrame(data)
 
-def add_exceptions(df: pd.DataFrame) -> int:
+@_write_operation
+def add_exceptions(df: pd.DataFrame, source_path: Optional[str] = None,
+                   content_hash: Optional[str] = None) -> Dict[str, int]:
     """
-    Add exceptions from a DataFrame.
-    Returns the number of records added.
+    Sync exceptions with a DataFrame, matching rows on the invoice number.
+    Returns the change summary from apply_reference_diff.
     """
     session = get_session()
-    count = 0
     
     try:
-        # Clear existing exceptions
-        session.query(Exception).delete()
-        session.commit()
-        
-        for _, row in df.iterrows():
-            try:
-                exception = Exception(
-                    invoice_number=str(row['Накладная №']).strip(),
-                    exception_route_id=str(row['ExceptionRouteID']).strip()
-                )
-                session.add(exception)
-                count += 1
-            except BaseException as e:
-                logger.error(f"Error adding exception record: {str(e)}, Row: {row.to_dict()}")
-                continue
+        incoming = pd.DataFrame({
+            'invoice_number': df['Накладная №'].map(str).str.strip(),
+            'exception_route_id': df['ExceptionRouteID'].map(str).str.strip()
+        })
         
+        summary = apply_reference_diff(
+            session, RouteException, incoming,
+            key_columns=['invoice_number'],
+            value_columns=['exception_route_id'],
+            on_changed_keys=_mark_invoice_wagons
+        )
+        _bump_reference_version(session, 'exceptions', summary['total'], source_path, content_hash,
+                                bump=_has_changes(summary))
         session.commit()
-        return count
+        logger.info(f"Synced exceptions: {summary}")
+        return summary
     except BaseException as e:
         session.rollback()
         logger.error(f"Error adding exceptions: {str(e)}")
@@ -159,7 +624,11 @@ def add_exceptions(df: pd.DataFrame) -> int:
 
 # Override operations
 def get_overrides() -> pd.DataFrame:
-    """Get all overrides data as a DataFrame."""
+    """Get all overrides data as a DataFrame, served from the reference cache."""
+    return reference_cache.get_frame('overrides', _load_overrides, lambda: get_reference_version('overrides'))
+
+def _load_overrides() -> pd.DataFrame:
+    """Query the overrides table into a typed DataFrame."""
     session = get_session()
     override_records = session.query(Override).all()
     
@@ -171,7 +640,8 @@ def get_overrides() -> pd.DataFrame:
             data.append({
                 'wagon_number': wagon_num,
                 'invoice_number': str(record.invoice_number).strip(),
-                'znp_code': str(record.znp_code).strip()
+                'znp_code': str(record.znp_code).strip(),
+                'wn_key': record.wn_key
             })
         except (ValueError, TypeError) as e:
             logger.error(f"Error processing override record: {str(e)}")
@@ -184,54 +654,52 @@ def get_overrides() -> pd.DataFrame:
         df['wagon_number'] = df['wagon_number'].astype('int64')
         df['invoice_number'] = df['invoice_number'].astype(str)
         df['znp_code'] = df['znp_code'].astype(str)
+        df['wn_key'] = df['wn_key'].fillna(-1).astype('int64')
     
     return df
 
-def add_overrides(df: pd.DataFrame) -> int:
+@_write_operation
+def add_overrides(df: pd.DataFrame, source_path: Optional[str] = None,
+                  content_hash: Optional[str] = None) -> Dict[str, int]:
     """
-    Add overrides from a DataFrame.
-    Returns the number of records added.
+    Sync overrides with a DataFrame, matching rows on the packed (wagon, invoice) key.
+    Returns the change summary from apply_reference_diff.
     """
     session = get_session()
-    count = 0
     
     try:
-        # Clear existing overrides
-        session.query(Override).delete()
-        session.commit()
-        
         # Rename columns from Russian to English
         column_mapping = {
             'Вагон №': 'wagon_number',
             'Накладная №': 'invoice_number',
             'ЗНП': 'znp_code'  # Changed from 'ЗНП Override' to 'ЗНП'
         }
-        
-        # Create a copy of the DataFrame with renamed columns
         df_processed = df.rename(columns=column_mapping)
         
-        # Log column names for debugging
-        logger.info(f"Input DataFrame columns: {df.columns.tolist()}")
-        logger.info(f"Processed DataFrame columns: {df_processed.columns.tolist()}")
+        # Wagon numbers are stored as integer strings; rows without one are skipped
+        wagon_numbers = pd.to_numeric(df_processed['wagon_number'], errors='coerce')
+        invalid = wagon_numbers.isna()
+        if invalid.any():
+            logger.error(f"Skipping {int(invalid.sum())} override rows without a valid wagon number")
         
-        for _, row in df_processed.iterrows():
-            try:
-                # Convert wagon number to integer and then to string
-                wagon_num = str(int(float(row['wagon_number'])))
-                override = Override(
-                    wagon_number=wagon_num.strip(),
-                    invoice_number=str(row['invoice_number']).strip(),
-                    znp_code=str(row['znp_code']).strip()
-                )
-                session.add(override)
-                count += 1
-            except BaseException as e:
-                logger.error(f"Error processing override row: {str(e)}, Row data: {row.to_dict()}")
-                continue
+        valid = df_processed[~invalid]
+        incoming = pd.DataFrame({
+            'wagon_number': wagon_numbers[~invalid].astype('int64').astype(str),
+            'invoice_number': valid['invoice_number'].map(str).str.strip(),
+            'znp_code': valid['znp_code'].map(str).str.strip()
+        })
+        incoming['wn_key'] = get_wn_keys(incoming['wagon_number'], incoming['invoice_number'])
         
+        summary = apply_reference_diff(
+            session, Override, incoming,
+            key_columns=['wn_key'],
+            value_columns=['wagon_number', 'invoice_number', 'znp_code']
+        )
+        _bump_reference_version(session, 'overrides', summary['total'], source_path, content_hash,
+                                bump=_has_changes(summary))
         session.commit()
-        logger.info(f"Successfully added {count} overrides")
-        return count
+        logger.info(f"Synced overrides: {summary}")
+        return summary
     except BaseException as e:
         session.rollback()
         logger.error(f"Error adding overrides: {str(e)}")
@@ -253,36 +721,27 @@ def get_active_routes() -> pd.DataFrame:
     
     return pd.DataFrame(data)
 
-def add_active_routes(routes: List[str]) -> int:
+@_write_operation
+def add_active_routes(routes: List[str], source_path: Optional[str] = None,
+                      content_hash: Optional[str] = None) -> Dict[str, int]:
     """
-    Add active routes from a list.
-    Returns the number of records added.
+    Replace the active routes with a list.
+    The table is rebuilt in a staging table and swapped in atomically.
+    Returns the change summary; 'total' is the number of records added.
     """
     session = get_session()
-    count = 0
     
     try:
         # Log the number of routes to process
         logger.info(f"Processing {len(routes)} active routes")
         
-        # Clear existing routes
-        session.query(ActiveRoute).delete()
-        session.commit()
-        logger.info("Cleared existing active routes")
-        
-        # Add new routes
-        for route in routes:
-            route_id = str(route).strip()
-            if not route_id:  # Skip empty route IDs
-                continue
-                
-            active = ActiveRoute(route_id=route_id)
-            session.add(active)
-            count += 1
+        # Skip empty route IDs and repeats of the same route
+        route_ids = dict.fromkeys(route_id for route_id in (str(route).strip() for route in routes) if route_id)
+        rows = [{'route_id': route_id} for route_id in route_ids]
         
-        session.commit()
-        logger.info(f"Successfully added {count} active routes")
-        return count
+        summary = _swap_reference_table(session, ActiveRoute, rows, source_path, content_hash)
+        logger.info(f"Successfully added {summary['total']} active routes")
+        return summary
     except BaseException as e:
         session.rollback()
         logger.error(f"Error adding active routes: {str(e)}")
@@ -302,18 +761,18 @@ def get_matrix_mappings() -> pd.DataFrame:
     
     return pd.DataFrame(data)
 
-def add_matrix_mappings(df: pd.DataFrame) -> int:
+@_write_operation
+def add_matrix_mappings(df: pd.DataFrame, source_path: Optional[str] = None,
+                        content_hash: Optional[str] = None) -> Dict[str, int]:
     """
-    Add matrix mappings from a DataFrame.
-    Returns the number of records added.
+    Replace the matrix mappings with a DataFrame.
+    The table is rebuilt in a staging table and swapped in atomically.
+    Returns the change summary; 'total' is the number of records added.
     """
     session = get_session()
-    count = 0
     
     try:
-        # Clear existing mappings
-        session.query(MatrixMapping).delete()
-        session.commit()
+        rows = []
         
         # Process each row in the matrix file
         for _, row in df.iterrows():
@@ -327,26 +786,25 @@ def add_matrix_mappings(df: pd.DataFrame) -> int:
                 continue
                 
             # Create mappings only from each value to the next one
-            group_id = f"group_{count}"
+            group_id = f"group_{len(rows)}"
             for i in range(len(values) - 1):
                 # Create forward mapping only
-                mapping = MatrixMapping(
-                    source_value=values[i].strip(),
-                    target_value=values[i + 1].strip(),
-                    mapping_group=group_id
-                )
-                session.add(mapping)
-                count += 1
-            
-        session.commit()
-        logger.info(f"Successfully added {count} matrix mappings")
-        return count
+                rows.append({
+                    'source_value': values[i].strip(),
+                    'target_value': values[i + 1].strip(),
+                    'mapping_group': group_id
+                })
+        
+        summary = _swap_reference_table(session, MatrixMapping, rows, source_path, content_hash)
+        logger.info(f"Successfully added {summary['total']} matrix mappings")
+        return summary
     except Exception as e:
         session.rollback()
         logger.error(f"Error adding matrix mappings: {str(e)}")
         raise
 
 # WagonInvoice operations
+@_write_operation
 def add_wagon_invoice_data(df: pd.DataFrame) -> int:
     """
     Add processed wagon-invoice data from a DataFrame.
@@ -356,7 +814,8 @@ def add_wagon_invoice_data(df: pd.DataFrame) -> int:
     count = 0
     
     try:
-        for _, row in df.iterrows():
+        keys = get_wn_keys(df['Вагон №'], df['Накладная №'])
+        for key, (_, row) in zip(keys, df.iterrows()):
             record = WagonInvoice(
                 wagon_number=row['Вагон №'],
                 invoice_number=row['Накладная №'],
@@ -368,7 +827,8 @@ def add_wagon_invoice_data(df: pd.DataFrame) -> int:
                 report_date=row['Отчетная дата'],
                 arrival_date=row.get('Прибытие на ст. назн.'),
                 status=row['Груж\\пор'],
-                wagon_type=row.get('Тип вагона', 'Unknown')
+                wagon_type=row.get('Тип вагона', 'Unknown'),
+                wn_key=int(key) if key >= 0 else None
             )
             session.add(record)
             count += 1
@@ -380,12 +840,246 @@ def add_wagon_invoice_data(df: pd.DataFrame) -> int:
         logger.error(f"Error adding wagon-invoice data: {str(e)}")
         raise
 
+# wagon_invoices columns filled from the Route ID table, after the (wagon, invoice) key
+WAGON_INVOICE_COLUMNS = {
+    'wagon_number': 'Вагон №',
+    'invoice_number': 'Накладная №',
+    'route_id': 'ЗНП',
+    'batch_id': 'Batch ID',
+    'departure_station': 'Ст. отправления',
+    'destination_station': 'Ст. назначения',
+    'departure_date': 'Прибытие на ст. отправл.',
+    'report_date': 'Отчетная дата',
+    'arrival_date': 'Прибытие на ст. назн.',
+    'status': 'Груж\\пор'
+}
+
+@_write_operation
+def sync_wagon_invoices(df: pd.DataFrame, wagons: Optional[Iterable[int]] = None) -> Dict[str, int]:
+    """
+    Bring wagon_invoices in line with a Route ID table from map_znp_to_batches,
+    matching rows on the (wagon, invoice) key. With wagons given, only the stored
+    rows of those wagons are compared, so rows of other wagons are kept.
+    Only changed rows are written. Returns the change summary from apply_reference_diff.
+    """
+    session = get_session()
+    
+    try:
+        incoming = pd.DataFrame({
+            column: df[source].astype(object) for column, source in WAGON_INVOICE_COLUMNS.items()
+        })
+        incoming['wn_key'] = df['W&N'].astype('int64').to_numpy()
+        incoming['wagon_type'] = df['Тип вагона'].astype(object) if 'Тип вагона' in df.columns else 'Unknown'
+        for column in ['departure_station', 'destination_station', 'status', 'wagon_type']:
+            incoming[column] = incoming[column].where(incoming[column].notna(), '')
+        incoming = incoming.astype(object).where(incoming.notna(), None)
+        incoming['wn_key'] = incoming['wn_key'].astype('int64')
+        
+        scope = None
+        if wagons is not None:
+            scope = WagonInvoice.wagon_number.in_([int(wagon) for wagon in wagons])
+        
+        value_columns = list(WAGON_INVOICE_COLUMNS) + ['wagon_type']
+        summary = apply_reference_diff(
+            session, WagonInvoice, incoming, key_columns=['wn_key'], value_columns=value_columns, scope=scope
+        )
+        session.commit()
+        logger.info(f"Synced wagon invoices: {summary}")
+        return summary
+    except BaseException as e:
+        session.rollback()
+        logger.error(f"Error syncing wagon invoices: {str(e)}")
+        raise
+
+# Route IDs of the STG history computed inside SQLite, the set-based form of
+# FileProcessor.map_znp_to_batches. Text keys are compared as the pandas path sees
+# them once prepare_stg_frame has turned missing text into ''. Within a batch rows
+# are ordered by report date and id, the order of the batch walk.
+_ROUTE_ID_RESULTS_SQL = """
+CREATE TEMP TABLE route_id_results AS
+WITH loaded AS (
+    SELECT s.id, s.batch_id, s.report_date,
+           z.znp_code AS znp, e.exception_route_id
+    FROM stg_data s
+    LEFT JOIN znp z
+           ON z.month = COALESCE(s.month, 0)
+          AND z.departure_station = COALESCE(s.departure_station, '')
+          AND z.destination_station = COALESCE(s.destination_station, '')
+          AND z.wagon_type = COALESCE(s.wagon_type, '')
+    LEFT JOIN exceptions e ON e.invoice_number = COALESCE(s.invoice_number, '')
+    WHERE s.load_status = 'ГРУЖ' AND s.batch_id IS NOT NULL
+),
+batch_routes AS (
+    -- Exceptions > ЗНП, each the first non-null value in the batch
+    SELECT DISTINCT batch_id,
+           COALESCE(
+               FIRST_VALUE(exception_route_id) OVER (
+                   PARTITION BY batch_id ORDER BY exception_route_id IS NULL, report_date, id),
+               FIRST_VALUE(znp) OVER (
+                   PARTITION BY batch_id ORDER BY znp IS NULL, report_date, id)
+           ) AS route_id
+    FROM loaded
+),
+row_routes AS (
+    -- Overrides replace the batch route of their own row
+    SELECT s.*, COALESCE(o.znp_code, b.route_id) AS row_route_id
+    FROM stg_data s
+    LEFT JOIN batch_routes b ON b.batch_id = s.batch_id
+    LEFT JOIN overrides o ON o.wn_key = s.wn_key AND o.wn_key >= 0
+    WHERE s.batch_id IS NOT NULL AND s.batch_id <> 0
+),
+propagated AS (
+    SELECT r.*, FIRST_VALUE(row_route_id) OVER (
+               PARTITION BY batch_id ORDER BY row_route_id IS NULL, report_date, id) AS propagated_route_id
+    FROM row_routes r
+)
+SELECT wagon_number, COALESCE(invoice_number, '') AS invoice_number, propagated_route_id AS route_id, batch_id,
+       COALESCE(departure_station, '') AS departure_station,
+       COALESCE(destination_station, '') AS destination_station,
+       departure_arrival AS departure_date, report_date, destination_arrival AS arrival_date,
+       COALESCE(load_status, '') AS status, 'Unknown' AS wagon_type, wn_key
+FROM propagated
+WHERE propagated_route_id IS NOT NULL
+"""
+
+_ROUTE_ID_RESULT_COLUMNS = [
+    'wagon_number', 'invoice_number', 'route_id', 'batch_id', 'departure_station', 'destination_station',
+    'departure_date', 'report_date', 'arrival_date', 'status', 'wagon_type'
+]
+
+_ROUTE_ID_CHANGED_SQL = " OR ".join(f"w.{col} IS NOT r.{col}" for col in _ROUTE_ID_RESULT_COLUMNS)
+
+@_write_operation
+def map_route_ids_in_database() -> Dict[str, int]:
+    """
+    Compute the route IDs of the whole STG history inside SQLite and write them
+    straight into wagon_invoices, without loading rows into pandas.
+    Uses the batch IDs stored in stg_data, so run the batch walk over the history
+    first (FileProcessor.assign_history_batch_ids). Like sync_wagon_invoices only
+    changed rows are written. Returns the same change summary.
+    """
+    session = get_session()
+    
+    try:
+        if not session.query(ZNP.id).first():
+            raise ValueError("No ZNP data found in the database. Please import ZNP data first.")
+        
+        conn = session.connection()
+        conn.execute(text("DROP TABLE IF EXISTS temp.route_id_results"))
+        conn.execute(text(_ROUTE_ID_RESULTS_SQL))
+        conn.execute(text("CREATE UNIQUE INDEX temp.ix_route_id_results_wn_key ON route_id_results (wn_key)"))
+        
+        total = conn.execute(text("SELECT COUNT(*) FROM route_id_results")).scalar()
+        inserted = conn.execute(text(
+            "SELECT COUNT(*) FROM route_id_results r "
+            "WHERE NOT EXISTS (SELECT 1 FROM wagon_invoices w WHERE w.wn_key = r.wn_key)"
+        )).scalar()
+        updated = conn.execute(text(
+            "SELECT COUNT(*) FROM route_id_results r JOIN wagon_invoices w ON w.wn_key = r.wn_key "
+            f"WHERE {_ROUTE_ID_CHANGED_SQL}"
+        )).scalar()
+        
+        deleted = conn.execute(text(
+            "DELETE FROM wagon_invoices WHERE wn_key IS NULL "
+            "OR wn_key NOT IN (SELECT wn_key FROM route_id_results)"
+        )).rowcount
+        columns = ", ".join(_ROUTE_ID_RESULT_COLUMNS + ['wn_key'])
+        conn.execute(text(
+            f"INSERT INTO wagon_invoices ({columns}) SELECT {columns} FROM route_id_results r WHERE true "
+            "ON CONFLICT (wn_key) DO UPDATE SET "
+            + ", ".join(f"{col} = excluded.{col}" for col in _ROUTE_ID_RESULT_COLUMNS)
+            + " WHERE " + " OR ".join(
+                f"wagon_invoices.{col} IS NOT excluded.{col}" for col in _ROUTE_ID_RESULT_COLUMNS
+            )
+        ))
+        conn.execute(text("DROP TABLE temp.route_id_results"))
+        session.commit()
+        
+        summary = {
+            'inserted': inserted,
+            'updated': updated,
+            'deleted': deleted,
+            'unchanged': total - inserted - updated,
+            'total': total
+        }
+        logger.info(f"Mapped route IDs in the database: {summary}")
+        return summary
+    except BaseException as e:
+        session.rollback()
+        logger.error(f"Error mapping route IDs in the database: {str(e)}")
+        raise
+
+@_write_operation
+def shift_wagon_invoice_batches(shifts: List[Tuple[int, Optional[int], int]]) -> int:
+    """
+    Move the stored batch IDs of wagons in open ranges (low, high) by a fixed amount,
+    for wagons whose batches were renumbered but not recomputed. high None means
+    no upper bound. Returns the number of rows updated.
+    """
+    session = get_session()
+    
+    try:
+        updated = 0
+        for low, high, shift in shifts:
+            if not shift:
+                continue
+            query = session.query(WagonInvoice).filter(WagonInvoice.batch_id > 0, WagonInvoice.wagon_number > low)
+            if high is not None:
+                query = query.filter(WagonInvoice.wagon_number < high)
+            updated += query.update({WagonInvoice.batch_id: WagonInvoice.batch_id + shift}, synchronize_session=False)
+        session.commit()
+        return updated
+    except BaseException as e:
+        session.rollback()
+        logger.error(f"Error shifting wagon invoice batches: {str(e)}")
+        raise
+
+def get_route_dirty_wagons() -> pd.DataFrame:
+    """Return the wagons marked for route ID recomputation with their recorded ГРУЖ counts, by wagon."""
+    session = get_session()
+    query = session.query(RouteDirtyWagon.wagon_number, RouteDirtyWagon.loaded_count).order_by(
+        RouteDirtyWagon.wagon_number
+    )
+    return pd.read_sql(query.statement, session.connection())
+
+@_write_operation
+def clear_route_dirty_wagons(wagons: Optional[Iterable[int]] = None) -> int:
+    """Remove the marks of the given wagons, or all marks. Returns the number removed."""
+    session = get_session()
+    
+    try:
+        query = session.query(RouteDirtyWagon)
+        if wagons is None:
+            removed = query.delete(synchronize_session=False)
+        else:
+            wagons = [int(wagon) for wagon in wagons]
+            removed = 0
+            for start in range(0, len(wagons), DEPENDENCY_CHUNK_SIZE):
+                removed += query.filter(
+                    RouteDirtyWagon.wagon_number.in_(wagons[start:start + DEPENDENCY_CHUNK_SIZE])
+                ).delete(synchronize_session=False)
+        session.commit()
+        return removed
+    except BaseException as e:
+        session.rollback()
+        logger.error(f"Error clearing route marks: {str(e)}")
+        raise
+
 def get_route_id_data() -> pd.DataFrame:
     """
     Get route ID data for the expense processor.
     This provides the same data as the "Route ID.csv" file.
+    The scan runs on DuckDB when that query engine is selected.
     """
     session = get_session()
+    
+    engine = _history_engine()
+    if engine is not None:
+        return engine.query(
+            'SELECT route_id AS "ЗНП", wagon_number AS "Вагон №", invoice_number AS "Накладная №" '
+            f"FROM {engine.table('wagon_invoices')} ORDER BY id"
+        )
+    
     records = session.query(WagonInvoice).all()
     
     data = [{
@@ -394,12 +1088,25 @@ def get_route_id_data() -> pd.DataFrame:
         'Накладная №': record.invoice_number
     } for record in records]
     
-    return pd.DataFrame(data)
+    return pd.DataFrame(data, columns=['ЗНП', 'Вагон №', 'Накладная №'])
 
 # Logging operations
 def log_operation(operation: str, status: str, file_name: Optional[str] = None, 
                  message: Optional[str] = None) -> None:
-    """Log an operation to the database."""
+    """
+    Log an operation to the database.
+    With the audit log started the entry is only queued; otherwise it is
+    committed right away.
+    """
+    if _audit_log is not None:
+        _audit_log.write(operation, status, file_name, message)
+        return
+    _add_log_entry(operation, status, file_name, message)
+
+@_write_operation
+def _add_log_entry(operation: str, status: str, file_name: Optional[str] = None,
+                   message: Optional[str] = None) -> None:
+    """Commit one log entry on the session."""
     session = get_session()
     
     try:
@@ -415,18 +1122,102 @@ def log_operation(operation: str, status: str, file_name: Optional[str] = None,
         session.rollback()
         logger.error(f"Error logging operation: {str(e)}")
 
+def get_processing_logs(limit: int = 200, before_id: Optional[int] = None,
+                        operation: Optional[str] = None, status: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Get one page of processing log entries, newest first.
+    Pass the smallest id of a page as before_id to get the next, older page;
+    operation and status filter on their indexes.
+    """
+    session = get_session()
+    
+    query = session.query(
+        ProcessingLog.id, ProcessingLog.timestamp, ProcessingLog.operation,
+        ProcessingLog.status, ProcessingLog.file_name, ProcessingLog.message
+    )
+    if before_id is not None:
+        query = query.filter(ProcessingLog.id < before_id)
+    if operation is not None:
+        query = query.filter(ProcessingLog.operation == operation)
+    if status is not None:
+        query = query.filter(ProcessingLog.status == status)
+    
+    return [row._asdict() for row in query.order_by(ProcessingLog.id.desc()).limit(limit)]
+
+@_write_operation
+def add_run_metrics(run_id: str, records: List[Dict[str, Any]]) -> int:
+    """
+    Persist the stage measurements of one pipeline run.
+    Returns the number of records added.
+    """
+    session = get_session()
+    
+    try:
+        session.add_all([RunMetric(run_id=run_id, **record) for record in records])
+        session.commit()
+        return len(records)
+    except BaseException as e:
+        session.rollback()
+        logger.error(f"Error adding run metrics: {str(e)}")
+        raise
+
+def get_run_metrics(run_id: Optional[str] = None) -> pd.DataFrame:
+    """Get stage measurements, optionally for a single run, as a DataFrame."""
+    session = get_session()
+    query = session.query(RunMetric)
+    if run_id:
+        query = query.filter(RunMetric.run_id == run_id)
+    
+    data = [{
+        'run_id': record.run_id,
+        'stage': record.stage,
+        'file_name': record.file_name,
+        'depth': record.depth,
+        'started_at': record.started_at,
+        'wall_seconds': record.wall_seconds,
+        'cpu_seconds': record.cpu_seconds,
+        'rows_in': record.rows_in,
+        'rows_out': record.rows_out,
+        'peak_memory_bytes': record.peak_memory_bytes,
+        'rss_bytes': record.rss_bytes
+    } for record in query.order_by(RunMetric.id).all()]
+    
+    return pd.DataFrame(data)
+
+def _stg_partition_filter(partitions: Iterable[Tuple[int, int]]):
+    """Return a filter selecting the given (year, month) partitions of the STG history."""
+    return tuple_(STGData.year, STGData.month).in_([(int(year), int(month)) for year, month in partitions])
+
+@_write_operation
 def add_stg_data(df):
-    """Add STG data to the database from a pandas DataFrame."""
+    """
+    Add STG data to the database from a pandas DataFrame.
+    Only the (year, month) partitions present in the frame are replaced; other
+    months are not rewritten, except that a (wagon, invoice) key loaded again
+    moves to the partition of its new row.
+    """
+    session = get_session()
+    
     try:
-        # Create a new session
-        session = SessionFactory()
+        keys = wn_keys(session.connection(), df['wagon_number'], df['invoice_number'])
+        years = pd.to_datetime(df['report_date'], errors='coerce').dt.year
+        partitions = sorted({
+            (int(year), int(month)) for year, month in zip(years, df['month'])
+            if pd.notna(year) and pd.notna(month)
+        })
         
-        # Clear existing STG data
-        session.query(STGData).delete()
+        # Clear the partitions being loaded and the rows the frame replaces
+        if partitions:
+            session.query(STGData).filter(_stg_partition_filter(partitions)).delete(synchronize_session=False)
+        loaded_keys = [int(key) for key in keys if key >= 0]
+        for start in range(0, len(loaded_keys), 500):
+            session.query(STGData).filter(
+                STGData.wn_key.in_(loaded_keys[start:start + 500])
+            ).delete(synchronize_session=False)
         
         # Convert DataFrame rows to STGData objects
         stg_objects = []
-        for _, row in df.iterrows():
+        for key, year, (_, row) in zip(keys, years, df.iterrows()):
             try:
                 stg_data = STGData(
                     wagon_number=None if pd.isna(row['wagon_number']) else int(row['wagon_number']),
@@ -443,9 +1234,10 @@ def add_stg_data(df):
                     shipper=row['shipper'],
                     consignee=row['consignee'],
                     repair_wait_time=None if pd.isna(row['repair_wait_time']) else float(row['repair_wait_time']),
-                    wn_code=row['wn_code'],
+                    wn_key=int(key) if key >= 0 else None,
                     batch_id=None if pd.isna(row['batch_id']) else int(row['batch_id']),
                     month=None if pd.isna(row['month']) else int(row['month']),
+                    year=None if pd.isna(year) else int(year),
                     route_id=row['route_id']
                 )
                 stg_objects.append(stg_data)
@@ -456,19 +1248,254 @@ def add_stg_data(df):
         # Bulk save the objects
         if stg_objects:
             session.bulk_save_objects(stg_objects)
+            _bump_stg_history_version(session)
             session.commit()
-            logger.info(f"Added {len(stg_objects)} records to STG data")
+            logger.info(f"Added {len(stg_objects)} records to STG partitions {partitions}")
         else:
             logger.warning("No valid records to add to STG data")
             
     except Exception as e:
         logger.error(f"Error adding STG data: {str(e)}")
-        if session:
-            session.rollback()
+        session.rollback()
+        raise
+
+# Columns of the STG history written by upsert_stg_data
+STG_HISTORY_COLUMNS = [
+    'wagon_number', 'invoice_number', 'departure_station', 'destination_station',
+    'departure_arrival', 'report_date', 'destination_arrival', 'load_status', 'wagon_type',
+    'distance', 'owner', 'shipper', 'consignee', 'repair_wait_time', 'wn_key', 'month', 'year'
+]
+
+def _bump_stg_history_version(session: Session) -> int:
+    """
+    Increase the STG history version in reference_versions within the caller's
+    transaction, so cached pipeline stages that read the history are recomputed.
+    """
+    return _bump_reference_version(session, 'stg_data', session.query(func.count(STGData.id)).scalar())
+
+@_write_operation
+def upsert_stg_data(df: pd.DataFrame, source_path: Optional[str] = None,
+                    content_hash: Optional[str] = None) -> int:
+    """
+    Apply STG rows to the history table in one transaction.
+    A row replaces the stored row with the same (wagon, invoice) key only when its
+    report date is the same or later, so the merge costs O(new rows).
+    Expects the English column names produced by prepare_stg_frame; the wn_key
+    column is computed here when ingestion has not added it.
+    When the rows come from a file, pass its content hash to record it as ingested.
+    Returns the number of rows applied.
+    """
+    session = get_session()
+    
+    if df.empty:
+        return 0
+    
+    try:
+        data = df.dropna(subset=["wagon_number", "invoice_number", "report_date"])
+        if "wn_key" not in data.columns:
+            data = data.assign(wn_key=get_wn_keys(data["wagon_number"], data["invoice_number"]))
+        if "year" not in data.columns:
+            data = data.assign(year=pd.to_datetime(data["report_date"]).dt.year)
+        data = data[data["wn_key"] >= 0]
+        frame = data[STG_HISTORY_COLUMNS].astype(object)
+        records = frame.where(frame.notna(), None).to_dict('records')
+        
+        if records:
+            stmt = sqlite_insert(STGData.__table__)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['wn_key'],
+                set_={col: stmt.excluded[col] for col in STG_HISTORY_COLUMNS if col != 'wn_key'},
+                where=stmt.excluded.report_date >= STGData.__table__.c.report_date
+            )
+            session.execute(stmt, records)
+        
+        if content_hash:
+            session.add(STGFile(file_path=source_path or "", content_hash=content_hash,
+                                row_count=len(records)))
+        if records:
+            _bump_stg_history_version(session)
+        session.commit()
+        
+        log_operation("upsert_stg_data", "SUCCESS", f"Applied {len(records)} records")
+        return len(records)
+    
+    except Exception as e:
+        session.rollback()
+        log_operation("upsert_stg_data", "ERROR", str(e))
+        raise
+
+# reference_versions entry for the history snapshot file last imported into, or written from, stg_data
+STG_SNAPSHOT_TABLE = 'stg_snapshot'
+
+def is_history_snapshot_imported(content_hash: str) -> bool:
+    """Return True when the STG history already holds every row of the snapshot with this content hash."""
+    return is_reference_unchanged(STG_SNAPSHOT_TABLE, content_hash)
+
+@_write_operation
+def record_history_snapshot(snapshot_path: str, content_hash: str, row_count: int) -> int:
+    """
+    Record a history snapshot file as contained in the STG history, after it was
+    imported into stg_data or written from it. Returns the snapshot version.
+    """
+    session = get_session()
+    
+    try:
+        version = _bump_reference_version(session, STG_SNAPSHOT_TABLE, row_count, snapshot_path, content_hash)
+        session.commit()
+        return version
+    except BaseException as e:
+        session.rollback()
+        logger.error(f"Error recording history snapshot {snapshot_path}: {str(e)}")
         raise
-    finally:
-        if session:
-            session.close()
+
+def is_stg_file_ingested(content_hash: str) -> bool:
+    """Return True when an STG file with this content hash was already applied to the history."""
+    session = get_session()
+    return session.query(STGFile.id).filter(STGFile.content_hash == content_hash).first() is not None
+
+def get_route_counts(year: Optional[int] = None, month: Optional[int] = None) -> pd.DataFrame:
+    """
+    Read the loaded-wagon count of each route from the route_counts aggregate,
+    optionally for one report (year, month), with the column names of the ZNP Routes tab.
+    """
+    session = get_session()
+    
+    query = session.query(
+        RouteCount.year.label("Год"),
+        RouteCount.month.label("Месяц"),
+        RouteCount.departure_station.label("Ст. отправления"),
+        RouteCount.destination_station.label("Ст. назначения"),
+        RouteCount.wagon_type.label("Тип вагона"),
+        RouteCount.count.label("Количество")
+    )
+    if year is not None:
+        query = query.filter(RouteCount.year == year)
+    if month is not None:
+        query = query.filter(RouteCount.month == month)
+    query = query.order_by(RouteCount.year, RouteCount.month,
+                           RouteCount.departure_station, RouteCount.destination_station)
+    
+    df = pd.read_sql(query.statement, session.connection())
+    # Rows without a report year or month are stored under 0
+    for col in ("Год", "Месяц"):
+        df[col] = df[col].astype("Int64").mask(df[col] == 0)
+    return df
+
+def get_route_count_periods() -> List[Tuple[int, int]]:
+    """Return the report (year, month) periods present in the route_counts aggregate."""
+    session = get_session()
+    rows = session.query(RouteCount.year, RouteCount.month).filter(
+        RouteCount.year != 0, RouteCount.month != 0
+    ).distinct().order_by(RouteCount.year, RouteCount.month)
+    return [(row[0], row[1]) for row in rows]
+
+def count_stg_history() -> int:
+    """Return the number of rows in the STG history."""
+    session = get_session()
+    return session.query(func.count(STGData.id)).scalar()
+
+def get_stg_partitions() -> List[Tuple[int, int]]:
+    """Return the (year, month) partitions present in the STG history, oldest first."""
+    session = get_session()
+    rows = session.query(STGData.year, STGData.month).filter(
+        STGData.year.isnot(None), STGData.month.isnot(None)
+    ).distinct().order_by(STGData.year, STGData.month)
+    return [(row.year, row.month) for row in rows]
+
+def get_stg_history(partitions: Optional[Iterable[Tuple[int, int]]] = None) -> pd.DataFrame:
+    """
+    Read the STG history with the English column names used by the pipeline,
+    optionally only the given (year, month) partitions.
+    Dates come back as stored; run the result through prepare_stg_frame.
+    The scan runs on DuckDB when that query engine is selected.
+    """
+    session = get_session()
+    
+    if partitions is not None:
+        partitions = list(partitions)
+    engine = _history_engine()
+    if engine is not None and partitions != []:
+        columns = ", ".join(f"s.{col}" for col in STG_HISTORY_COLUMNS)
+        join = partition_join(partitions) if partitions is not None else ""
+        return engine.query(f"SELECT {columns} FROM {engine.table('stg_data')} s {join} ORDER BY s.id")
+    
+    table = STGData.__table__
+    query = session.query(*[table.c[col] for col in STG_HISTORY_COLUMNS])
+    if partitions is not None:
+        query = query.filter(_stg_partition_filter(partitions))
+    query = query.order_by(table.c.id)
+    return pd.read_sql(query.statement, session.connection())
+
+def iter_stg_history_by_wagon(chunk_rows: int,
+                              partitions: Optional[Iterable[Tuple[int, int]]] = None) -> Iterator[pd.DataFrame]:
+    """
+    Read the STG history in (wagon, report date) order, chunk_rows rows at a time.
+    Ties keep insertion order, matching a stable sort of get_stg_history; rows
+    without a wagon or report date are skipped. Each chunk is a separate keyset
+    query on the wagon index, so no cursor stays open between chunks and callers
+    may write back (see update_stg_batch_ids) as they go. Chunks carry the row 'id'.
+    """
+    session = get_session()
+    
+    table = STGData.__table__
+    order = (table.c.wagon_number, table.c.report_date, table.c.id)
+    query = session.query(table.c.id, *[table.c[col] for col in STG_HISTORY_COLUMNS]).filter(
+        table.c.wagon_number.isnot(None), table.c.report_date.isnot(None)
+    )
+    if partitions is not None:
+        query = query.filter(_stg_partition_filter(partitions))
+    query = query.order_by(*order)
+    
+    last_key = None
+    while True:
+        page = query if last_key is None else query.filter(tuple_(*order) > tuple_(*last_key))
+        rows = page.limit(chunk_rows).all()
+        if not rows:
+            return
+        last_key = (rows[-1].wagon_number, rows[-1].report_date, rows[-1].id)
+        yield pd.DataFrame(rows, columns=['id'] + STG_HISTORY_COLUMNS)
+        if len(rows) < chunk_rows:
+            return
+
+@_write_operation
+def update_stg_batch_ids(ids, batch_ids) -> int:
+    """Write batch IDs back to STG history rows by row id. Returns the number of rows updated."""
+    session = get_session()
+    
+    params = [
+        {"row_id": int(row_id), "batch_id": None if pd.isna(batch_id) else int(batch_id)}
+        for row_id, batch_id in zip(ids, batch_ids)
+    ]
+    if params:
+        session.execute(text("UPDATE stg_data SET batch_id = :batch_id WHERE id = :row_id"), params)
+        session.commit()
+    return len(params)
+
+def get_stg_history_for_wagons(wagons: Iterable[int]) -> pd.DataFrame:
+    """Read the STG history rows of the given wagons, like get_stg_history."""
+    session = get_session()
+    
+    table = STGData.__table__
+    wagons = [int(wagon) for wagon in wagons]
+    frames = []
+    for start in range(0, len(wagons), DEPENDENCY_CHUNK_SIZE):
+        query = session.query(*[table.c[col] for col in STG_HISTORY_COLUMNS]).filter(
+            table.c.wagon_number.in_(wagons[start:start + DEPENDENCY_CHUNK_SIZE])
+        ).order_by(table.c.id)
+        frames.append(pd.read_sql(query.statement, session.connection()))
+    
+    if not frames:
+        return pd.DataFrame(columns=STG_HISTORY_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+def get_loaded_counts_by_wagon() -> pd.Series:
+    """Return the number of ГРУЖ rows of each wagon in the STG history, indexed by wagon in order."""
+    session = get_session()
+    rows = session.execute(text(
+        "SELECT wagon_number, COUNT(*) FROM stg_data "
+        "WHERE load_status = 'ГРУЖ' AND wagon_number IS NOT NULL GROUP BY wagon_number ORDER BY wagon_number"
+    )).all()
+    return pd.Series([count for _, count in rows], index=[wagon for wagon, _ in rows], dtype='int64')
 
 def get_stg_data(filters: Dict[str, Any] = None) -> pd.DataFrame:
     """
@@ -481,8 +1508,12 @@ def get_stg_data(filters: Dict[str, Any] = None) -> pd.DataFrame:
         # Start with base query
         query = session.query(STGData)
         
-        # Apply filters if provided
+        # Apply filters if provided; year and month select partitions through the partition index
         if filters:
+            if 'partitions' in filters:
+                query = query.filter(_stg_partition_filter(filters['partitions']))
+            if 'year' in filters:
+                query = query.filter(STGData.year == filters['year'])
             if 'month' in filters:
                 query = query.filter(STGData.month == filters['month'])
             if 'wagon_type' in filters:
@@ -514,7 +1545,7 @@ def get_stg_data(filters: Dict[str, Any] = None) -> pd.DataFrame:
                 'Грузоотправитель': result.shipper,
                 'Грузополучатель': result.consignee,
                 'Простой в ожидании ремонта': result.repair_wait_time,
-                'W&N': result.wn_code,
+                'W&N': result.wn_key,
                 'Batch ID': result.batch_id,
                 'Месяц': result.month,
                 'Final RouteID': result.route_id
@@ -526,6 +1557,25 @@ def get_stg_data(filters: Dict[str, Any] = None) -> pd.DataFrame:
         log_operation("get_stg_data", "ERROR", str(e))
         raise
 
+def _apply_stg_wagon_types(session: Session, changes: List[Dict[str, Any]]) -> int:
+    """Rename STG wagon types within the caller's transaction. Returns the records updated."""
+    updated_count = 0
+    for change in changes:
+        # Update matching records
+        result = session.query(STGData).filter(
+            STGData.month == change['Месяц'],
+            STGData.departure_station == change['Ст. отправления'],
+            STGData.destination_station == change['Ст. назначения'],
+            STGData.wagon_type == change['old_wagon_type']
+        ).update({'wagon_type': change['new_wagon_type']})
+        
+        updated_count += result
+    
+    if updated_count:
+        _bump_stg_history_version(session)
+    return updated_count
+
+@_write_operation
 def update_stg_wagon_types(changes: List[Dict[str, Any]]) -> int:
     """
     Update wagon types in STG data based on provided changes.
@@ -534,18 +1584,7 @@ def update_stg_wagon_types(changes: List[Dict[str, Any]]) -> int:
     session = get_session()
     
     try:
-        updated_count = 0
-        for change in changes:
-            # Update matching records
-            result = session.query(STGData).filter(
-                STGData.month == change['Месяц'],
-                STGData.departure_station == change['Ст. отправления'],
-                STGData.destination_station == change['Ст. назначения'],
-                STGData.wagon_type == change['old_wagon_type']
-            ).update({'wagon_type': change['new_wagon_type']})
-            
-            updated_count += result
-        
+        updated_count = _apply_stg_wagon_types(session, changes)
         session.commit()
         log_operation("update_stg_wagon_types", "SUCCESS", f"Updated {updated_count} records")
         
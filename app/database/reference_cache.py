@@ -0,0 +1,66 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+class ReferenceCache:
+    """
+    Process-wide cache of reference table frames and lookups derived from them.
+    Each entry remembers the table version it was loaded at and is reloaded
+    when the version stored in the database has moved on, whether the change
+    came from this process or another one. Writers also call invalidate() to
+    free entries early.
+    """
+
+    def __init__(self):
+        self._frames: Dict[str, Tuple[int, pd.DataFrame]] = {}
+        self._derived: Dict[Tuple[str, str], Tuple[int, Any]] = {}
+        self._lock = threading.RLock()
+
+    def get_frame(self, table_name: str, loader: Callable[[], pd.DataFrame],
+                  version_loader: Callable[[], int]) -> pd.DataFrame:
+        """
+        Return a copy of the cached frame for a table, loading it on first use and
+        whenever the table's current version differs from the cached one.
+        Callers may modify the returned frame freely.
+        """
+        with self._lock:
+            # The version is read before the rows, so an entry is never newer than its version
+            version = version_loader()
+            entry = self._frames.get(table_name)
+            if entry is None or entry[0] != version:
+                entry = (version, loader())
+                self._frames[table_name] = entry
+                logger.debug(f"Cached {table_name} at version {version} ({len(entry[1])} rows)")
+            return entry[1].copy()
+
+    def get_derived(self, table_name: str, name: str, frame_loader: Callable[[], pd.DataFrame],
+                    builder: Callable[[pd.DataFrame], Any], version_loader: Callable[[], int]) -> Any:
+        """
+        Return an object (e.g. a keyed frame) built from a table's frame.
+        It is built once per table version and shared, so callers must not modify it.
+        """
+        with self._lock:
+            version = version_loader()
+            entry = self._derived.get((table_name, name))
+            if entry is None or entry[0] != version:
+                entry = (version, builder(frame_loader()))
+                self._derived[(table_name, name)] = entry
+            return entry[1]
+
+    def invalidate(self, table_name: Optional[str] = None) -> None:
+        """Drop the cached frame and derived lookups of one table, or of all tables."""
+        with self._lock:
+            if table_name is None:
+                self._frames.clear()
+                self._derived.clear()
+                return
+            self._frames.pop(table_name, None)
+            for key in [key for key in self._derived if key[0] == table_name]:
+                del self._derived[key]
+
+# Shared by every reader and writer in the process
+reference_cache = ReferenceCache()
@@ -0,0 +1,63 @@
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+class DatabaseWriter:
+    """
+    Thread that runs database writes one at a time, in the order they were submitted.
+    SQLite allows one writer; sending every commit through this thread means
+    writers queue here instead of failing with "database is locked", while other
+    threads keep reading on their own sessions.
+    """
+
+    def __init__(self, on_exit: Optional[Callable[[], None]] = None, name: str = "database-writer"):
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._on_exit = on_exit
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def is_writer_thread(self) -> bool:
+        """Return True when called from the writer thread itself."""
+        return threading.current_thread() is self._thread
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> Future:
+        """Queue a write and return a future for its result."""
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run a write on the writer thread and wait for it; its exception is raised here."""
+        return self.submit(func, *args, **kwargs).result()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Finish the queued writes, then stop the thread."""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+
+                future, func, args, kwargs = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            if self._on_exit is not None:
+                try:
+                    self._on_exit()
+                except Exception as e:
+                    logger.warning(f"Error closing the writer session: {str(e)}")
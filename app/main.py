@@ -7,43 +7,47 @@ import pandas as pd
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QTabWidget, QWidget,
                           QVBoxLayout, QPushButton, QLabel, QTableView,
                           QMessageBox, QFileDialog, QProgressBar, QGroupBox,
-                          QHBoxLayout, QLineEdit, QTextEdit)
+                          QHBoxLayout, QLineEdit, QTextEdit, QComboBox)
 from PyQt5.QtCore import Qt, QThread, pyqtSignal
 from PyQt5.QtGui import QStandardItemModel, QStandardItem, QIcon
 import json
 import numpy as np
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-import glob
 
-from app.database.models import Base
+from app.database.models import init_db
+from app.database.analytics import init_query_engine
 from app.database.operations import (
-    add_znp_data, get_znp_data, get_exceptions, add_exceptions,
-    get_overrides, add_overrides, add_active_routes, get_active_routes,
-    get_matrix_mappings, add_matrix_mappings, init_session, add_stg_data,
-    get_database_path
+    get_znp_data, lookup_znp_codes, get_exceptions, add_exceptions,
+    get_overrides, add_overrides, get_active_routes,
+    get_matrix_mappings, add_matrix_mappings, init_session, remove_session, start_writer, stop_writer, add_stg_data,
+    start_audit_log, stop_audit_log, flush_audit_log, get_processing_logs,
+    get_database_path, save_znp_route_edits, upsert_stg_data,
+    is_stg_file_ingested, get_route_counts, get_route_count_periods, get_wn_keys, get_route_id_data
 )
 
 from app.config import load_config, save_config
 from app.core.file_processor import FileProcessor
 from app.core.expense_processor import ExpenseProcessor
-from app.utils.file_utils import get_files_by_pattern, ensure_directory_exists
+from app.core.reference_loader import (
+    REFERENCE_FILE_TYPES, find_changed_files, parse_reference_files, write_reference_data, rows_per_second
+)
+from app.utils.file_utils import get_files_by_pattern, ensure_directory_exists, get_file_hash
 from app.utils.data_utils import read_excel_file, read_csv_file
+from app.utils.stg_schema import prepare_stg_frame, concat_stg_frames, set_category_value, STG_REQUIRED_COLUMNS
 
-# Set up logging
-log_dir = os.path.join(os.getenv('APPDATA'), 'Logistics Data Processor', 'logs')
-os.makedirs(log_dir, exist_ok=True)
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(os.path.join(log_dir, "logistics_processor.log")),
-        logging.StreamHandler()
-    ]
-)
+# Logging is set up by the entry point (main.setup_logging)
 logger = logging.getLogger(__name__)
 
+# Columns of the ZNP Routes table; only wagon type and ЗНП are editable
+ROUTE_HEADERS = ["Год", "Месяц", "Ст. отправления", "Ст. назначения", "Тип вагона", "Количество", "ЗНП"]
+ROUTE_WAGON_TYPE_COL = 4
+ROUTE_ZNP_COL = 6
+
+# Log entries shown per page of the Logs tab
+LOG_PAGE_SIZE = 200
+
+# Seconds the logs view waits for buffered log entries to be written
+LOG_FLUSH_TIMEOUT = 2.0
+
 class LogisticsProcessorApp(QMainWindow):
     """
     Main application window for the Logistics Processor.
@@ -60,18 +64,25 @@ class LogisticsProcessorApp(QMainWindow):
         if os.path.exists(icon_path):
             self.setWindowIcon(QIcon(icon_path))
         
-        # Initialize database
+        # Initialize database; worker threads get their own sessions on the same
+        # engine and every write is committed on the writer thread
         db_path = get_database_path()
-        engine = create_engine(f'sqlite:///{db_path}')
-        Base.metadata.create_all(engine)
-        Session = sessionmaker(bind=engine)
+        engine, Session = init_db(db_path)
         session = Session()
         init_session(session)
+        start_writer()
+        start_audit_log()
         
         # Initialize instance variables
         self.config = load_config()
+        init_query_engine(self.config.get("query_engine", "sqlite"), db_path)
         self.processed_stg_data = None
         
+        # ZNP Routes editor state: the loaded rows plus pending cell edits
+        self.routes_df = pd.DataFrame(columns=ROUTE_HEADERS)
+        self.route_edits = {}
+        self._loading_routes = False
+        
         # Set up the main widget and layout
         main_widget = QWidget()
         self.setCentralWidget(main_widget)
@@ -114,9 +125,7 @@ class LogisticsProcessorApp(QMainWindow):
         # ZNP Routes
         self.routes_table = QTableView()
         self.routes_model = QStandardItemModel()
-        self.routes_model.setHorizontalHeaderLabels([
-            "Месяц", "Ст. отправления", "Ст. назначения", "Тип вагона", "Количество", "ЗНП"
-        ])
+        self.routes_model.setHorizontalHeaderLabels(ROUTE_HEADERS)
         self.routes_table.setModel(self.routes_model)
         
         # Results
@@ -139,28 +148,22 @@ class LogisticsProcessorApp(QMainWindow):
         self.matrix_model = QStandardItemModel()
         self.matrix_table.setModel(self.matrix_model)
     
+    def closeEvent(self, event):
+        """Commit the queued database writes and log entries before the window closes."""
+        stop_writer()
+        stop_audit_log()
+        super().closeEvent(event)
+    
     def load_initial_data(self):
         """Load initial data into tables."""
         try:
-            # Load ZNP data
-            znp_data = get_znp_data()
-            if not znp_data.empty:
-                self.update_routes_table(znp_data)
-            
-            # Load exceptions
-            exceptions_data = get_exceptions()
-            if not exceptions_data.empty:
-                self.update_exceptions_table()
+            # Load routes from the route count aggregate
+            self.refresh_routes_table()
             
-            # Load overrides
-            overrides_data = get_overrides()
-            if not overrides_data.empty:
-                self.update_overrides_table()
-            
-            # Load matrix
-            matrix_data = get_matrix_mappings()
-            if not matrix_data.empty:
-                self.update_matrix_table()
+            # Each table is read once and handed to its view
+            self.update_exceptions_table(get_exceptions())
+            self.update_overrides_table(get_overrides())
+            self.update_matrix_table(get_matrix_mappings())
         
         except Exception as e:
             logger.error(f"Error loading initial data: {str(e)}")
@@ -213,6 +216,10 @@ class LogisticsProcessorApp(QMainWindow):
         self.process_stg_btn.clicked.connect(self.process_route_ids)
         process_layout.addWidget(self.process_stg_btn)
         
+        self.update_route_ids_btn = QPushButton("Update Changed Route IDs")
+        self.update_route_ids_btn.clicked.connect(self.update_changed_route_ids)
+        process_layout.addWidget(self.update_route_ids_btn)
+        
         self.stg_progress = QProgressBar()
         process_layout.addWidget(self.stg_progress)
         
@@ -252,21 +259,32 @@ class LogisticsProcessorApp(QMainWindow):
             
             # Log the data shape and columns for debugging
             logger.info(f"Processing batched data with shape: {batched_data.shape}")
-            logger.info(f"Available columns: {batched_data.columns.tolist()}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Available columns: {batched_data.columns.tolist()}")
             
             # Create FileProcessor instance
             processor = FileProcessor(self.config)
+            metrics = processor.start_run_metrics()
             
-            # First assign batch IDs if not already present
-            if 'batch_id' not in batched_data.columns:
-                batched_data = processor.assign_batch_ids(batched_data)
-                logger.info("Batch IDs assigned to data")
-            
-            # Map ZNP to batches using the updated data
-            final_data = processor.map_znp_to_batches(batched_data)
-            
-            # Export RouteID data with updated wagon types
-            output_path = processor.export_route_id_data(final_data)
+            try:
+                # First assign batch IDs if not already present
+                if 'batch_id' not in batched_data.columns:
+                    with metrics.stage("assign_batch_ids", rows_in=len(batched_data)) as stage:
+                        batched_data = processor.assign_batch_ids(batched_data)
+                        stage.rows_out = len(batched_data)
+                    logger.info("Batch IDs assigned to data")
+                
+                # Map ZNP to batches using the updated data
+                with metrics.stage("map_znp_to_batches", rows_in=len(batched_data)) as stage:
+                    final_data = processor.map_znp_to_batches(batched_data)
+                    stage.rows_out = len(final_data)
+                
+                # Export RouteID data with updated wagon types
+                with metrics.stage("export_route_id_data", rows_in=len(final_data)) as stage:
+                    output_path = processor.export_route_id_data(final_data)
+                    stage.rows_out = len(final_data)
+            finally:
+                processor.save_run_metrics()
             
             # Update the config with the new route_id_path
             self.config["route_id_path"] = output_path
@@ -277,6 +295,8 @@ class LogisticsProcessorApp(QMainWindow):
             self.stg_status.setStyleSheet("color: green")
             self.stg_output.append(f"Route ID data exported to: {output_path}")
             self.stg_output.append("Note: Any wagon type changes made in ZNP Routes tab have been applied.")
+            for record in metrics.records:
+                self.stg_output.append(f"{record.stage}: {record.wall_seconds:.2f}s ({record.rows_out} rows)")
             
             # Update the route_id_edit in the expense tab
             if hasattr(self, 'route_id_edit'):
@@ -292,6 +312,41 @@ class LogisticsProcessorApp(QMainWindow):
             # Re-enable the process button
             self.process_stg_btn.setEnabled(True)
     
+    def update_changed_route_ids(self):
+        """Recompute route IDs only for wagons affected by changes since the last run."""
+        try:
+            self.update_route_ids_btn.setEnabled(False)
+            self.stg_status.setText("Updating changed Route IDs...")
+            self.stg_output.clear()
+            
+            processor = FileProcessor(self.config)
+            summary = processor.update_route_ids()
+            self.stg_output.append(
+                f"Recomputed {summary['wagons']} wagons: {summary['inserted']} added, "
+                f"{summary['updated']} updated, {summary['deleted']} removed"
+            )
+            
+            # Rewrite the Route ID file from the stored table only when something changed
+            if summary['inserted'] or summary['updated'] or summary['deleted'] or summary['shifted']:
+                output_path = processor.export_route_id_data(get_route_id_data())
+                self.config["route_id_path"] = output_path
+                save_config(self.config)
+                if hasattr(self, 'route_id_edit'):
+                    self.route_id_edit.setText(output_path)
+                self.stg_output.append(f"Route ID data exported to: {output_path}")
+            
+            self.stg_status.setText("Route IDs are up to date")
+            self.stg_status.setStyleSheet("color: green")
+            
+        except Exception as e:
+            self.stg_status.setText(f"Error: {str(e)}")
+            self.stg_status.setStyleSheet("color: red")
+            self.stg_output.append(f"Error: {str(e)}")
+            logger.error(f"Error updating route IDs: {str(e)}")
+        
+        finally:
+            self.update_route_ids_btn.setEnabled(True)
+    
     def setup_expense_tab(self):
         """Set up the Expense processing tab."""
         layout = QVBoxLayout()
@@ -445,9 +500,9 @@ class LogisticsProcessorApp(QMainWindow):
         ref_layout.addLayout(matrix_layout)
         
         # Import button
-        import_btn = QPushButton("Import Reference Data")
-        import_btn.clicked.connect(self.import_reference_data)
-        ref_layout.addWidget(import_btn)
+        self.import_btn = QPushButton("Import Reference Data")
+        self.import_btn.clicked.connect(self.import_reference_data)
+        ref_layout.addWidget(self.import_btn)
         
         self.ref_progress = QProgressBar()
         ref_layout.addWidget(self.ref_progress)
@@ -552,13 +607,22 @@ class LogisticsProcessorApp(QMainWindow):
         table_group = QGroupBox("Route Management")
         table_layout = QVBoxLayout()
         
+        # Report month filter, served from the route count aggregate
+        filter_layout = QHBoxLayout()
+        filter_layout.addWidget(QLabel("Month:"))
+        self.routes_month_combo = QComboBox()
+        self.routes_month_combo.addItem("All months", None)
+        self.routes_month_combo.currentIndexChanged.connect(self.on_routes_month_changed)
+        filter_layout.addWidget(self.routes_month_combo)
+        filter_layout.addStretch()
+        table_layout.addLayout(filter_layout)
+        
         # Create table
         self.routes_table = QTableView()
         self.routes_model = QStandardItemModel()
-        self.routes_model.setHorizontalHeaderLabels([
-            "Месяц", "Ст. отправления", "Ст. назначения", "Тип вагона", "Количество", "ЗНП"
-        ])
+        self.routes_model.setHorizontalHeaderLabels(ROUTE_HEADERS)
         self.routes_table.setModel(self.routes_model)
+        self.routes_model.itemChanged.connect(self.on_route_item_changed)
         
         # Make ZNP and Wagon Type columns editable, others read-only
         self.routes_table.setEditTriggers(QTableView.DoubleClicked | QTableView.EditKeyPressed)
@@ -704,11 +768,16 @@ class LogisticsProcessorApp(QMainWindow):
         self.log_viewer.setReadOnly(True)
         layout.addWidget(self.log_viewer)
         
-        # Refresh button
+        # Refresh shows the newest page; older pages are appended on request
         refresh_button = QPushButton("Refresh Logs")
         refresh_button.clicked.connect(self.refresh_logs)
         layout.addWidget(refresh_button)
         
+        older_button = QPushButton("Load Older Logs")
+        older_button.clicked.connect(self.load_older_logs)
+        layout.addWidget(older_button)
+        self.oldest_log_id = None
+        
         self.logs_tab.setLayout(layout)
     
     # UI Event Handlers
@@ -758,7 +827,7 @@ class LogisticsProcessorApp(QMainWindow):
             return
         
         try:
-            # Process STG files and store in the correct format
+            # Process STG files; new files are added to the STG history on the way
             stg_data = self.process_stg_data()
             
             # Store the processed data in the expected dictionary format
@@ -767,11 +836,8 @@ class LogisticsProcessorApp(QMainWindow):
                 'processed_at': datetime.now().isoformat()
             }
             
-            # Generate routes
-            routes = self.generate_routes(stg_data)
-            
-            # Update routes table
-            self.update_routes_table(routes)
+            # Route counts are maintained in the database as rows are ingested
+            self.refresh_routes_table()
             
             QMessageBox.information(self, "Success", "Routes generated successfully.")
         except Exception as e:
@@ -779,69 +845,116 @@ class LogisticsProcessorApp(QMainWindow):
             logger.error(f"Error generating routes: {str(e)}")
             self.processed_stg_data = None  # Clear the data on error
     
+    def on_route_item_changed(self, item: QStandardItem):
+        """Record an edited ZNP / wagon type cell as a pending change."""
+        if self._loading_routes:
+            return
+        
+        row, col = item.row(), item.column()
+        if col not in (ROUTE_WAGON_TYPE_COL, ROUTE_ZNP_COL) or row >= len(self.routes_df):
+            return
+        
+        original = str(self.routes_df.iat[row, col])
+        new_value = item.text().strip()
+        
+        row_edits = self.route_edits.setdefault(row, {})
+        if new_value == original:
+            row_edits.pop(col, None)
+            if not row_edits:
+                del self.route_edits[row]
+        else:
+            row_edits[col] = new_value
+    
+    def current_routes_frame(self) -> pd.DataFrame:
+        """Return the loaded routes with any pending edits applied."""
+        df = self.routes_df.copy()
+        for row, row_edits in self.route_edits.items():
+            for col, value in row_edits.items():
+                df.iat[row, col] = value
+        return df
+    
     def save_znp_routes(self):
-        """Save ZNP routes to database and Excel."""
-        # Get data from model
-        routes_data = []
-        for row in range(self.routes_model.rowCount()):
-            try:
-                month = int(self.routes_model.item(row, 0).text())
-                count_text = self.routes_model.item(row, 4).text()
-                count = int(float(count_text)) if count_text.strip() else 0
-                
-                route = {
-                    "Месяц": month,
-                    "Ст. отправления": self.routes_model.item(row, 1).text(),
-                    "Ст. назначения": self.routes_model.item(row, 2).text(),
-                    "Тип вагона": self.routes_model.item(row, 3).text(),
-                    "Количество": count,
-                    "ЗНП": self.routes_model.item(row, 5).text()
-                }
-                routes_data.append(route)
-            except Exception as e:
-                logger.warning(f"Skipping invalid row {row}: {str(e)}")
-                continue
-        
-        if not routes_data:
-            QMessageBox.warning(self, "Error", "No valid route data to save")
+        """Persist only the edited ZNP routes and wagon types."""
+        if not self.route_edits:
+            QMessageBox.information(self, "No Changes", "There are no route changes to save")
             return
         
-        # Save to database
-        df = pd.DataFrame(routes_data)
-        add_znp_data(df)
+        znp_changes = []
+        wagon_type_changes = []
+        for row, row_edits in sorted(self.route_edits.items()):
+            original = self.routes_df.iloc[row]
+            old_wagon_type = str(original["Тип вагона"])
+            new_wagon_type = row_edits.get(ROUTE_WAGON_TYPE_COL, old_wagon_type)
+            
+            route_key = {
+                "Месяц": int(original["Месяц"]),
+                "Ст. отправления": str(original["Ст. отправления"]),
+                "Ст. назначения": str(original["Ст. назначения"])
+            }
+            znp_changes.append({
+                **route_key,
+                "old_wagon_type": old_wagon_type,
+                "Тип вагона": new_wagon_type,
+                "ЗНП": row_edits.get(ROUTE_ZNP_COL, str(original["ЗНП"]))
+            })
+            if new_wagon_type != old_wagon_type:
+                wagon_type_changes.append({
+                    **route_key,
+                    "old_wagon_type": old_wagon_type,
+                    "new_wagon_type": new_wagon_type
+                })
+        
+        # Keep the edited table for the export; the reload below merges renamed wagon types
+        df = self.current_routes_frame()
+        try:
+            save_znp_route_edits(znp_changes, wagon_type_changes)
+            if wagon_type_changes:
+                self.apply_wagon_type_changes(wagon_type_changes)
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Error saving routes: {str(e)}")
+            logger.error(f"Error saving routes: {str(e)}")
+            return
         
-        # Export to Excel
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_path = os.path.join(self.config.get("output_directory", ""), f"znp_routes_{timestamp}.xlsx")
-        df.to_excel(output_path, index=False)
+        # Edits are persisted; reload so merged wagon types show their combined counts
+        self.refresh_routes_table()
+        
+        try:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            output_path = os.path.join(self.config.get("output_directory", ""), f"znp_routes_{timestamp}.xlsx")
+            df.to_excel(output_path, index=False)
+        except Exception as e:
+            QMessageBox.warning(self, "Warning", f"Routes saved, but the export failed: {str(e)}")
+            logger.error(f"Error exporting routes: {str(e)}")
+            return
         
-        QMessageBox.information(self, "Success", f"Routes saved successfully.\nExported to: {output_path}")
+        QMessageBox.information(
+            self, "Success",
+            f"Saved {len(znp_changes)} changed routes.\nExported to: {output_path}"
+        )
+    
+    def apply_wagon_type_changes(self, changes: List[Dict[str, Any]]):
+        """Apply saved wagon type edits to the STG data kept in memory for Route ID generation."""
+        if not self.processed_stg_data or 'batched_data' not in self.processed_stg_data:
+            return
+        
+        stg_data = self.processed_stg_data['batched_data']
+        for change in changes:
+            mask = (
+                (stg_data["month"] == change["Месяц"]) &
+                (stg_data["departure_station"] == change["Ст. отправления"]) &
+                (stg_data["destination_station"] == change["Ст. назначения"]) &
+                (stg_data["wagon_type"] == change["old_wagon_type"])
+            )
+            set_category_value(stg_data, mask, "wagon_type", change["new_wagon_type"])
     
     def export_znp_routes(self):
         """Export ZNP routes to Excel."""
-        # Get data from model
-        routes_data = []
-        for row in range(self.routes_model.rowCount()):
-            try:
-                route = {
-                    "Месяц": int(self.routes_model.item(row, 0).text()),
-                    "Ст. отправления": self.routes_model.item(row, 1).text(),
-                    "Ст. назначения": self.routes_model.item(row, 2).text(),
-                    "Тип вагона": self.routes_model.item(row, 3).text(),
-                    "Количество": int(float(self.routes_model.item(row, 4).text())),
-                    "ЗНП": self.routes_model.item(row, 5).text()
-                }
-                routes_data.append(route)
-            except Exception as e:
-                logger.warning(f"Skipping invalid row {row}: {str(e)}")
-                continue
-        
-        if not routes_data:
+        if self.routes_df.empty:
             QMessageBox.warning(self, "Error", "No valid route data to export")
             return
         
         # Export to Excel
-        df = pd.DataFrame(routes_data)
+        df = self.current_routes_frame()
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         output_path = os.path.join(self.config.get("output_directory", ""), f"znp_routes_{timestamp}.xlsx")
         df.to_excel(output_path, index=False)
@@ -912,19 +1025,37 @@ class LogisticsProcessorApp(QMainWindow):
             logger.error(f"Error importing matrix: {str(e)}")
     
     def refresh_logs(self):
-        """Refresh the logs display."""
+        """Refresh the logs display with the newest page of log entries."""
         try:
-            # Get logs from database
-            logs = get_processing_logs()
-            
-            # Update log viewer
+            # Entries still buffered by the audit log are written first, without holding up the view
+            if not flush_audit_log(timeout=LOG_FLUSH_TIMEOUT):
+                logger.warning("Showing the logs without the entries still buffered by the audit log")
             self.log_viewer.clear()
-            for log in logs:
-                self.log_viewer.append(f"{log['timestamp']} - {log['operation']} - {log['status']} - {log['message']}")
+            self.oldest_log_id = None
+            self.append_logs(get_processing_logs(limit=LOG_PAGE_SIZE))
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Error refreshing logs: {str(e)}")
             logger.error(f"Error refreshing logs: {str(e)}")
     
+    def load_older_logs(self):
+        """Append the next page of older log entries."""
+        if self.oldest_log_id is None:
+            self.refresh_logs()
+            return
+        
+        try:
+            self.append_logs(get_processing_logs(limit=LOG_PAGE_SIZE, before_id=self.oldest_log_id))
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Error loading logs: {str(e)}")
+            logger.error(f"Error loading logs: {str(e)}")
+    
+    def append_logs(self, logs: List[Dict]):
+        """Append log entries to the log viewer and remember the oldest one shown."""
+        for log in logs:
+            self.log_viewer.append(f"{log['timestamp']} - {log['operation']} - {log['status']} - {log['message']}")
+        if logs:
+            self.oldest_log_id = logs[-1]['id']
+    
     # Helper Methods
     def update_results_table(self, df: pd.DataFrame):
         """Update the results table with processed data."""
@@ -947,53 +1078,62 @@ class LogisticsProcessorApp(QMainWindow):
     
     def update_routes_table(self, df: pd.DataFrame):
         """Update the routes table with generated routes."""
-        self.routes_model.clear()
-        
-        if df is None or df.empty:
-            return
-        
-        # Set headers
-        headers = ["Месяц", "Ст. отправления", "Ст. назначения", "Тип вагона", "Количество", "ЗНП"]
-        self.routes_model.setHorizontalHeaderLabels(headers)
-        
-        # Add data
-        for _, row in df.iterrows():
-            items = []
-            for col in headers:
-                try:
-                    val = row.get(col, "")
-                    # Handle special cases
-                    if col == "Количество" and pd.isna(val):
-                        val = 0
-                    elif pd.isna(val):
+        self._loading_routes = True
+        try:
+            self.routes_model.clear()
+            self.route_edits = {}
+            self.routes_df = pd.DataFrame(columns=ROUTE_HEADERS)
+            
+            if df is None or df.empty:
+                return
+            
+            # Set headers
+            headers = ROUTE_HEADERS
+            self.routes_model.setHorizontalHeaderLabels(headers)
+            
+            # Add data
+            rows = []
+            for _, row in df.iterrows():
+                values = []
+                for col in headers:
+                    try:
+                        val = row.get(col, "")
+                        # Handle special cases
+                        if col == "Количество" and pd.isna(val):
+                            val = 0
+                        elif pd.isna(val):
+                            val = ""
+                        elif col in ("Год", "Месяц", "Количество"):
+                            val = int(val)
+                        else:
+                            val = str(val)
+                    except Exception as e:
+                        logger.warning(f"Error processing column {col}: {str(e)}")
                         val = ""
-                    elif col == "Месяц":
-                        val = int(val)
-                    items.append(QStandardItem(str(val)))
-                except Exception as e:
-                    logger.warning(f"Error processing column {col}: {str(e)}")
-                    items.append(QStandardItem(""))
-            self.routes_model.appendRow(items)
-        
-        # Make only ZNP and wagon type columns editable
-        for row in range(self.routes_model.rowCount()):
-            for col in range(self.routes_model.columnCount()):
-                item = self.routes_model.item(row, col)
-                if item:
-                    if col not in [3, 5]:  # 3 is Тип вагона, 5 is ЗНП
-                        item.setEditable(False)
-                    else:
-                        item.setEditable(True)
-        
-        # Resize columns to content
-        self.routes_table.resizeColumnsToContents()
+                    values.append(val)
+                
+                items = [QStandardItem(str(val)) for val in values]
+                # Make only ZNP and wagon type columns editable
+                for col, item in enumerate(items):
+                    item.setEditable(col in (ROUTE_WAGON_TYPE_COL, ROUTE_ZNP_COL))
+                self.routes_model.appendRow(items)
+                rows.append(values)
+            
+            # Keep the loaded rows as the baseline that edits are diffed against
+            self.routes_df = pd.DataFrame(rows, columns=headers)
+            
+            # Resize columns to content
+            self.routes_table.resizeColumnsToContents()
+        finally:
+            self._loading_routes = False
     
-    def update_exceptions_table(self):
-        """Update the exceptions table."""
+    def update_exceptions_table(self, df: Optional[pd.DataFrame] = None):
+        """Update the exceptions table, reading it from the database unless a frame is given."""
         self.exceptions_model.clear()
         
         # Get exceptions from database
-        df = get_exceptions()
+        if df is None:
+            df = get_exceptions()
         
         if df.empty:
             return
@@ -1010,8 +1150,8 @@ class LogisticsProcessorApp(QMainWindow):
         # Resize columns to content
         self.exceptions_table.resizeColumnsToContents()
     
-    def update_overrides_table(self):
-        """Update the overrides table."""
+    def update_overrides_table(self, df: Optional[pd.DataFrame] = None):
+        """Update the overrides table, reading it from the database unless a frame is given."""
         try:
             if not hasattr(self, 'overrides_model') or not hasattr(self, 'overrides_table'):
                 return
@@ -1019,11 +1159,15 @@ class LogisticsProcessorApp(QMainWindow):
             self.overrides_model.clear()
             
             # Get overrides from database
-            df = get_overrides()
+            if df is None:
+                df = get_overrides()
             
             if df.empty:
                 return
             
+            # The packed key is internal
+            df = df.drop(columns=['wn_key'], errors='ignore')
+            
             # Set headers
             headers = list(df.columns)
             self.overrides_model.setHorizontalHeaderLabels(headers)
@@ -1042,8 +1186,8 @@ class LogisticsProcessorApp(QMainWindow):
         except Exception as e:
             logger.error(f"Error updating overrides table: {str(e)}")
     
-    def update_matrix_table(self):
-        """Update the matrix table."""
+    def update_matrix_table(self, df: Optional[pd.DataFrame] = None):
+        """Update the matrix table, reading it from the database unless a frame is given."""
         try:
             if not hasattr(self, 'matrix_model') or not hasattr(self, 'matrix_table'):
                 return
@@ -1051,7 +1195,8 @@ class LogisticsProcessorApp(QMainWindow):
             self.matrix_model.clear()
             
             # Get matrix from database
-            df = get_matrix_mappings()
+            if df is None:
+                df = get_matrix_mappings()
             
             if df.empty:
                 return
@@ -1075,13 +1220,8 @@ class LogisticsProcessorApp(QMainWindow):
             logger.error(f"Error updating matrix table: {str(e)}")
 
     def import_reference_data(self):
-        """Import all reference data files."""
+        """Import all reference data files in a background worker."""
         try:
-            # Initialize progress bar
-            self.ref_progress.setValue(0)
-            self.ref_status.setText("Starting import...")
-            self.ref_output.clear()
-            
             # Get file paths from text fields
             files = {
                 "znp": self.znp_edit.text(),
@@ -1096,76 +1236,83 @@ class LogisticsProcessorApp(QMainWindow):
             if missing_files:
                 raise ValueError(f"Following files not found: {', '.join(missing_files)}")
             
-            total_files = len([f for f in files.values() if f])
-            if total_files == 0:
+            if not any(files.values()):
                 raise ValueError("No files selected for import")
             
-            processed = 0
-            results = {}
-            
-            # Process each file
-            for file_type, file_path in files.items():
-                if not file_path:
-                    continue
-                    
-                try:
-                    self.ref_status.setText(f"Importing {file_type}...")
-                    progress = int((processed / total_files) * 100)
-                    self.ref_progress.setValue(progress)
-                    
-                    if file_type == "znp":
-                        df = pd.read_excel(file_path)
-                        count = add_znp_data(df)
-                        self.update_routes_table(df)
-                        results[file_type] = count
-                    elif file_type == "exceptions":
-                        df = pd.read_excel(file_path)
-                        count = add_exceptions(df)
-                        self.update_exceptions_table()
-                        results[file_type] = count
-                    elif file_type == "overrides":
-                        df = pd.read_excel(file_path)
-                        count = add_overrides(df)
-                        self.update_overrides_table()
-                        results[file_type] = count
-                    elif file_type == "active":
-                        df = pd.read_csv(file_path)
-                        routes = df.iloc[:, 0].astype(str).tolist()
-                        count = add_active_routes(routes)
-                        results[file_type] = count
-                    elif file_type == "matrix":
-                        df = pd.read_csv(file_path)
-                        count = add_matrix_mappings(df)
-                        self.update_matrix_table()
-                        results[file_type] = count
-                    
-                    processed += 1
-                    
-                except Exception as e:
-                    results[file_type] = f"Error: {str(e)}"
-                    logger.error(f"Error importing {file_type}: {str(e)}")
-            
-            # Update progress and status
-            self.ref_progress.setValue(100)
-            self.ref_status.setText("Import complete")
-            
-            # Show results
+            # Initialize progress bar
+            self.ref_progress.setValue(0)
+            self.ref_status.setText("Starting import...")
             self.ref_output.clear()
-            for file_type, result in results.items():
-                self.ref_output.append(f"{file_type.upper()}: {result}")
             
-            # Show success message if any files were processed successfully
-            if any(isinstance(v, int) for v in results.values()):
-                QMessageBox.information(self, "Success", "Reference data imported successfully.")
-            else:
-                QMessageBox.warning(self, "Warning", "Some or all imports failed. Check the results for details.")
-                
+            # Parse and write in a worker thread so the window stays responsive
+            self.reference_worker = ProcessingWorker("import_reference", {"files": files})
+            self.reference_worker.progress_update.connect(self.update_reference_progress)
+            self.reference_worker.process_complete.connect(self.reference_import_complete)
+            
+            self.import_btn.setEnabled(False)
+            self.reference_worker.start()
+        
         except Exception as e:
             self.ref_status.setText(f"Error: {str(e)}")
             self.ref_progress.setValue(0)
             QMessageBox.critical(self, "Error", f"Error importing reference data: {str(e)}")
             logger.error(f"Error importing reference data: {str(e)}")
-
+    
+    def update_reference_progress(self, value, message):
+        """Update reference import progress."""
+        self.ref_progress.setValue(value)
+        self.ref_status.setText(message)
+    
+    def reference_import_complete(self, success, message, results):
+        """Show the import results and refresh the tables that were rewritten."""
+        self.import_btn.setEnabled(True)
+        self.ref_progress.setValue(100)
+        self.ref_status.setText(message)
+        
+        self.ref_output.clear()
+        for file_type, result in results.items():
+            if "error" in result:
+                self.ref_output.append(f"{file_type.upper()}: Error: {result['error']}")
+            elif result.get("skipped"):
+                self.ref_output.append(f"{file_type.upper()}: unchanged, skipped (version {result['version']})")
+            else:
+                changes = result.get("changes")
+                if changes:
+                    self.ref_output.append(
+                        f"{file_type.upper()}: {changes['inserted']} inserted, {changes['updated']} updated, "
+                        f"{changes['deleted']} deleted, {changes['unchanged']} unchanged"
+                    )
+                self.ref_output.append(
+                    f"{file_type.upper()}: {result['count']} records "
+                    f"({result['rows']} rows parsed at {result['parse_rows_per_second']:.0f} rows/s, "
+                    f"written at {result['write_rows_per_second']:.0f} rows/s, version {result['version']})"
+                )
+        
+        # Refresh only the tables whose data changed
+        changed = {
+            file_type for file_type, result in results.items()
+            if "error" not in result and not result.get("skipped")
+            and (not result.get("changes")
+                 or any(result["changes"][k] for k in ("inserted", "updated", "deleted")))
+        }
+        try:
+            if "znp" in changed:
+                self.refresh_routes_table()
+            if "exceptions" in changed:
+                self.update_exceptions_table()
+            if "overrides" in changed:
+                self.update_overrides_table()
+            if "matrix" in changed:
+                self.update_matrix_table()
+        except Exception as e:
+            logger.error(f"Error refreshing reference tables: {str(e)}")
+        
+        # Show success message if any files were processed successfully
+        if success:
+            QMessageBox.information(self, "Success", "Reference data imported successfully.")
+        else:
+            QMessageBox.warning(self, "Warning", "Some or all imports failed. Check the results for details.")
+    
     def process_expense_files(self):
         """Process expense files with Route ID data."""
         expense_folder = self.expense_folder_edit.text()
@@ -1221,6 +1368,12 @@ class LogisticsProcessorApp(QMainWindow):
             self.expense_output.append(f"Processing completed successfully!")
             self.expense_output.append(f"Files processed: {result.get('processed_files', 0)}")
             self.expense_output.append(f"Files skipped: {result.get('skipped_files', 0)}")
+            if result.get('unkeyed_reference_rows') or result.get('unkeyed_expense_rows'):
+                self.expense_output.append(
+                    f"Rows without a wagon or invoice number: "
+                    f"{result.get('unkeyed_reference_rows', 0)} in the Route ID data, "
+                    f"{result.get('unkeyed_expense_rows', 0)} in the expense files"
+                )
             
             if result.get('error_files'):
                 self.expense_output.append("\nFiles with errors:")
@@ -1257,7 +1410,8 @@ class LogisticsProcessorApp(QMainWindow):
     
     def browse_existing_data(self):
         """Browse for existing data file."""
-        file, _ = QFileDialog.getOpenFileName(self, "Select Existing Data File", "", "Excel Files (*.xlsx *.xls)")
+        file, _ = QFileDialog.getOpenFileName(self, "Select Existing Data File", "",
+                                              "History Files (*.parquet *.xlsx *.xls)")
         if file:
             self.existing_data_edit.setText(file)
             self.config["existing_data_path"] = file
@@ -1327,89 +1481,32 @@ class LogisticsProcessorApp(QMainWindow):
             if not stg_folder or not os.path.exists(stg_folder):
                 raise ValueError(f"STG folder not found: {stg_folder}")
             
-            excel_files = glob.glob(os.path.join(stg_folder, "*.xlsx"))
+            # Same files as the STG workflow, so only daily STG exports reach the history
+            excel_files = get_files_by_pattern(stg_folder, "STGDaily_*.xlsx")
             if not excel_files:
-                raise ValueError(f"No Excel files found in {stg_folder}")
-            
-            # Define column mapping (Russian to English)
-            column_mapping = {
-                'Вагон №': 'wagon_number',
-                'Накладная №': 'invoice_number',
-                'Ст. отправления': 'departure_station',
-                'Ст. назначения': 'destination_station',
-                'Прибытие на ст. отправл.': 'departure_arrival',
-                'Отчетная дата': 'report_date',
-                'Прибытие на ст. назн.': 'destination_arrival',
-                'Груж\\пор': 'load_status',
-                'Тип вагона': 'wagon_type',
-                'Расстояние': 'distance',
-                'Собственник': 'owner',
-                'Грузоотправитель': 'shipper',
-                'Грузополучатель': 'consignee',
-                'Простой в ожидании ремонта': 'repair_wait_time'
-            }
+                raise ValueError(f"No STG daily files found in {stg_folder}")
             
-            # Read and combine all Excel files
+            # Import the history snapshot before the daily files, so the route counts cover the whole history
+            self.seed_stg_history()
+            
+            # Read all Excel files, applying the STG dtype plan and the (wagon, invoice) key to each one
             all_data = []
             for file in excel_files:
                 try:
-                    df = pd.read_excel(file)
-                    # Strip whitespace from column names
-                    df.columns = df.columns.str.strip()
+                    df = prepare_stg_frame(pd.read_excel(file))
+                    df["wn_key"] = get_wn_keys(df["wagon_number"], df["invoice_number"])
                     all_data.append(df)
                 except Exception as e:
                     logger.warning(f"Error reading file {file}: {str(e)}")
                     continue
+                
+                self.ingest_stg_file(file, df)
             
             if not all_data:
                 raise ValueError("No valid data found in Excel files")
             
-            # Combine all DataFrames
-            stg_data = pd.concat(all_data, ignore_index=True)
-            
-            # Create empty columns for any missing fields
-            for rus_col, eng_col in column_mapping.items():
-                if rus_col not in stg_data.columns:
-                    stg_data[rus_col] = ""
-            
-            # Rename columns using the mapping
-            stg_data = stg_data.rename(columns=column_mapping)
-            
-            # Handle string columns first
-            string_columns = ['invoice_number', 'departure_station', 'destination_station', 
-                            'load_status', 'wagon_type', 'owner', 'shipper', 'consignee']
-            for col in string_columns:
-                if col in stg_data.columns:
-                    stg_data[col] = stg_data[col].fillna('').astype(str)
-            
-            # Handle numeric columns
-            numeric_columns = {
-                'wagon_number': 0,
-                'distance': 0,
-                'repair_wait_time': 0
-            }
-            for col, default_value in numeric_columns.items():
-                if col in stg_data.columns:
-                    try:
-                        stg_data[col] = pd.to_numeric(stg_data[col], errors='coerce').fillna(default_value).astype(float)
-                    except Exception as e:
-                        logger.warning(f"Error converting column {col} to numeric: {str(e)}")
-            
-            # Handle datetime columns last
-            datetime_columns = ['report_date', 'departure_arrival', 'destination_arrival']
-            for col in datetime_columns:
-                if col in stg_data.columns:
-                    try:
-                        stg_data[col] = pd.to_datetime(stg_data[col], errors='coerce')
-                    except Exception as e:
-                        logger.warning(f"Error converting column {col} to datetime: {str(e)}")
-            
-            # Extract month from report_date
-            try:
-                stg_data['month'] = pd.to_datetime(stg_data['report_date']).dt.month
-            except Exception as e:
-                logger.warning(f"Error extracting month from report_date: {str(e)}")
-                stg_data['month'] = 0
+            # Combine all DataFrames, keeping the categorical columns
+            stg_data = concat_stg_frames(all_data)
             
             return stg_data
             
@@ -1417,88 +1514,75 @@ class LogisticsProcessorApp(QMainWindow):
             logger.error(f"Error processing STG data: {str(e)}")
             raise
 
-    def generate_routes(self, stg_data: pd.DataFrame) -> pd.DataFrame:
-        """Generate route suggestions from STG data."""
-        if stg_data is None or stg_data.empty:
-            raise ValueError("No STG data available for route generation")
-        
+    def seed_stg_history(self):
+        """Import the configured history snapshot into the STG history unless it is already contained in it."""
+        existing_data_path = self.config.get("existing_data_path")
+        if not existing_data_path:
+            return
         try:
-            # Reset index to handle potential duplicate labels
-            stg_data = stg_data.reset_index(drop=True)
-            
-            # Filter for loaded wagons only
-            stg_data = stg_data[stg_data['load_status'] == 'ГРУЖ'].copy()
-            
-            # Ensure required columns exist
-            required_columns = ["month", "departure_station", "destination_station", "wagon_type"]
-            missing_columns = [col for col in required_columns if col not in stg_data.columns]
-            if missing_columns:
-                raise ValueError(f"Missing required columns: {', '.join(missing_columns)}")
-            
-            # Group by month, departure station, destination station, and wagon type
-            route_data = stg_data.groupby([
-                "month",
-                "departure_station",
-                "destination_station",
-                "wagon_type"
-            ], dropna=False).size().reset_index(name="Количество")
-            
-            # Rename columns to match expected format
-            route_data = route_data.rename(columns={
-                "month": "Месяц",
-                "departure_station": "Ст. отправления",
-                "destination_station": "Ст. назначения",
-                "wagon_type": "Тип вагона"
-            })
-            
-            # Get existing ZNP data
-            znp_data = get_znp_data()
-            
-            # Create a dictionary for quick lookup of existing ZNP values
-            znp_lookup = {}
-            if not znp_data.empty:
-                for _, row in znp_data.iterrows():
-                    try:
-                        key = (
-                            int(row["Месяц"]),
-                            str(row["Ст. отправления"]).strip(),
-                            str(row["Ст. назначения"]).strip(),
-                            str(row["Тип вагона"]).strip() if pd.notna(row["Тип вагона"]) else ""
-                        )
-                        znp_lookup[key] = str(row["ЗНП"])
-                    except Exception as e:
-                        logger.warning(f"Skipping invalid ZNP row: {str(e)}")
-                        continue
-            
-            # Add ZNP values from lookup
-            znp_values = []
-            for _, row in route_data.iterrows():
-                try:
-                    key = (
-                        int(row["Месяц"]),
-                        str(row["Ст. отправления"]).strip(),
-                        str(row["Ст. назначения"]).strip(),
-                        str(row["Тип вагона"]).strip() if pd.notna(row["Тип вагона"]) else ""
-                    )
-                    znp_values.append(znp_lookup.get(key, ""))
-                except Exception as e:
-                    logger.warning(f"Error processing route row: {str(e)}")
-                    znp_values.append("")
-            
-            route_data["ЗНП"] = znp_values
-            
-            # Sort by month, station names
-            route_data = route_data.sort_values(["Месяц", "Ст. отправления", "Ст. назначения"])
-            
-            # Ensure all columns are present and in the correct order
-            expected_columns = ["Месяц", "Ст. отправления", "Ст. назначения", "Тип вагона", "Количество", "ЗНП"]
-            route_data = route_data.reindex(columns=expected_columns)
-            
+            FileProcessor(self.config).seed_history(existing_data_path)
+        except Exception as e:
+            logger.warning(f"Error importing STG history from {existing_data_path}: {str(e)}")
+    
+    def ingest_stg_file(self, file_path: str, df: pd.DataFrame):
+        """Add an STG file to the STG history unless a file with the same content was already added."""
+        try:
+            content_hash = get_file_hash(file_path)
+            if is_stg_file_ingested(content_hash):
+                return
+            # Rows the workflow would drop are not added either
+            upsert_stg_data(df.dropna(subset=STG_REQUIRED_COLUMNS),
+                            source_path=file_path, content_hash=content_hash)
+        except Exception as e:
+            logger.warning(f"Error adding file {file_path} to STG history: {str(e)}")
+    
+    def load_route_counts(self, period: Optional[Tuple[int, int]] = None) -> pd.DataFrame:
+        """Build the routes table from the route count aggregate, optionally for one report (year, month)."""
+        year, month = period if period is not None else (None, None)
+        route_data = get_route_counts(year, month)
+        if route_data.empty:
             return route_data
-            
+        
+        # Add ZNP values with one merge on the normalized route key
+        route_data["ЗНП"] = lookup_znp_codes(route_data)
+        
+        # Ensure all columns are present and in the correct order
+        return route_data.reindex(columns=ROUTE_HEADERS)
+    
+    def refresh_routes_table(self):
+        """
+        Reload the routes table for the selected report month.
+        Until any STG data has been loaded, the stored ZNP routes are shown instead.
+        """
+        period = self.routes_month_combo.currentData()
+        period = tuple(period) if period is not None else None
+        
+        # Rebuild the month list without triggering a reload per item
+        self.routes_month_combo.blockSignals(True)
+        try:
+            self.routes_month_combo.clear()
+            self.routes_month_combo.addItem("All months", None)
+            for year, month in get_route_count_periods():
+                self.routes_month_combo.addItem(f"{year}-{month:02d}", (year, month))
+            index = next((i for i in range(1, self.routes_month_combo.count())
+                          if tuple(self.routes_month_combo.itemData(i)) == period), 0)
+            self.routes_month_combo.setCurrentIndex(index)
+        finally:
+            self.routes_month_combo.blockSignals(False)
+        
+        routes = self.load_route_counts(self.routes_month_combo.currentData())
+        if routes.empty and self.routes_month_combo.count() == 1:
+            routes = get_znp_data()
+        self.update_routes_table(routes)
+    
+    def on_routes_month_changed(self, index: int):
+        """Show the routes of the selected month."""
+        if self.route_edits:
+            logger.info(f"Discarding {len(self.route_edits)} unsaved route edits")
+        try:
+            self.update_routes_table(self.load_route_counts(self.routes_month_combo.itemData(index)))
         except Exception as e:
-            logger.error(f"Error generating routes: {str(e)}")
-            raise
+            logger.error(f"Error loading routes: {str(e)}")
 
 class ProcessingWorker(QThread):
     """Worker thread for processing operations."""
@@ -1512,10 +1596,14 @@ class ProcessingWorker(QThread):
     
     def run(self):
         """Run the worker thread."""
-        if self.operation == "process_expenses":
-            self.process_expenses()
-        elif self.operation == "import_reference":
-            self.import_reference()
+        try:
+            if self.operation == "process_expenses":
+                self.process_expenses()
+            elif self.operation == "import_reference":
+                self.import_reference()
+        finally:
+            # The thread's database session ends with the thread
+            remove_session()
     
     def process_expenses(self):
         """Process expense files."""
@@ -1535,54 +1623,66 @@ class ProcessingWorker(QThread):
             self.process_complete.emit(False, str(e), {})
     
     def import_reference(self):
-        """Import reference data."""
+        """
+        Import reference data.
+        The files are parsed concurrently in worker processes; each table is then
+        written in its own transaction on this thread.
+        """
         try:
-            files = self.params.get("files", {})
+            files = {k: v for k, v in self.params.get("files", {}).items() if v and os.path.exists(v)}
+            
+            # Files identical to the last import are skipped without parsing
+            changed, unchanged = find_changed_files(files)
+            results = {file_type: {"skipped": True, "version": version} for file_type, version in unchanged.items()}
             
-            total_files = len(files)
-            processed = 0
-            results = {}
+            total_steps = max(len(changed) * 2, 1)
+            done = 0
+            parsed = {}
             
-            for file_type, file_path in files.items():
-                if not file_path or not os.path.exists(file_path):
+            for result in parse_reference_files({file_type: files[file_type] for file_type in changed}):
+                file_type = result["file_type"]
+                done += 1
+                self.progress_update.emit(int(done / total_steps * 100), f"Parsed {file_type}")
+                
+                if "error" in result:
+                    results[file_type] = {"error": result["error"]}
+                else:
+                    parsed[file_type] = result
+            
+            for file_type in REFERENCE_FILE_TYPES:
+                if file_type not in parsed:
                     continue
                 
-                processed += 1
-                progress = int((processed / total_files) * 100)
-                self.progress_update.emit(progress, f"Importing {file_type}...")
+                result = parsed[file_type]
+                done += 1
+                self.progress_update.emit(int(done / total_steps * 100), f"Importing {file_type}...")
                 
                 try:
-                    if file_type == "znp":
-                        df = pd.read_excel(file_path)
-                        count = add_znp_data(df)
-                        results[file_type] = count
-                    elif file_type == "exceptions":
-                        df = pd.read_excel(file_path)
-                        count = add_exceptions(df)
-                        results[file_type] = count
-                    elif file_type == "overrides":
-                        df = pd.read_excel(file_path)
-                        count = add_overrides(df)
-                        results[file_type] = count
-                    elif file_type == "active":
-                        df = pd.read_csv(file_path)
-                        routes = df.iloc[:, 0].astype(str).tolist()
-                        count = add_active_routes(routes)
-                        results[file_type] = count
-                    elif file_type == "matrix":
-                        df = pd.read_csv(file_path)
-                        count = add_matrix_mappings(df)
-                        results[file_type] = count
+                    written = write_reference_data(
+                        file_type, result["data"], source_path=result["file_path"], content_hash=changed[file_type]
+                    )
+                    results[file_type] = {
+                        "count": written["count"],
+                        "changes": written["changes"],
+                        "version": written["version"],
+                        "rows": result["rows"],
+                        "parse_rows_per_second": rows_per_second(result["rows"], result["parse_seconds"]),
+                        "write_rows_per_second": rows_per_second(result["rows"], written["write_seconds"])
+                    }
+                    logger.info(
+                        f"Imported {file_type}: {result['rows']} rows, "
+                        f"parsed in {result['parse_seconds']:.2f}s, written in {written['write_seconds']:.2f}s"
+                    )
                 except Exception as e:
                     logger.error(f"Error importing {file_type}: {str(e)}")
-                    results[file_type] = f"Error: {str(e)}"
+                    results[file_type] = {"error": str(e)}
             
             self.progress_update.emit(100, "Import complete")
             
-            if any(isinstance(v, int) for v in results.values()):
+            if any("error" not in v for v in results.values()):
                 self.process_complete.emit(True, "Successfully imported reference data", results)
             else:
                 self.process_complete.emit(False, "Errors occurred during import", results)
         except Exception as e:
             logger.error(f"Error importing reference data: {str(e)}")
-            self.process_complete.emit(False, str(e), {})
\ No newline at end of file
+            self.process_complete.emit(False, str(e), {})
@@ -28,6 +28,22 @@ def standardize_column_types(df: pd.DataFrame, type_mapping: Dict[str, str]) ->
     
     return result_df
 
+# Columns identifying a route for ЗНП matching
+ROUTE_KEY_COLUMNS = ["Месяц", "Ст. отправления", "Ст. назначения", "Тип вагона"]
+
+def normalize_route_keys(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Return the route key columns of a frame normalized for matching.
+    The month becomes a nullable integer, stations and wagon type are stripped
+    strings, and a missing wagon type is "". The index of df is kept.
+    """
+    keys = pd.DataFrame(index=df.index)
+    keys["Месяц"] = pd.to_numeric(df["Месяц"], errors='coerce').astype('Int64')
+    for col in ROUTE_KEY_COLUMNS[1:]:
+        values = df[col].astype(object)
+        keys[col] = values.where(values.notna(), "").astype(str).str.strip()
+    return keys
+
 def read_excel_file(file_path: str, sheet_name: Optional[str] = None) -> pd.DataFrame:
     """Read an Excel file and return as DataFrame."""
     try:
@@ -1,5 +1,6 @@
 import os
 import glob
+import hashlib
 import logging
 from typing import List
 
@@ -21,4 +22,12 @@ def get_files_by_pattern(directory: str, pattern: str) -> List[str]:
     files = glob.glob(file_pattern)
     
     logger.info(f"Found {len(files)} files matching pattern '{pattern}' in {directory}")
-    return files
\ No newline at end of file
+    return files
+
+def get_file_hash(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Return the SHA-256 hash of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
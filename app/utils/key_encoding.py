@@ -0,0 +1,144 @@
+from typing import Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Code given to missing values; it packs as 0, so missing only matches missing
+MISSING_CODE = -1
+
+# Bits given to each part of a packed key; every key fits a signed int64
+MONTH_BITS = 8
+STATION_BITS = 20
+WAGON_TYPE_BITS = 15
+WAGON_BITS = 31
+INVOICE_BITS = 32
+
+# Invoice numbers made only of digits are compared as 8-digit zero-padded numbers
+INVOICE_NUMBER_WIDTH = 8
+
+class KeyDictionary:
+    """
+    Append-only dictionary from text values to integer codes.
+    A value keeps its code for the lifetime of the dictionary, so frames encoded
+    with the same dictionary can be joined on the codes instead of the text.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._values = pd.Index([], dtype=object)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def encode(self, values) -> np.ndarray:
+        """
+        Return the int64 code of each value, adding unseen values to the dictionary.
+        Categoricals are encoded through their categories, so each distinct value
+        is looked up once. Missing values get MISSING_CODE.
+        """
+        series = values if isinstance(values, pd.Series) else pd.Series(values)
+
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            category_codes = self._encode_unique(series.cat.categories.map(str))
+            codes = series.cat.codes.to_numpy()
+        else:
+            codes, uniques = pd.factorize(series.astype(object), use_na_sentinel=True)
+            category_codes = self._encode_unique(pd.Index(uniques).map(str))
+
+        if not len(category_codes):
+            return np.full(len(series), MISSING_CODE, dtype=np.int64)
+        return np.where(codes >= 0, category_codes[codes], MISSING_CODE).astype(np.int64)
+
+    def _encode_unique(self, uniques: pd.Index) -> np.ndarray:
+        """Return the codes of distinct values, appending the ones not seen before."""
+        positions = self._values.get_indexer(uniques)
+        unseen = positions < 0
+        if unseen.any():
+            start = len(self._values)
+            self._values = self._values.append(pd.Index(uniques[unseen], dtype=object))
+            positions[unseen] = np.arange(start, len(self._values))
+        return positions.astype(np.int64)
+
+def pack_codes(parts: Sequence[Tuple[np.ndarray, int]]) -> np.ndarray:
+    """
+    Pack columns of integer codes into one int64 key per row.
+    Each part is (codes, bits); codes are shifted by one so MISSING_CODE packs as 0.
+    Raises ValueError when a code does not fit its bits.
+    """
+    total_bits = sum(bits for _, bits in parts)
+    if total_bits > 63:
+        raise ValueError(f"Packed key needs {total_bits} bits, more than an int64 holds")
+
+    key = None
+    for codes, bits in parts:
+        shifted = np.asarray(codes, dtype=np.int64) + 1
+        if len(shifted) and (shifted.min() < 0 or shifted.max() >= (1 << bits)):
+            raise ValueError(f"Key codes out of range for a {bits}-bit field")
+        key = shifted if key is None else (key << bits) | shifted
+    return key
+
+def normalize_invoice_numbers(values) -> pd.Series:
+    """
+    Bring invoice numbers to the text form used by the invoice dictionary.
+    Whole numbers and digit strings become zero-padded numbers, anything else is
+    stripped; missing values stay missing.
+    """
+    series = values if isinstance(values, pd.Series) else pd.Series(values)
+    series = series.astype(object)
+
+    text = series.map(str, na_action='ignore').str.strip()
+    digits = text.str.fullmatch(r"[0-9]+", na=False)
+
+    # Numbers read from a workbook may arrive as floats (12345678.0)
+    not_text = series.map(type) != str
+    numbers = pd.to_numeric(series.where(not_text), errors='coerce')
+    whole = numbers.notna() & (numbers % 1 == 0)
+
+    normalized = text.copy()
+    normalized[digits] = text[digits].str.lstrip('0').replace('', '0').str.zfill(INVOICE_NUMBER_WIDTH)
+    normalized[whole] = numbers[whole].astype(np.int64).astype(str).str.zfill(INVOICE_NUMBER_WIDTH)
+    return normalized
+
+def normalize_wagon_numbers(values) -> np.ndarray:
+    """Return wagon numbers as int64, with MISSING_CODE for values that are not whole wagon numbers."""
+    numbers = pd.to_numeric(pd.Series(values).astype(object), errors='coerce')
+    valid = numbers.notna() & (numbers % 1 == 0) & (numbers >= 0) & (numbers < (1 << WAGON_BITS))
+    return np.where(valid, numbers.where(valid, 0), MISSING_CODE).astype(np.int64)
+
+def pack_wn_keys(wagon_numbers: np.ndarray, invoice_ids: np.ndarray) -> np.ndarray:
+    """
+    Pack wagon numbers and invoice dictionary IDs into the int64 (wagon, invoice) key.
+    The wagon number takes the high bits and the invoice ID the low 32 bits;
+    rows missing either part get MISSING_CODE.
+    """
+    wagons = np.asarray(wagon_numbers, dtype=np.int64)
+    invoices = np.asarray(invoice_ids, dtype=np.int64)
+    valid = (wagons >= 0) & (invoices >= 0) & (invoices < (1 << INVOICE_BITS))
+    return np.where(valid, (wagons << INVOICE_BITS) | invoices, MISSING_CODE)
+
+class KeyEncoding:
+    """
+    Shared dictionaries for the text keys of the ZNP and exception joins.
+    Stations, wagon types and invoices are each encoded once, and the STG and
+    reference sides of a join are packed into one int64 key. (Wagon, invoice)
+    pairs already carry a persistent key, see pack_wn_keys.
+    """
+
+    def __init__(self):
+        self.stations = KeyDictionary("stations")
+        self.wagon_types = KeyDictionary("wagon_types")
+        self.invoices = KeyDictionary("invoices")
+
+    def route_keys(self, month, departure_station, destination_station, wagon_type) -> np.ndarray:
+        """Pack (month, departure, destination, wagon type) into one int64 key per row."""
+        months = pd.Series(month).astype("Int64").fillna(MISSING_CODE).to_numpy(dtype=np.int64)
+        return pack_codes([
+            (months, MONTH_BITS),
+            (self.stations.encode(departure_station), STATION_BITS),
+            (self.stations.encode(destination_station), STATION_BITS),
+            (self.wagon_types.encode(wagon_type), WAGON_TYPE_BITS)
+        ])
+
+    def invoice_keys(self, invoice_number) -> np.ndarray:
+        """Encode invoice numbers as int64 codes."""
+        return self.invoices.encode(invoice_number)
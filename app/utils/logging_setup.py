@@ -0,0 +1,62 @@
+import os
+import queue
+import atexit
+import logging
+import logging.handlers
+from typing import Optional
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_FILE_NAME = "logistics_processor.log"
+
+# The log file is rotated at this size, keeping this many old files
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def setup_logging(log_dir: str, level: int = logging.INFO, console: bool = True,
+                  max_bytes: int = LOG_MAX_BYTES, backup_count: int = LOG_BACKUP_COUNT) -> logging.handlers.QueueListener:
+    """
+    Send application logging through a queue.
+    Loggers only put records on the queue; a listener thread formats them and
+    writes them to a size-rotated log file in log_dir (and to the console), so
+    pipeline and worker threads never wait on file writes. The records left
+    on the queue are written by stop_logging, at the latest at exit.
+    """
+    global _listener
+
+    stop_logging()
+    os.makedirs(log_dir, exist_ok=True)
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.handlers.RotatingFileHandler(
+        os.path.join(log_dir, LOG_FILE_NAME), maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+    )]
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+def stop_logging() -> None:
+    """Write the queued log records and stop the listener thread."""
+    global _listener
+
+    listener, _listener = _listener, None
+    if listener is None:
+        return
+
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import uuid
+import logging
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Dict, Any, Optional
+
+try:
+    import psutil
+except ImportError:  # RSS sampling is optional
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+def get_rss_bytes() -> Optional[int]:
+    """
+    Return the resident set size of the current process, if it can be measured.
+    Without psutil this falls back to the peak RSS reported by the resource module.
+    """
+    if psutil is not None:
+        return psutil.Process(os.getpid()).memory_info().rss
+    try:
+        import resource
+        # ru_maxrss is reported in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, AttributeError):
+        return None
+
+class StageRecord:
+    """Measurements collected for a single pipeline stage."""
+
+    def __init__(self, stage: str, file_name: Optional[str] = None, rows_in: Optional[int] = None,
+                 parent: Optional['StageRecord'] = None):
+        self.stage = stage
+        self.file_name = file_name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent else 0
+        self.started_at = None
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.peak_memory_bytes = None
+        self.rss_bytes = None
+        self._start_wall = None
+        self._start_cpu = None
+        self._peak_seen = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Return the record as a plain dictionary."""
+        return {
+            'stage': self.stage,
+            'file_name': self.file_name,
+            'depth': self.depth,
+            'started_at': self.started_at,
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'peak_memory_bytes': self.peak_memory_bytes,
+            'rss_bytes': self.rss_bytes
+        }
+
+class RunMetrics:
+    """
+    Collects wall time, CPU time, row counts and memory for each stage of a run.
+    Stages are opened with the stage() context manager and may be nested
+    (e.g. one stage per file inside the daily files stage).
+    """
+
+    def __init__(self, enabled: bool = True, trace_memory: bool = False):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.run_id = uuid.uuid4().hex
+        self.records: List[StageRecord] = []
+        self._stack: List[StageRecord] = []
+        self._started_tracing = False
+        self._origin = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, file_name: Optional[str] = None, rows_in: Optional[int] = None):
+        """Measure the enclosed block as one stage; set rows_out on the yielded record."""
+        parent = self._stack[-1] if self._stack else None
+        record = StageRecord(name, file_name=file_name, rows_in=rows_in, parent=parent)
+
+        if not self.enabled:
+            yield record
+            return
+
+        if self.trace_memory:
+            self._start_memory_trace(parent)
+
+        self._stack.append(record)
+        record.started_at = datetime.now()
+        record._start_wall = time.perf_counter()
+        record._start_cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record.wall_seconds = time.perf_counter() - record._start_wall
+            record.cpu_seconds = time.process_time() - record._start_cpu
+            record.rss_bytes = get_rss_bytes()
+            if self.trace_memory:
+                self._stop_memory_trace(record)
+            self._stack.pop()
+            self.records.append(record)
+
+            logger.info(
+                f"Stage '{name}'{f' [{file_name}]' if file_name else ''}: "
+                f"{record.wall_seconds:.3f}s wall, {record.cpu_seconds:.3f}s CPU, "
+                f"rows {record.rows_in} -> {record.rows_out}"
+            )
+
+    def _start_memory_trace(self, parent: Optional[StageRecord]):
+        """Start tracemalloc if needed and reset the peak for a new stage."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        # Keep the parent's peak so far before the child resets the counter
+        if parent is not None:
+            parent._peak_seen = max(parent._peak_seen, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+
+    def _stop_memory_trace(self, record: StageRecord):
+        """Record the stage peak and hand it on to the enclosing stage."""
+        record.peak_memory_bytes = max(record._peak_seen, tracemalloc.get_traced_memory()[1])
+        if record.parent is not None:
+            record.parent._peak_seen = max(record.parent._peak_seen, record.peak_memory_bytes)
+        if not self._stack[:-1] and self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """Return all finished stage records as dictionaries."""
+        return [record.to_dict() for record in self.records]
+
+    def export_chrome_trace(self, output_path: str) -> str:
+        """
+        Export the stages as Chrome trace-event JSON.
+        Open the file in chrome://tracing or https://ui.perfetto.dev.
+        """
+        events = []
+        for record in self.records:
+            if record._start_wall is None:
+                continue
+            events.append({
+                'name': record.stage if not record.file_name else f"{record.stage}: {os.path.basename(record.file_name)}",
+                'cat': 'pipeline',
+                'ph': 'X',
+                'ts': int((record._start_wall - self._origin) * 1_000_000),
+                'dur': int(record.wall_seconds * 1_000_000),
+                'pid': os.getpid(),
+                'tid': 0,
+                'args': {
+                    'cpu_seconds': record.cpu_seconds,
+                    'rows_in': record.rows_in,
+                    'rows_out': record.rows_out,
+                    'peak_memory_bytes': record.peak_memory_bytes,
+                    'rss_bytes': record.rss_bytes
+                }
+            })
+
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False, indent=2)
+
+        logger.info(f"Trace exported to {output_path}")
+        return output_path
@@ -0,0 +1,121 @@
+import logging
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# STGDaily column names and the names used by the pipeline stages
+STG_COLUMN_MAPPING = {
+    'Вагон №': 'wagon_number',
+    'Накладная №': 'invoice_number',
+    'Ст. отправления': 'departure_station',
+    'Ст. назначения': 'destination_station',
+    'Прибытие на ст. отправл.': 'departure_arrival',
+    'Отчетная дата': 'report_date',
+    'Прибытие на ст. назн.': 'destination_arrival',
+    'Груж\\пор': 'load_status',
+    'Тип вагона': 'wagon_type',
+    'Расстояние': 'distance',
+    'Собственник': 'owner',
+    'Грузоотправитель': 'shipper',
+    'Грузополучатель': 'consignee',
+    'Простой в ожидании ремонта': 'repair_wait_time'
+}
+
+# Low-cardinality text columns stored as categoricals
+STG_CATEGORY_COLUMNS = [
+    'departure_station', 'destination_station', 'load_status', 'wagon_type',
+    'owner', 'shipper', 'consignee'
+]
+
+# High-cardinality text columns kept as plain strings
+STG_STRING_COLUMNS = ['invoice_number']
+
+STG_DATETIME_COLUMNS = ['departure_arrival', 'report_date', 'destination_arrival']
+
+# Columns a row needs before it can be added to the STG history
+STG_REQUIRED_COLUMNS = ['wagon_number', 'invoice_number', 'load_status', 'report_date']
+
+# Numeric columns with the compact dtype each one is stored in
+STG_NUMERIC_DTYPES = {
+    'wagon_number': 'int32',
+    'distance': 'float32',
+    'repair_wait_time': 'float32'
+}
+
+# Derived columns added by the pipeline
+MONTH_DTYPE = 'Int8'
+YEAR_DTYPE = 'Int16'
+BATCH_ID_DTYPE = 'Int32'
+
+def frame_memory_mb(df: pd.DataFrame) -> float:
+    """Return the deep memory usage of a DataFrame in megabytes."""
+    return df.memory_usage(deep=True).sum() / (1024 * 1024)
+
+def prepare_stg_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Rename STGDaily columns and apply the STG dtype plan once at ingestion.
+    Text columns become categoricals, wagon numbers int32 and the report year and
+    month (the STG storage partition) nullable integers, so later stages can work
+    on the frame without re-casting.
+    """
+    log_memory = logger.isEnabledFor(logging.DEBUG)
+    if log_memory:
+        memory_before = frame_memory_mb(df)
+
+    stg_data = df.copy()
+    stg_data.columns = [col.strip() if isinstance(col, str) else col for col in stg_data.columns]
+    stg_data = stg_data.rename(columns=STG_COLUMN_MAPPING)
+
+    # Create empty columns for any missing fields
+    for col in STG_COLUMN_MAPPING.values():
+        if col not in stg_data.columns:
+            stg_data[col] = None
+
+    for col in STG_STRING_COLUMNS:
+        stg_data[col] = stg_data[col].fillna('').astype(str)
+
+    for col in STG_CATEGORY_COLUMNS:
+        stg_data[col] = stg_data[col].fillna('').astype(str).astype('category')
+
+    for col, dtype in STG_NUMERIC_DTYPES.items():
+        values = pd.to_numeric(stg_data[col], errors='coerce').fillna(0)
+        stg_data[col] = values.astype(dtype)
+
+    for col in STG_DATETIME_COLUMNS:
+        stg_data[col] = pd.to_datetime(stg_data[col], errors='coerce')
+
+    stg_data['month'] = stg_data['report_date'].dt.month.astype(MONTH_DTYPE)
+    stg_data['year'] = stg_data['report_date'].dt.year.astype(YEAR_DTYPE)
+
+    if log_memory:
+        logger.debug(f"STG frame memory: {memory_before:.1f} MB -> {frame_memory_mb(stg_data):.1f} MB")
+
+    return stg_data
+
+def set_category_value(df: pd.DataFrame, mask, column: str, value) -> None:
+    """Assign a value to the masked rows of a column, adding it to the categories if needed."""
+    series = df[column]
+    if isinstance(series.dtype, pd.CategoricalDtype) and value not in series.cat.categories:
+        df[column] = series.cat.add_categories([value])
+    df.loc[mask, column] = value
+
+def concat_stg_frames(frames) -> pd.DataFrame:
+    """
+    Concatenate prepared STG frames without losing the categorical dtypes.
+    pd.concat falls back to object columns when category sets differ, so the
+    categories are unified first.
+    """
+    frames = [frame.copy(deep=False) for frame in frames if frame is not None and not frame.empty]
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0]
+
+    for col in STG_CATEGORY_COLUMNS:
+        if not all(col in frame.columns and isinstance(frame[col].dtype, pd.CategoricalDtype) for frame in frames):
+            continue
+        categories = pd.api.types.union_categoricals([frame[col] for frame in frames]).categories
+        for frame in frames:
+            frame[col] = frame[col].cat.set_categories(categories)
+
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from typing import List
+
+import pandas as pd
+
+# The application resolves its database and config paths from APPDATA
+os.environ.setdefault('APPDATA', tempfile.gettempdir())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.file_processor import FileProcessor
+from app.database.models import init_db
+from app.database.operations import init_session, get_wn_keys, upsert_stg_data, get_stg_history
+from app.utils.metrics import get_rss_bytes
+from app.utils.stg_schema import prepare_stg_frame
+from benchmarks.data_generator import generate_stg_data, generate_reference_data
+from benchmarks.run_benchmarks import import_reference
+
+MODES = ["pandas", "sql"]
+
+# Compared after each mode has written wagon_invoices
+COMPARE_COLUMNS = [
+    "wn_key", "wagon_number", "invoice_number", "route_id", "batch_id", "departure_station",
+    "destination_station", "departure_date", "report_date", "arrival_date", "status", "wagon_type"
+]
+
+def build_database(db_path: str, n_rows: int, seed: int) -> None:
+    """Create a database holding a synthetic STG history and its reference data."""
+    engine, session_maker = init_db(db_path)
+    session = session_maker()
+    init_session(session)
+
+    stg_source = generate_stg_data(n_rows, seed=seed)
+    import_reference(generate_reference_data(stg_source, seed=seed))
+    data = prepare_stg_frame(stg_source)
+    data["wn_key"] = get_wn_keys(data["wagon_number"], data["invoice_number"])
+    upsert_stg_data(data.dropna(subset=["wagon_number", "invoice_number", "load_status", "report_date"]))
+
+    session.close()
+    engine.dispose()
+
+def run_mode(mode: str, db_path: str, output_dir: str) -> dict:
+    """Map route IDs of the whole history in one mode; returns wall time and memory peaks."""
+    engine, session_maker = init_db(db_path)
+    session = session_maker()
+    init_session(session)
+    processor = FileProcessor({"output_directory": output_dir})
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    if mode == "sql":
+        summary = processor.map_route_ids_in_database()
+    else:
+        history = prepare_stg_frame(get_stg_history())
+        summary = processor.store_route_ids(processor.map_znp_to_batches(processor.assign_batch_ids(history)))
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rss = get_rss_bytes()
+    session.close()
+    engine.dispose()
+    return {
+        "mode": mode,
+        "seconds": round(seconds, 3),
+        "tracemalloc_peak_mb": round(peak / 1024 / 1024, 1),
+        "rss_mb": round(rss / 1024 / 1024, 1) if rss is not None else None,
+        "rows": summary["total"]
+    }
+
+def read_wagon_invoices(db_path: str) -> pd.DataFrame:
+    """Read wagon_invoices in key order for comparison."""
+    engine, _ = init_db(db_path)
+    df = pd.read_sql(f"SELECT {', '.join(COMPARE_COLUMNS)} FROM wagon_invoices ORDER BY wn_key", engine)
+    engine.dispose()
+    return df
+
+def change_history(db_path: str, seed: int, fraction: float = 0.05) -> int:
+    """
+    Flip ГРУЖ/ПОР on a random sample of history rows and shift a few report dates,
+    upserted like a later daily file. Returns the number of rows changed.
+    """
+    engine, session_maker = init_db(db_path)
+    session = session_maker()
+    init_session(session)
+
+    history = prepare_stg_frame(get_stg_history())
+    changed = history.sample(frac=fraction, random_state=seed).copy()
+    flip = {"ГРУЖ": "ПОР", "ПОР": "ГРУЖ"}
+    changed["load_status"] = changed["load_status"].astype(str).map(lambda status: flip.get(status, status))
+    changed.loc[changed.index[::7], "report_date"] += pd.Timedelta(days=3)
+    # The report month and year follow the shifted dates
+    upsert_stg_data(prepare_stg_frame(changed.drop(columns=["id"], errors="ignore")))
+
+    session.close()
+    engine.dispose()
+    return len(changed)
+
+def count_differences(expected: pd.DataFrame, actual: pd.DataFrame) -> int:
+    """Return the number of rows found in only one of two wagon_invoices tables."""
+    merged = expected.merge(actual, how="outer", on=COMPARE_COLUMNS, indicator=True)
+    return int((merged["_merge"] != "both").sum())
+
+def check(n_rows: int, seeds: List[int]) -> bool:
+    """
+    Check that the SQL mapping writes the same wagon_invoices as the pandas path
+    (map_znp_to_batches + store_route_ids), on a fresh history and again after
+    part of it changed. Everything runs in this process; returns True on success.
+    """
+    ok = True
+    with tempfile.TemporaryDirectory(prefix="logistics_sql_check_") as workdir:
+        for seed in seeds:
+            source_path = os.path.join(workdir, f"source_{seed}.db")
+            build_database(source_path, n_rows, seed)
+            db_paths = {}
+            for mode in MODES:
+                db_paths[mode] = os.path.join(workdir, f"{mode}_{seed}.db")
+                shutil.copyfile(source_path, db_paths[mode])
+
+            for step in ("initial", "after changes"):
+                if step == "after changes":
+                    for mode in MODES:
+                        change_history(db_paths[mode], seed)
+                tables = {}
+                for mode in MODES:
+                    run_mode(mode, db_paths[mode], workdir)
+                    tables[mode] = read_wagon_invoices(db_paths[mode])
+                differences = count_differences(tables["pandas"], tables["sql"])
+                status = "ok" if differences == 0 and len(tables["pandas"]) == len(tables["sql"]) else "MISMATCH"
+                print(f"seed {seed}, {step}: {len(tables['pandas'])} pandas rows, {len(tables['sql'])} SQL rows, "
+                      f"{differences} differing rows: {status}")
+                ok = ok and status == "ok"
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the pandas and SQL route ID mapping")
+    parser.add_argument("--rows", type=int, help="STG history rows (default: 200000)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (default: 42)")
+    parser.add_argument("--check", action="store_true",
+                        help="Only check that both modes write the same wagon_invoices, for each --seeds value "
+                             "(default rows: 3000); exits with status 1 on a mismatch")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[1, 2, 3], help="Seeds checked by --check")
+    parser.add_argument("--mode", choices=["build"] + MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.check:
+        sys.exit(0 if check(args.rows or 3000, args.seeds) else 1)
+    args.rows = args.rows or 200_000
+
+    # The database is built and each mode run in a process of its own: the
+    # maximum RSS survives fork and exec, so it must not include another step
+    if args.mode == "build":
+        build_database(args.db, args.rows, args.seed)
+        return
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, args.db, os.path.dirname(args.db))))
+        return
+
+    def run_step(mode: str, db_path: str) -> str:
+        return subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--mode", mode, "--db", db_path,
+             "--rows", str(args.rows), "--seed", str(args.seed)],
+            check=True, capture_output=True, text=True
+        ).stdout
+
+    with tempfile.TemporaryDirectory(prefix="logistics_sql_bench_") as workdir:
+        source_path = os.path.join(workdir, "source.db")
+        run_step("build", source_path)
+
+        results = {}
+        tables = {}
+        for mode in MODES:
+            db_path = os.path.join(workdir, f"{mode}.db")
+            shutil.copyfile(source_path, db_path)
+            results[mode] = json.loads(run_step(mode, db_path).strip().splitlines()[-1])
+            tables[mode] = read_wagon_invoices(db_path)
+
+    matches = tables["pandas"].equals(tables["sql"])
+    print(f"STG rows:              {args.rows}")
+    for mode in MODES:
+        result = results[mode]
+        print(f"{mode:>6}: {result['seconds']:.3f}s, tracemalloc peak {result['tracemalloc_peak_mb']} MB, "
+              f"RSS {result['rss_mb']} MB, {result['rows']} route rows")
+    print(f"Results identical:     {matches}")
+    if not matches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import statistics
+
+import numpy as np
+import pandas as pd
+
+# The application resolves its database and config paths from APPDATA
+os.environ.setdefault('APPDATA', tempfile.gettempdir())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.database.models import init_db
+from app.database.operations import init_session, add_znp_data, get_znp_data, lookup_znp_codes
+from benchmarks.data_generator import make_station_names, WAGON_TYPES
+
+def generate_route_groups(n_groups: int, seed: int = 42) -> pd.DataFrame:
+    """Build n_groups distinct (month, departure, destination, wagon type) route groups with counts."""
+    rng = np.random.default_rng(seed)
+    stations = make_station_names(max(40, int(np.sqrt(n_groups / 24)) + 2))
+
+    # Draw more candidates than needed and keep the first n distinct routes
+    n_draw = n_groups * 2
+    routes = pd.DataFrame({
+        "Месяц": rng.integers(1, 13, n_draw),
+        "Ст. отправления": rng.choice(stations, n_draw),
+        "Ст. назначения": rng.choice(stations, n_draw),
+        "Тип вагона": rng.choice(WAGON_TYPES + [""], n_draw)
+    }).drop_duplicates().head(n_groups).reset_index(drop=True)
+    routes["Количество"] = rng.integers(1, 50, len(routes))
+    return routes
+
+def generate_znp(routes: pd.DataFrame, coverage: float = 0.8, seed: int = 42) -> pd.DataFrame:
+    """Assign a ЗНП code to a share of the routes, padding some station names with spaces."""
+    rng = np.random.default_rng(seed)
+    znp = routes.sample(frac=coverage, random_state=seed)[["Месяц", "Ст. отправления", "Ст. назначения", "Тип вагона"]].copy()
+    padded = rng.random(len(znp)) < 0.1
+    znp.loc[padded, "Ст. отправления"] = znp.loc[padded, "Ст. отправления"] + " "
+    znp["ЗНП"] = [str(4_000_000 + i) for i in range(len(znp))]
+    return znp
+
+def lookup_with_iterrows(routes: pd.DataFrame) -> pd.Series:
+    """The previous row-by-row lookup, kept as the baseline."""
+    znp_data = get_znp_data()
+    znp_lookup = {}
+    for _, row in znp_data.iterrows():
+        key = (
+            int(row["Месяц"]),
+            str(row["Ст. отправления"]).strip(),
+            str(row["Ст. назначения"]).strip(),
+            str(row["Тип вагона"]).strip() if pd.notna(row["Тип вагона"]) else ""
+        )
+        znp_lookup[key] = str(row["ЗНП"])
+
+    znp_values = []
+    for _, row in routes.iterrows():
+        key = (
+            int(row["Месяц"]),
+            str(row["Ст. отправления"]).strip(),
+            str(row["Ст. назначения"]).strip(),
+            str(row["Тип вагона"]).strip() if pd.notna(row["Тип вагона"]) else ""
+        )
+        znp_values.append(znp_lookup.get(key, ""))
+    return pd.Series(znp_values, index=routes.index, name="ЗНП")
+
+def time_call(func, repeat: int):
+    """Return the result of the last call and the median wall time."""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return result, statistics.median(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ЗНП lookup used by route generation")
+    parser.add_argument("--groups", type=int, default=50_000, help="Number of route groups (default: 50000)")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions (default: 3)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (default: 42)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix="logistics_znp_bench_") as workdir:
+        engine, session_maker = init_db(os.path.join(workdir, "benchmark.db"))
+        session = session_maker()
+        init_session(session)
+
+        routes = generate_route_groups(args.groups, seed=args.seed)
+        add_znp_data(generate_znp(routes, seed=args.seed))
+
+        # The cached lookup is built on first use; time the steady state separately
+        _, first_seconds = time_call(lambda: lookup_znp_codes(routes), 1)
+        merged, merged_seconds = time_call(lambda: lookup_znp_codes(routes), args.repeat)
+        baseline, baseline_seconds = time_call(lambda: lookup_with_iterrows(routes), args.repeat)
+
+        session.close()
+        engine.dispose()
+
+    matches = (merged == baseline).all()
+    print(f"Route groups:          {len(routes)}")
+    print(f"iterrows lookup:       {baseline_seconds:.4f}s")
+    print(f"merge lookup (first):  {first_seconds:.4f}s")
+    print(f"merge lookup (cached): {merged_seconds:.4f}s")
+    print(f"Speedup:               {baseline_seconds / merged_seconds:.1f}x")
+    print(f"Results identical:     {matches}")
+    if not matches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+import os
+import logging
+from datetime import datetime
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Excel sheets hold at most 1,048,576 rows including the header
+EXCEL_MAX_ROWS = 1_048_575
+
+STATION_BASES = [
+    "Караганды-Сорт.", "Экибастуз", "Павлодар", "Костанай", "Актобе", "Атырау", "Шымкент",
+    "Тараз", "Алматы", "Астана", "Кокшетау", "Семей", "Жезказган", "Балхаш", "Уральск",
+    "Кызылорда", "Туркестан", "Мангышлак", "Жетыген", "Аксу", "Петропавловск", "Усть-Каменогорск",
+    "Есиль", "Тобол", "Шу", "Сарыагаш", "Достык", "Алтынколь", "Бейнеу", "Кандыагаш",
+    "Жана-Аул", "Мойынты", "Сексеул", "Арысь", "Кульсары", "Макат", "Сатпаев", "Лисаковск",
+    "Рудный", "Степногорск", "Ерейментау", "Шидерты", "Майкаин", "Курорт-Боровое", "Тюратам"
+]
+STATION_SUFFIXES = ["", " I", " II", "-Тов.", "-Пасс.", " Северный", " Южный"]
+
+WAGON_TYPES = ["ПВ", "КР", "ЦС", "ПЛ", "ХП", "ЦМВ", "МИН", "ФП"]
+WAGON_TYPE_WEIGHTS = [0.38, 0.14, 0.16, 0.10, 0.09, 0.05, 0.05, 0.03]
+
+COMPANY_WORDS = [
+    "КазТемирТранс", "Евразийская", "Энергетическая", "Промышленная", "Транзит", "Логистик",
+    "Сервис", "Казахмыс", "АрселорМиттал", "Корпорация", "Зерно", "Цемент", "Уголь", "Нефть"
+]
+
+COLUMN_ORDER = [
+    "Вагон №", "Накладная №", "Ст. отправления", "Ст. назначения", "Прибытие на ст. отправл.",
+    "Отчетная дата", "Прибытие на ст. назн.", "Груж\\пор", "Тип вагона", "Расстояние",
+    "Собственник", "Грузоотправитель", "Грузополучатель", "Простой в ожидании ремонта"
+]
+
+def make_station_names(count: int) -> List[str]:
+    """Build a list of distinct Cyrillic station names."""
+    names = []
+    for suffix in STATION_SUFFIXES:
+        for base in STATION_BASES:
+            names.append(f"{base}{suffix}")
+            if len(names) == count:
+                return names
+    # Fall back to numbered sidings for very large station sets
+    index = 1
+    while len(names) < count:
+        names.append(f"Разъезд {index}")
+        index += 1
+    return names
+
+def make_company_names(rng: np.random.Generator, count: int) -> List[str]:
+    """Build a list of company names in the style of the source files."""
+    first = rng.choice(COMPANY_WORDS, size=count)
+    second = rng.choice(COMPANY_WORDS, size=count)
+    return [f"ТОО «{a} {b} {i}»" for i, (a, b) in enumerate(zip(first, second), start=1)]
+
+def generate_stg_data(n_rows: int, seed: int = 42, n_months: int = 3,
+                      start_date: datetime = datetime(2025, 1, 1),
+                      n_stations: int = 120, trips_per_wagon: float = 6.0) -> pd.DataFrame:
+    """
+    Generate STGDaily rows with realistic wagon trip patterns.
+    Each wagon alternates loaded (ГРУЖ) legs with one or more empty (ПОР) return legs,
+    ordered by report date, so batch assignment sees real ПОР inheritance chains.
+    """
+    rng = np.random.default_rng(seed)
+
+    stations = np.array(make_station_names(n_stations), dtype=object)
+    owners = np.array(make_company_names(rng, 40), dtype=object)
+    shippers = np.array(make_company_names(rng, 300), dtype=object)
+    consignees = np.array(make_company_names(rng, 300), dtype=object)
+
+    # Spread rows over wagons; each wagon contributes a contiguous run of legs
+    n_wagons = max(1, int(n_rows / (trips_per_wagon * 2)))
+    wagon_ids = np.sort(rng.choice(np.arange(50_000_000, 99_999_999), size=n_wagons, replace=False))
+    wagon_index = np.sort(rng.integers(0, n_wagons, size=n_rows))
+    wagons = wagon_ids[wagon_index]
+
+    # Position of each row within its wagon's run
+    run_start = np.r_[0, np.flatnonzero(np.diff(wagon_index)) + 1]
+    run_lengths = np.diff(np.r_[run_start, n_rows])
+    position = np.arange(n_rows) - np.repeat(run_start, run_lengths)
+
+    # A loaded leg is followed by 1-2 empty legs; a few rows carry no status at all
+    empty_legs = rng.choice([1, 1, 2], size=n_rows)
+    is_loaded = (position == 0) | (rng.random(n_rows) < 1.0 / (1.0 + empty_legs))
+    load_status = np.where(is_loaded, "ГРУЖ", "ПОР").astype(object)
+    load_status[rng.random(n_rows) < 0.002] = ""
+
+    # Report dates move forward along each wagon's run and span the whole period
+    period_hours = max(1, n_months * 30) * 24
+    run_position = (position + rng.random(n_rows)) / np.repeat(run_lengths, run_lengths)
+    report_dates = pd.to_datetime(start_date) + pd.to_timedelta(
+        (run_position * period_hours).astype(np.int64), unit="h"
+    )
+
+    # Loaded routes are skewed towards a few busy corridors
+    corridor_weights = rng.zipf(1.6, size=len(stations)).astype(float)
+    corridor_weights /= corridor_weights.sum()
+    departure = rng.choice(stations, size=n_rows, p=corridor_weights)
+    destination = rng.choice(stations, size=n_rows, p=corridor_weights[::-1])
+
+    wagon_type_by_wagon = rng.choice(WAGON_TYPES, size=n_wagons, p=WAGON_TYPE_WEIGHTS)
+    wagon_type = wagon_type_by_wagon[wagon_index].astype(object)
+    # Occasionally the source leaves the wagon type empty
+    wagon_type[rng.random(n_rows) < 0.01] = ""
+
+    # Invoices are mostly 8-digit numbers, a few carry a Cyrillic prefix
+    invoice_numbers = rng.integers(10_000_000, 99_999_999, size=n_rows).astype(str).astype(object)
+    prefixed = rng.random(n_rows) < 0.05
+    invoice_numbers[prefixed] = "ЭА" + invoice_numbers[prefixed].astype(str)
+
+    departure_arrival = report_dates - pd.to_timedelta(rng.integers(1, 72, size=n_rows), unit="h")
+    destination_arrival = report_dates + pd.to_timedelta(rng.integers(12, 240, size=n_rows), unit="h")
+    destination_arrival = destination_arrival.where(rng.random(n_rows) < 0.8)
+
+    df = pd.DataFrame({
+        "Вагон №": wagons,
+        "Накладная №": invoice_numbers,
+        "Ст. отправления": departure,
+        "Ст. назначения": destination,
+        "Прибытие на ст. отправл.": departure_arrival,
+        "Отчетная дата": report_dates,
+        "Прибытие на ст. назн.": destination_arrival,
+        "Груж\\пор": load_status,
+        "Тип вагона": wagon_type,
+        "Расстояние": rng.integers(50, 3500, size=n_rows),
+        "Собственник": owners[rng.integers(0, len(owners), size=n_rows)],
+        "Грузоотправитель": shippers[rng.integers(0, len(shippers), size=n_rows)],
+        "Грузополучатель": consignees[rng.integers(0, len(consignees), size=n_rows)],
+        "Простой в ожидании ремонта": np.where(rng.random(n_rows) < 0.03, rng.random(n_rows) * 100, np.nan)
+    }, columns=COLUMN_ORDER)
+
+    # Shuffle so the files are not already in batch order
+    return df.sample(frac=1.0, random_state=seed).reset_index(drop=True)
+
+def generate_reference_data(stg_data: pd.DataFrame, seed: int = 42, znp_coverage: float = 0.9,
+                            exception_rate: float = 0.01, override_rate: float = 0.005,
+                            active_rate: float = 0.7) -> Dict[str, object]:
+    """
+    Generate ZNP, Exceptions, Overrides, Active and Matrix reference data matching the STG rows.
+    Returns a dict with DataFrames for 'znp', 'exceptions', 'overrides', 'matrix'
+    and a list of route IDs for 'active'.
+    """
+    rng = np.random.default_rng(seed + 1)
+
+    loaded = stg_data[stg_data["Груж\\пор"] == "ГРУЖ"]
+    months = pd.to_datetime(loaded["Отчетная дата"]).dt.month
+
+    # One ZNP per loaded route; leave some routes uncovered like a real plan
+    routes = pd.DataFrame({
+        "Месяц": months.values,
+        "Ст. отправления": loaded["Ст. отправления"].values,
+        "Ст. назначения": loaded["Ст. назначения"].values,
+        "Тип вагона": loaded["Тип вагона"].values
+    }).drop_duplicates().reset_index(drop=True)
+    routes = routes[rng.random(len(routes)) < znp_coverage].reset_index(drop=True)
+    routes["ЗНП"] = (4_000_000 + rng.permutation(len(routes))).astype(str)
+
+    exception_rows = loaded.sample(frac=exception_rate, random_state=seed)
+    exceptions = pd.DataFrame({
+        "Накладная №": exception_rows["Накладная №"].values,
+        "ExceptionRouteID": (5_000_000 + np.arange(len(exception_rows))).astype(str)
+    })
+
+    override_rows = stg_data.sample(frac=override_rate, random_state=seed + 2)
+    overrides = pd.DataFrame({
+        "Вагон №": override_rows["Вагон №"].values,
+        "Накладная №": override_rows["Накладная №"].values,
+        "ЗНП": (6_000_000 + np.arange(len(override_rows))).astype(str)
+    })
+
+    # Active routes are a subset of the codes; the rest reach an active code through the matrix
+    all_codes = pd.concat([routes["ЗНП"], exceptions["ExceptionRouteID"], overrides["ЗНП"]]).unique()
+    is_active = rng.random(len(all_codes)) < active_rate
+    active_codes = all_codes[is_active]
+    inactive_codes = all_codes[~is_active]
+
+    matrix_rows = []
+    for code in inactive_codes:
+        if len(active_codes) == 0:
+            break
+        target = active_codes[rng.integers(0, len(active_codes))]
+        if rng.random() < 0.3:
+            matrix_rows.append([code, f"9{code}", target])
+        else:
+            matrix_rows.append([code, target, None])
+    matrix = pd.DataFrame(matrix_rows, columns=["Код 1", "Код 2", "Код 3"])
+
+    return {
+        "znp": routes,
+        "exceptions": exceptions,
+        "overrides": overrides,
+        "active": list(active_codes),
+        "matrix": matrix
+    }
+
+def generate_expense_data(stg_data: pd.DataFrame, n_rows: int, seed: int = 42,
+                          match_rate: float = 0.85) -> pd.DataFrame:
+    """Generate expense rows referencing STG wagons and invoices, plus some unmatched rows."""
+    rng = np.random.default_rng(seed + 3)
+
+    sample = stg_data.sample(n=n_rows, replace=n_rows > len(stg_data), random_state=seed)
+    wagons = sample["Вагон №"].values.astype(object)
+    invoices = sample["Накладная №"].values.astype(object)
+
+    unmatched = rng.random(n_rows) > match_rate
+    invoices[unmatched] = rng.integers(10_000_000, 99_999_999, size=unmatched.sum()).astype(str)
+
+    return pd.DataFrame({
+        "Дата": pd.to_datetime(sample["Отчетная дата"].values).date,
+        "Номер вагона": wagons,
+        "Номер документа": invoices,
+        "Услуга": rng.choice(["Тариф", "Подача-уборка", "Простой", "Охрана"], size=n_rows),
+        "Сумма": np.round(rng.random(n_rows) * 250_000, 2)
+    })
+
+def write_expense_workbook(expense_data: pd.DataFrame, output_path: str) -> str:
+    """Write an expense workbook with a title block above the header row, like the 1C exports."""
+    with pd.ExcelWriter(output_path, engine="openpyxl") as writer:
+        title = pd.DataFrame([["Реестр расходов"], [f"Сформирован {datetime.now():%d.%m.%Y}"], [None]])
+        title.to_excel(writer, index=False, header=False, startrow=0)
+        expense_data.to_excel(writer, index=False, startrow=3)
+    return output_path
+
+def write_dataset(output_dir: str, n_rows: int, seed: int = 42, n_months: int = 3,
+                  history_fraction: float = 0.8, expense_rows: int = 5000,
+                  expense_files: int = 1) -> Dict[str, object]:
+    """
+    Write a complete synthetic dataset to disk.
+
+    The first history_fraction of rows (by report date) goes into a baseline workbook
+    (the existing_data_path file); the rest is split into STGDaily_ddmmyyyy.xlsx files.
+    Workbooks are capped at the Excel row limit, so very large scales produce
+    several files per day.
+    Returns the paths of everything that was written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    stg_folder = os.path.join(output_dir, "STG")
+    expense_folder = os.path.join(output_dir, "Expenses")
+    os.makedirs(stg_folder, exist_ok=True)
+    os.makedirs(expense_folder, exist_ok=True)
+
+    stg_data = generate_stg_data(n_rows, seed=seed, n_months=n_months)
+    stg_data = stg_data.sort_values("Отчетная дата", kind="mergesort").reset_index(drop=True)
+    split = int(len(stg_data) * history_fraction)
+
+    history = stg_data.iloc[:split]
+    history_path = os.path.join(output_dir, "STGHistory.xlsx")
+    _write_capped_excel(history, history_path)
+
+    daily_paths = []
+    daily = stg_data.iloc[split:]
+    for day, day_rows in daily.groupby(daily["Отчетная дата"].dt.date):
+        path = os.path.join(stg_folder, f"STGDaily_{day:%d%m%Y}.xlsx")
+        daily_paths.extend(_write_capped_excel(day_rows, path))
+
+    reference = generate_reference_data(stg_data, seed=seed)
+    paths = {
+        "stg_folder": stg_folder,
+        "existing_data_path": history_path,
+        "daily_files": daily_paths,
+        "znp_path": os.path.join(output_dir, "ЗНП.xlsx"),
+        "exceptions_path": os.path.join(output_dir, "Exceptions.xlsx"),
+        "overrides_path": os.path.join(output_dir, "Overrides.xlsx"),
+        "active_path": os.path.join(output_dir, "Active.csv"),
+        "matrix_path": os.path.join(output_dir, "Matrix.csv"),
+        "expense_folder": expense_folder
+    }
+    reference["znp"].to_excel(paths["znp_path"], index=False)
+    reference["exceptions"].to_excel(paths["exceptions_path"], index=False)
+    reference["overrides"].to_excel(paths["overrides_path"], index=False)
+    pd.DataFrame({"route_id": reference["active"]}).to_csv(paths["active_path"], index=False)
+    reference["matrix"].to_csv(paths["matrix_path"], index=False)
+
+    for index in range(expense_files):
+        expenses = generate_expense_data(stg_data, expense_rows, seed=seed + index)
+        write_expense_workbook(expenses, os.path.join(expense_folder, f"Expenses_{index + 1:03d}.xlsx"))
+
+    logger.info(f"Synthetic dataset with {n_rows} STG rows written to {output_dir}")
+    return paths
+
+def _write_capped_excel(df: pd.DataFrame, path: str) -> List[str]:
+    """Write a frame to one or more workbooks that respect the Excel row limit."""
+    if len(df) <= EXCEL_MAX_ROWS:
+        df.to_excel(path, index=False)
+        return [path]
+
+    root, ext = os.path.splitext(path)
+    paths = []
+    for part, start in enumerate(range(0, len(df), EXCEL_MAX_ROWS), start=1):
+        part_path = f"{root}_{part}{ext}"
+        df.iloc[start:start + EXCEL_MAX_ROWS].to_excel(part_path, index=False)
+        paths.append(part_path)
+    return paths
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic STG / reference / expense dataset")
+    parser.add_argument("output_dir", help="Directory to write the dataset to")
+    parser.add_argument("--rows", type=int, default=10_000, help="Number of STG rows (default: 10000)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (default: 42)")
+    parser.add_argument("--months", type=int, default=3, help="Number of months covered (default: 3)")
+    parser.add_argument("--expense-rows", type=int, default=5000, help="Rows per expense workbook")
+    parser.add_argument("--expense-files", type=int, default=1, help="Number of expense workbooks")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    write_dataset(args.output_dir, args.rows, seed=args.seed, n_months=args.months,
+                  expense_rows=args.expense_rows, expense_files=args.expense_files)
@@ -0,0 +1,253 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import subprocess
+import statistics
+from datetime import datetime
+from typing import Dict, List, Any, Optional
+
+import pandas as pd
+
+# The application resolves its database and config paths from APPDATA
+os.environ.setdefault('APPDATA', tempfile.gettempdir())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.file_processor import FileProcessor
+from app.core.expense_processor import ExpenseProcessor
+from app.database.models import init_db
+from app.database.analytics import QUERY_ENGINES, init_query_engine, close_query_engine
+from app.database.operations import (
+    init_session, add_znp_data, add_exceptions, add_overrides, add_active_routes, add_matrix_mappings,
+    get_wn_keys, count_stg_history
+)
+from app.utils.metrics import RunMetrics
+from app.utils.logging_setup import LOG_FORMAT, setup_logging
+from app.utils.stg_schema import prepare_stg_frame, frame_memory_mb
+from benchmarks.data_generator import (
+    generate_stg_data, generate_reference_data, generate_expense_data, write_expense_workbook
+)
+
+logger = logging.getLogger(__name__)
+
+def get_commit() -> Optional[str]:
+    """Return the current git commit, if the benchmark runs inside the repository."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+def import_reference(reference: Dict[str, Any]) -> int:
+    """Load the synthetic reference data into the benchmark database."""
+    count = add_znp_data(reference['znp'].copy())['total']
+    count += add_exceptions(reference['exceptions'])['total']
+    count += add_overrides(reference['overrides'])['total']
+    count += add_active_routes(reference['active'])['total']
+    count += add_matrix_mappings(reference['matrix'])['total']
+    return count
+
+def run_scale(n_rows: int, workdir: str, seed: int = 42, repeat: int = 3, with_io: bool = False,
+              expense_rows: int = 5000, trace_memory: bool = False,
+              stages: Optional[List[str]] = None, query_engine: str = 'sqlite') -> Dict[str, Any]:
+    """
+    Run every pipeline stage on a synthetic dataset of n_rows STG rows.
+    History scans run on the given query engine ('sqlite' or 'duckdb').
+    Returns per-stage timings for all repetitions.
+    """
+    stg_source = generate_stg_data(n_rows, seed=seed)
+    reference = generate_reference_data(stg_source, seed=seed)
+
+    scale_dir = os.path.join(workdir, f"rows_{n_rows}")
+    expense_folder = os.path.join(scale_dir, "Expenses")
+    os.makedirs(expense_folder, exist_ok=True)
+    write_expense_workbook(
+        generate_expense_data(stg_source, expense_rows, seed=seed),
+        os.path.join(expense_folder, "Expenses_001.xlsx")
+    )
+
+    if with_io:
+        stg_folder = os.path.join(scale_dir, "STG")
+        os.makedirs(stg_folder, exist_ok=True)
+        split = int(len(stg_source) * 0.8)
+        history_path = os.path.join(scale_dir, "STGHistory.xlsx")
+        stg_source.iloc[:split].to_excel(history_path, index=False)
+        stg_source.iloc[split:].to_excel(os.path.join(stg_folder, "STGDaily_01012025.xlsx"), index=False)
+
+    db_path = os.path.join(scale_dir, "benchmark.db")
+    _, session_maker = init_db(db_path)
+    init_session(session_maker())
+    init_query_engine(query_engine, db_path)
+
+    config = {'output_directory': scale_dir, 'base_directory': scale_dir}
+    processor = FileProcessor(config)
+    expense_processor = ExpenseProcessor(config)
+    metrics = RunMetrics(trace_memory=trace_memory)
+
+    def wanted(name: str) -> bool:
+        return not stages or name in stages
+
+    for _ in range(repeat):
+        with metrics.stage("import_reference") as stage:
+            stage.rows_out = import_reference(reference)
+
+        if with_io and wanted("process_daily_files"):
+            with metrics.stage("process_daily_files") as stage:
+                daily_data = processor.process_daily_files(stg_folder)
+                stage.rows_out = len(daily_data)
+            with metrics.stage("merge_with_existing_data", rows_in=len(daily_data)) as stage:
+                stage.rows_out = len(processor.merge_with_existing_data(daily_data, history_path))
+            if wanted("assign_history_batch_ids"):
+                with metrics.stage("assign_history_batch_ids", rows_in=count_stg_history()) as stage:
+                    processor.assign_history_batch_ids(chunk_rows=max(1, n_rows // 10))
+                    stage.rows_out = stage.rows_in
+
+        with metrics.stage("prepare_stg", rows_in=len(stg_source)) as stage:
+            stg_data = prepare_stg_frame(stg_source)
+            stg_data["wn_key"] = get_wn_keys(stg_data["wagon_number"], stg_data["invoice_number"])
+            stage.rows_out = len(stg_data)
+
+        with metrics.stage("assign_batch_ids", rows_in=len(stg_data)) as stage:
+            batched_data = processor.assign_batch_ids(stg_data)
+            stage.rows_out = len(batched_data)
+
+        with metrics.stage("map_znp_to_batches", rows_in=len(batched_data)) as stage:
+            final_data = processor.map_znp_to_batches(batched_data)
+            stage.rows_out = len(final_data)
+
+        with metrics.stage("export_route_id_data", rows_in=len(final_data)) as stage:
+            route_id_path = processor.export_route_id_data(
+                final_data, os.path.join(scale_dir, "Route_ID_benchmark.csv")
+            )
+            stage.rows_out = len(final_data)
+
+        if wanted("process_expenses"):
+            with metrics.stage("process_expenses", rows_in=expense_rows) as stage:
+                result = expense_processor.process_expense_folder(expense_folder, route_id_path)
+                stage.rows_out = result['processed_files']
+
+    results = summarize(metrics, n_rows)
+    results['frame_memory_mb'] = {
+        'source': frame_memory_mb(stg_source),
+        'prepared': frame_memory_mb(stg_data),
+        'batched': frame_memory_mb(batched_data)
+    }
+    return results
+
+def summarize(metrics: RunMetrics, n_rows: int) -> Dict[str, Any]:
+    """Group the recorded stages by name and compute the median wall time of each."""
+    by_stage: Dict[str, List[Dict[str, Any]]] = {}
+    for record in metrics.summary():
+        if record['depth'] == 0:
+            by_stage.setdefault(record['stage'], []).append(record)
+
+    stage_results = {}
+    for name, records in by_stage.items():
+        walls = [r['wall_seconds'] for r in records]
+        stage_results[name] = {
+            'wall_seconds': walls,
+            'median_wall_seconds': statistics.median(walls),
+            'median_cpu_seconds': statistics.median(r['cpu_seconds'] for r in records),
+            'rows_in': records[-1]['rows_in'],
+            'rows_out': records[-1]['rows_out'],
+            'peak_memory_bytes': max((r['peak_memory_bytes'] or 0) for r in records) or None,
+            'rss_bytes': records[-1]['rss_bytes']
+        }
+    return {'rows': n_rows, 'stages': stage_results}
+
+def compare(current: Dict[str, Any], baseline_path: str) -> None:
+    """Print the median wall time of each stage next to a previous results file."""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    baseline_scales = {scale['rows']: scale for scale in baseline.get('scales', [])}
+    print(f"\nComparison against {baseline_path} (commit {baseline.get('commit')})")
+    print(f"{'rows':>10}  {'stage':<28} {'baseline s':>11} {'current s':>10} {'speedup':>8}")
+    for scale in current['scales']:
+        old_scale = baseline_scales.get(scale['rows'])
+        if not old_scale:
+            continue
+        for name, result in scale['stages'].items():
+            old = old_scale['stages'].get(name)
+            if not old:
+                continue
+            old_wall = old['median_wall_seconds']
+            new_wall = result['median_wall_seconds']
+            speedup = old_wall / new_wall if new_wall else float('inf')
+            print(f"{scale['rows']:>10}  {name:<28} {old_wall:>11.4f} {new_wall:>10.4f} {speedup:>7.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the route pipeline stages on synthetic data")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000],
+                        help="STG row counts to benchmark (default: 10000)")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions per scale (default: 3)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (default: 42)")
+    parser.add_argument("--expense-rows", type=int, default=5000, help="Rows in the expense workbook")
+    parser.add_argument("--with-io", action="store_true",
+                        help="Also benchmark reading STG workbooks, merging with the history workbook "
+                             "and the out-of-core batch walk over the stored history")
+    parser.add_argument("--memory", action="store_true", help="Track peak memory with tracemalloc (slower)")
+    parser.add_argument("--stages", nargs="*", help="Only run the optional stages listed here")
+    parser.add_argument("--query-engine", choices=QUERY_ENGINES, default="sqlite",
+                        help="Engine for history scans (default: sqlite)")
+    parser.add_argument("--log-dir",
+                        help="Log at INFO as the application does, through the queue to a rotating file "
+                             "in this directory (default: warnings to the console only)")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the JSON results")
+    parser.add_argument("--compare", help="Previous results file to compare against")
+    parser.add_argument("--workdir", help="Directory for generated files (default: a temporary directory)")
+    args = parser.parse_args()
+
+    if args.log_dir:
+        setup_logging(args.log_dir, console=False)
+    else:
+        logging.basicConfig(level=logging.WARNING, format=LOG_FORMAT)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="logistics_bench_")
+    try:
+        scales = []
+        for n_rows in args.rows:
+            print(f"Benchmarking {n_rows} rows...")
+            scales.append(run_scale(
+                n_rows, workdir, seed=args.seed, repeat=args.repeat, with_io=args.with_io,
+                expense_rows=args.expense_rows, trace_memory=args.memory, stages=args.stages,
+                query_engine=args.query_engine
+            ))
+    finally:
+        close_query_engine()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        'commit': get_commit(),
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'query_engine': args.query_engine,
+        'scales': scales
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    for scale in scales:
+        for name, result in scale['stages'].items():
+            print(f"{scale['rows']:>10}  {name:<28} {result['median_wall_seconds']:.4f}s")
+        memory = scale['frame_memory_mb']
+        print(f"{scale['rows']:>10}  STG frame memory: {memory['source']:.1f} MB as read, "
+              f"{memory['prepared']:.1f} MB prepared, {memory['batched']:.1f} MB with batch IDs")
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,9 @@
 echo Installing required packages...
 python -m pip install -r requirements.txt
 
+echo Installing the DuckDB sqlite extension for bundling...
+python -c "import duckdb; c = duckdb.connect(); c.execute(\"SET extension_directory = 'extensions'\"); c.execute('INSTALL sqlite')"
+
 echo Building executable...
 python -m PyInstaller --name="LogisticsProcessor" ^
     --windowed ^
@@ -9,10 +12,13 @@ python -m PyInstaller --name="LogisticsProcessor" ^
     --add-data="app;app" ^
     --add-data="usm.ico;." ^
     --add-data="config.json;." ^
+    --add-data="extensions;extensions" ^
     --hidden-import=pandas ^
     --hidden-import=openpyxl ^
     --hidden-import=PyQt5 ^
     --hidden-import=sqlalchemy ^
+    --hidden-import=pyarrow ^
+    --hidden-import=duckdb ^
     main.py
 
 echo Build complete!
@@ -2,10 +2,12 @@ import sys
 import os
 import logging
 import argparse
+import multiprocessing
 from PyQt5.QtWidgets import QApplication
 
 from app.main import LogisticsProcessorApp
 from app.utils.file_utils import ensure_directory_exists
+from app.utils.logging_setup import setup_logging as start_queue_logging
 from app.config import load_config
 from app.core.expense_processor import ExpenseProcessor
 from app.database.models import init_db
@@ -14,17 +16,9 @@ from app.core.file_processor import FileProcessor
 
 # Setup logging
 def setup_logging():
+    """Log through a queue to a rotating file in AppData and to the console."""
     log_dir = os.path.join(os.getenv('APPDATA'), 'Logistics Data Processor', 'logs')
-    os.makedirs(log_dir, exist_ok=True)
-    
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(os.path.join(log_dir, "logistics_processor.log")),
-            logging.StreamHandler()
-        ]
-    )
+    start_queue_logging(log_dir)
 
 def process_expenses(config, folder_type):
     """Process expense files."""
@@ -96,4 +90,6 @@ def main():
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
+    # Reference imports parse files in worker processes; needed for the frozen executable
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file